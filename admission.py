@@ -0,0 +1,194 @@
+"""
+admission
+
+Admission control in front of the detection engine. Every synchronous
+detection request is charged its number of 4 s segments; the controller
+keeps the segments admitted and not finished yet, and the rate at which
+the engine works them off, measured while it is busy (so it follows the
+replicas, the micro-batcher, the cache and early exit without being told
+about them).
+
+The projected wait of a request is (segments in flight + its own) / rate.
+When it is over the SLO, or MAX_PENDING requests are already in flight,
+the request is refused at once with Overloaded, whose retry_after is the
+time the backlog needs to drain to the point the request would fit:
+a 503 with Retry-After is cheaper for the client than a response that
+comes too late, and it keeps the queue (and the latency of the requests
+that were admitted) bounded under overload.
+
+Usage:
+  admission = get_admission()
+  with admission.admit(num_segments(len(waveform), sr)):
+      result = engine.detect(waveform, sr=sr)
+"""
+import math
+import os
+import threading
+import time
+
+from metrics import QUEUE_DEPTH
+
+# longest projected wait (seconds) of an admitted request, 0 disables
+ADMISSION_SLO = float(os.environ.get("ECHOWIPE_ADMISSION_SLO", "20"))
+# detection requests in flight at once, further requests are refused; 0
+# sets no limit
+MAX_PENDING = int(os.environ.get("ECHOWIPE_MAX_PENDING", "64"))
+# seconds per 4 s segment assumed before anything is measured
+SEGMENT_SECONDS = float(os.environ.get("ECHOWIPE_SEGMENT_SECONDS", "0.25"))
+# time constant (seconds) of the throughput estimate
+RATE_WINDOW = float(os.environ.get("ECHOWIPE_RATE_WINDOW", "30"))
+
+SEGMENT_LEN = 96000
+SAMPLE_RATE = 24000
+
+
+def num_segments(num_samples, sr=SAMPLE_RATE):
+    """ 4 s segments the engine scores for a waveform (eval.segment). """
+    samples = int(math.ceil(num_samples * float(SAMPLE_RATE) / sr))
+    return max(int(math.ceil(samples / float(SEGMENT_LEN))), 1)
+
+
+class Overloaded(RuntimeError):
+    """ Raised by AdmissionController.admit when a request would wait too long. """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    admission = AdmissionController(slo=ADMISSION_SLO, max_pending=MAX_PENDING,
+                                    segment_seconds=SEGMENT_SECONDS,
+                                    window=RATE_WINDOW)
+
+    slo: float, longest projected wait in seconds, 0 admits everything
+    max_pending: int, requests in flight at once, 0 sets no limit
+    segment_seconds: float, initial estimate of the seconds per segment
+    window: float, seconds over which the throughput is averaged
+
+    admit(segments) is a context manager around the scoring of a request.
+    """
+
+    def __init__(self, slo=ADMISSION_SLO, max_pending=MAX_PENDING,
+                 segment_seconds=SEGMENT_SECONDS, window=RATE_WINDOW):
+        if max_pending < 0:
+            raise ValueError("max_pending should be >= 0")
+        self.slo = slo
+        self.max_pending = max_pending
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._segments = 0
+        self._last = time.monotonic()
+        # throughput as decayed segments done / decayed busy seconds; the
+        # prior weighs like one second of measurements
+        self._busy = 1.0
+        self._done = 1.0 / segment_seconds
+        self.admitted = 0
+        self.rejected = 0
+
+    def _advance(self, now):
+        # called with the lock held, at every admission and completion
+        elapsed = now - self._last
+        decay = math.exp(-elapsed / self.window)
+        self._done *= decay
+        self._busy *= decay
+        if self._pending:
+            self._busy += elapsed
+        self._last = now
+
+    @property
+    def pending(self):
+        """ Requests admitted and not finished. """
+        return self._pending
+
+    @property
+    def rate(self):
+        """ Segments scored per second while busy. """
+        return self._done / self._busy
+
+    def _full(self):
+        return bool(self.max_pending) and self._pending >= self.max_pending
+
+    def _wait(self, segments):
+        return (self._segments + segments) / self.rate
+
+    def admit(self, segments):
+        """ Context manager charging a request of segments segments. """
+        return _Ticket(self, segments)
+
+    def _enter(self, segments):
+        with self._lock:
+            self._advance(time.monotonic())
+            if self._full():
+                self.rejected += 1
+                raise Overloaded(
+                    "Server busy: {} requests in flight".format(self._pending),
+                    max(int(math.ceil(self._segments / self.rate / self._pending)), 1))
+            wait = self._wait(segments)
+            if self.slo and wait > self.slo and self._segments:
+                # a request alone is always admitted, even a long one
+                self.rejected += 1
+                raise Overloaded(
+                    "Server busy: estimated wait {:.1f} s".format(wait),
+                    max(int(math.ceil(wait - self.slo)), 1))
+            self._pending += 1
+            self._segments += segments
+            self.admitted += 1
+
+    def _exit(self, segments):
+        with self._lock:
+            self._advance(time.monotonic())
+            self._pending -= 1
+            self._segments -= segments
+            self._done += segments
+
+    def stats(self):
+        """ Queue depth and estimated wait of a one-segment request. """
+        with self._lock:
+            self._advance(time.monotonic())
+            wait = self._wait(1)
+            return {
+                "ready": not self._full()
+                and not (self.slo and wait > self.slo and self._segments),
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "segments": self._segments,
+                "segments_per_second": round(self.rate, 3),
+                "estimated_wait": round(wait, 3),
+                "slo": self.slo,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+
+
+class _Ticket:
+
+    def __init__(self, controller, segments):
+        self.controller = controller
+        self.segments = segments
+
+    def __enter__(self):
+        self.controller._enter(self.segments)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.controller._exit(self.segments)
+        return False
+
+
+_admission = None
+_admission_lock = threading.Lock()
+
+
+def get_admission():
+    """ Return the per-process AdmissionController, created on first use. """
+    global _admission
+    if _admission is None:
+        with _admission_lock:
+            if _admission is None:
+                _admission = AdmissionController()
+                QUEUE_DEPTH.set_function(lambda: _admission.pending,
+                                         queue="admission")
+    return _admission
@@ -1,48 +1,61 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
-import json, os, uuid
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context
+import io, json, os
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 
+from upload_io import InMemoryRequest, UploadError, decode_upload, MAX_UPLOAD_BYTES
+
 # ---------------- APP SETUP ----------------
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-key")
+# uploads stay in memory, so the body size is capped up front
+app.request_class = InMemoryRequest
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES + 64 * 1024
 
 # ---------------- RENDER HEALTH CHECK ----------------
 @app.route("/echowipe")
 def echowipe():
     return "EchoWipe is running"
 
+# ---------------- METRICS ----------------
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(),
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ---------------- READINESS ----------------
+@app.route("/echowipe/ready")
+def echowipe_ready():
+    # 503 while new detection requests would be refused, so that a load
+    # balancer sends them elsewhere
+    stats = get_admission().stats()
+    return jsonify(stats), 200 if stats["ready"] else 503
+
 # ---------------- PATHS ----------------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-from model_service import detect_voice
+from model_service import get_engine, preload_engine, PRELOAD
+import metrics
+from admission import Overloaded, get_admission, num_segments
+from job_queue import JobQueueFull, get_job_queue, MAX_JOB_BYTES
+from stream_detect import StreamDetector, StatefulStreamDetector, STREAM_HOP, check_format, iter_stream_samples, stream_format
+import core_scripts.data_io.wav_tools as nii_wav_tk
 
 # ---------------- DATABASE ----------------
-USER_DB = os.path.join(BASE_DIR, "users.json")
-
-def load_users():
-    if os.path.exists(USER_DB):
-        with open(USER_DB, "r") as f:
-            return json.load(f)
-    return {}
-
-def save_users(users):
-    with open(USER_DB, "w") as f:
-        json.dump(users, f, indent=4)
+# users.db, with users.json imported on first use, see user_store
+from user_store import get_user_store
 
 # ---------------- HOME ----------------
 @app.route("/", methods=["GET", "POST"])
 def index():
-    users = load_users()
-
     # ---------- LOGIN ----------
     if request.method == "POST" and request.form.get("action") == "login":
         email = request.form.get("login_email")
         password = request.form.get("login_password")
 
-        if email in users and check_password_hash(users[email]["password"], password):
+        user = get_user_store().get(email) if email else None
+        if user is not None and user["password"] and \
+                check_password_hash(user["password"], password or ""):
             session["email"] = email
             return redirect(url_for("dashboard"))
         else:
@@ -61,16 +74,12 @@ def index():
             flash("All fields are required", "warning")
         elif password != confirm:
             flash("Passwords do not match", "danger")
-        elif email in users:
+        elif not get_user_store().create(
+                email, generate_password_hash(password), first=first, last=last,
+                created=datetime.now().strftime("%d-%m-%Y %H:%M")):
+            # the unique index on email decides, even between workers
             flash("User already exists", "danger")
         else:
-            users[email] = {
-                "first": first,
-                "last": last,
-                "password": generate_password_hash(password),
-                "created": datetime.now().strftime("%d-%m-%Y %H:%M")
-            }
-            save_users(users)
             session["email"] = email
             flash("Signup successful!", "success")
             return redirect(url_for("dashboard"))
@@ -87,51 +96,134 @@ def dashboard():
 # ---------------- DETECT (WEB) ----------------
 @app.route("/detect", methods=["POST"])
 def detect():
-    if "audio" not in request.files:
+    with metrics.timer("upload"):
+        files = request.files
+    if "audio" not in files:
         return render_template("dashboard.html", error="No file uploaded")
 
-    file = request.files["audio"]
-    filename = f"{uuid.uuid4().hex}.wav"
-    path = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(path)
+    try:
+        with metrics.timer("decode"):
+            waveform, sr = decode_upload(files["audio"].stream)
+    except UploadError as e:
+        return render_template("dashboard.html", error=str(e)), e.status
 
     try:
-        fake, real, _ = detect_voice(path)
-        result = {
-            "fake": round(fake, 4),
-            "real": round(real, 4),
-            "label": "FAKE (AI)" if fake > real else "REAL"
-        }
-    finally:
-        if os.path.exists(path):
-            os.remove(path)
+        with get_admission().admit(num_segments(len(waveform), sr)):
+            detection = get_engine().detect(waveform, sr=sr)
+    except Overloaded as e:
+        return render_template("dashboard.html", error=str(e)), 503, \
+            {"Retry-After": str(e.retry_after)}
+    result = {
+        "fake": round(detection["fake"], 4),
+        "real": round(detection["real"], 4),
+        "label": detection["label"],
+        "cache": detection.get("cache")
+    }
 
     return render_template("dashboard.html", result=result)
 
 # ---------------- PUBLIC API (JSON) ----------------
 @app.route("/api/detect", methods=["POST"])
 def api_detect():
-    if "audio" not in request.files:
+    with metrics.timer("upload"):
+        files = request.files
+    if "audio" not in files:
         return jsonify({"error": "No file"}), 400
 
-    file = request.files["audio"]
-    filename = f"{uuid.uuid4().hex}.wav"
-    path = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(path)
+    try:
+        with metrics.timer("decode"):
+            waveform, sr = decode_upload(files["audio"].stream)
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+
+    try:
+        with get_admission().admit(num_segments(len(waveform), sr)):
+            return jsonify(get_engine().detect(waveform, sr=sr))
+    except Overloaded as e:
+        return jsonify({"error": str(e), "retry_after": e.retry_after}), 503, \
+            {"Retry-After": str(e.retry_after)}
+
+# ---------------- STREAMING ----------------
+@app.route("/api/stream", methods=["POST"])
+def api_stream():
+    """
+    Raw audio in the request body (chunked transfer encoding is fine),
+    one JSON line per scored window in the response.
+
+    Query: encoding=pcm16|pcm24|pcm32|float32|wav (default pcm16),
+           sr (default 24000), channels (default 1), hop (24 kHz samples),
+           stateful=1 to carry the GRU state across hops instead of
+           re-scoring whole windows (torch backend, 24 kHz only)
+    """
+    # the stream may run for hours; memory is bounded by the ring buffer
+    request.max_content_length = None
+    stream = request.stream
+    try:
+        if request.args.get("encoding", "pcm16") == "wav":
+            fmt = check_format(nii_wav_tk.wavHeaderRead(stream)[0])
+        else:
+            fmt = stream_format(request.args.get("encoding", "pcm16"),
+                                request.args.get("sr", 24000, type=int),
+                                request.args.get("channels", 1, type=int))
+        detector_class = StatefulStreamDetector \
+            if request.args.get("stateful") in ("1", "true") else StreamDetector
+        detector = detector_class(get_engine(), fmt["sr"],
+                                  request.args.get("hop", STREAM_HOP, type=int))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        try:
+            for samples in iter_stream_samples(stream, fmt):
+                for window in detector.push(samples):
+                    yield json.dumps(window) + "\n"
+            for window in detector.finish():
+                yield json.dumps(window) + "\n"
+            yield json.dumps(dict(detector.result(), done=True)) + "\n"
+        except ValueError as e:
+            yield json.dumps({"error": str(e), "done": True}) + "\n"
+
+    return Response(stream_with_context(generate()),
+                    mimetype="application/x-ndjson")
+
+# ---------------- JOBS (LONG RECORDINGS) ----------------
+@app.route("/api/jobs", methods=["POST"])
+def api_create_job():
+    # long recordings: the job limit replaces the app-wide upload limit
+    request.max_content_length = MAX_JOB_BYTES + 64 * 1024
+    request.spool_uploads = True
+    if "audio" not in request.files:
+        return jsonify({"error": "No file"}), 400
 
+    # decoding and scoring happen in the job workers
+    upload = request.files["audio"]
     try:
-        fake, real, _ = detect_voice(path)
-        return jsonify({
-            "fake": float(fake),
-            "real": float(real),
-            "label": "FAKE (AI)" if fake > real else "REAL"
-        })
-    finally:
-        if os.path.exists(path):
-            os.remove(path)
+        job_id = get_job_queue().submit(upload.stream, request.form.get("callback_url"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except JobQueueFull as e:
+        return jsonify({"error": str(e)}), 503
+    # the job closes the temporary file, not the end of the request
+    upload.stream = io.BytesIO()
+
+    return jsonify({"id": job_id, "status": "queued",
+                    "url": url_for("api_get_job", job_id=job_id)}), 202
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def api_get_job(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
 
 # ---------------- LOGOUT ----------------
 @app.route("/logout")
 def logout():
     session.clear()
     return redirect(url_for("index"))
+
+# ---------------- PRE-FORK MODEL LOADING ----------------
+# gunicorn --preload imports this module in the master: loading the model
+# here, last, lets every worker share one copy of the weights
+if PRELOAD:
+    preload_engine()
@@ -0,0 +1,196 @@
+"""
+batch_scheduler
+
+Request-coalescing scheduler in front of RawNet.
+
+Segments submitted by concurrent requests are put on a single queue; a
+worker thread pops up to max_batch_size of them, waiting at most
+max_wait_ms after the first one arrives, runs one batched forward and
+scatters the per-segment probabilities back to the owning requests.
+
+With num_workers > 1, that many threads collect and run batches at
+once, for a forward_fn that can run several batches in parallel (see
+replica_pool).
+
+Segments do not need to have the same length (see DetectionEngine
+variable_length): a batch holding several lengths is split into buckets
+of bucket_size samples, and each bucket is zero-padded to its longest
+segment and run as forward_fn(batch, lengths).
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+def pad_batch(segments):
+    """
+    batch, lengths = pad_batch(segments)
+
+    segments: list of 1-D arrays
+    batch: (num_segments, max length) float32 array, zeros after each segment
+    lengths: (num_segments, ) int64 array
+    """
+    lengths = np.array([len(segment) for segment in segments], dtype=np.int64)
+    batch = np.zeros((len(segments), lengths.max()), dtype=np.float32)
+    for row, segment in enumerate(segments):
+        batch[row, :len(segment)] = segment
+    return batch, lengths
+
+
+def length_buckets(lengths, bucket_size):
+    """ Indices of the segments of each bucket, shortest bucket first. """
+    buckets = {}
+    for idx, length in enumerate(lengths):
+        buckets.setdefault((length - 1) // bucket_size, []).append(idx)
+    return [buckets[key] for key in sorted(buckets)]
+
+
+class _Request:
+    """ Book-keeping for the segments of one submitted request. """
+
+    def __init__(self, num_segments):
+        self.future = Future()
+        # with several workers, batches of one request finish concurrently
+        self.lock = threading.Lock()
+        self.pending = num_segments
+        self.binary = [None] * num_segments
+        self.multi = [None] * num_segments
+
+
+class BatchScheduler:
+    """
+    scheduler = BatchScheduler(forward_fn, max_batch_size=16, max_wait_ms=10)
+
+    forward_fn: callable, (batch, 96000) array -> (probs_binary, probs_multi);
+                takes the lengths as second argument when segments of
+                several lengths are submitted
+    max_batch_size: int, upper bound of segments in one forward
+    max_wait_ms: float, how long the first segment of a batch may wait for
+                 company before the batch is run anyway
+    bucket_size: int, width in samples of the length buckets
+    num_workers: int, batches run at the same time
+    """
+
+    def __init__(self, forward_fn, max_batch_size=16, max_wait_ms=10,
+                 bucket_size=24000, num_workers=1):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size should be >= 1")
+        self.forward_fn = forward_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.bucket_size = bucket_size
+        self.num_workers = max(num_workers, 1)
+        self._queue = queue.Queue()
+        self._workers = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, segments):
+        """
+        future = scheduler.submit(segments)
+
+        segments: list of 1-D arrays, or a (num_segments, length) array
+
+        The future resolves to (probs_binary, probs_multi), arrays of shape
+        (num_segments, 2) and (num_segments, 7) in submission order.
+        """
+        self._ensure_worker()
+        request = _Request(len(segments))
+        if request.pending == 0:
+            request.future.set_exception(ValueError("No segments to score"))
+            return request.future
+        for idx, segment in enumerate(segments):
+            self._queue.put((request, idx, segment))
+        return request.future
+
+    def depth(self):
+        """ Segments waiting for a batch. """
+        return self._queue.qsize()
+
+    def close(self):
+        """ Stop the worker threads after the queued segments are scored. """
+        if self._pid == os.getpid():
+            for _ in self._workers:
+                self._queue.put(None)
+            for worker in self._workers:
+                worker.join()
+        self._workers = []
+
+    def _ensure_worker(self):
+        # threads do not survive fork(), so a worker started in the gunicorn
+        # master has to be recreated in each worker process
+        pid = os.getpid()
+        if self._workers and self._pid == pid:
+            return
+        with self._lock:
+            if not self._workers or self._pid != pid:
+                self._queue = queue.Queue()
+                self._pid = pid
+                self._workers = [threading.Thread(
+                    target=self._run, name="rawnet-batcher", daemon=True)
+                    for _ in range(self.num_workers)]
+                for worker in self._workers:
+                    worker.start()
+
+    def _collect(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        items = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # let the loop see the sentinel after this batch
+                self._queue.put(None)
+                break
+            items.append(item)
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            if items is None:
+                return
+            lengths = [len(segment) for _, _, segment in items]
+            if min(lengths) == max(lengths):
+                self._forward(items)
+            else:
+                for rows in length_buckets(lengths, self.bucket_size):
+                    self._forward([items[row] for row in rows], padded=True)
+
+    def _forward(self, items, padded=False):
+        try:
+            segments = [segment for _, _, segment in items]
+            if padded:
+                batch, lengths = pad_batch(segments)
+                probs_binary, probs_multi = self.forward_fn(batch, lengths)
+            else:
+                probs_binary, probs_multi = self.forward_fn(np.stack(segments))
+        except Exception as e:
+            for request, _, _ in items:
+                with request.lock:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+            return
+
+        for row, (request, idx, _) in enumerate(items):
+            with request.lock:
+                if request.future.done():
+                    continue
+                request.binary[idx] = probs_binary[row]
+                request.multi[idx] = probs_multi[row]
+                request.pending -= 1
+                if request.pending == 0:
+                    request.future.set_result((np.stack(request.binary),
+                                               np.stack(request.multi)))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+bench_audio_frontend
+
+Decode + resample to 24 kHz: librosa.load / librosa.resample against the
+WAV fast path and cached polyphase resampler of eval.load_audio, on
+synthetic PCM16 uploads at typical sampling rates.
+
+Usage: python benchmarks/bench_audio_frontend.py --seconds 10 --channels 2
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import soundfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from eval import load_audio
+
+
+def time_it(fn, runs):
+    fn()
+    start = time.perf_counter()
+    for _ in range(runs):
+        out = fn()
+    return (time.perf_counter() - start) / runs * 1000, out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--rates', type=int, nargs='*',
+                        default=[16000, 22050, 24000, 44100, 48000])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        import librosa
+    except ImportError:
+        librosa = None
+    import_ms = (time.perf_counter() - start) * 1000
+    if librosa is None:
+        print('librosa is not installed, only the fast path is timed')
+    else:
+        print('import librosa: {:.1f} ms (not paid by the fast path)'.format(import_ms))
+
+    def librosa_path(path):
+        y, sr = librosa.load(path, sr=None, mono=True)
+        if sr != 24000:
+            y = librosa.resample(y, orig_sr=sr, target_sr=24000)
+        return y
+
+    print('{:>8} {:>14} {:>14} {:>9} {:>12}'.format(
+        'rate', 'librosa (ms)', 'fast (ms)', 'speedup', 'rel. diff'))
+    rs = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for sr in args.rates:
+            # speech-like: partials below 4 kHz with a slow envelope
+            num = int(args.seconds * sr)
+            t = np.arange(num) / sr
+            wav = np.zeros((num, args.channels))
+            for freq in rs.uniform(80, 4000, 24):
+                wav += np.sin(2 * np.pi * freq * t[:, None] + rs.uniform(0, 2 * np.pi,
+                                                                args.channels))
+            wav *= (0.02 + 0.02 * np.sin(2 * np.pi * 3 * t))[:, None]
+            path = os.path.join(tmp_dir, '{}.wav'.format(sr))
+            soundfile.write(path, wav, sr, subtype='PCM_16')
+
+            t_fast, y_fast = time_it(lambda: load_audio(path), args.runs)
+            if librosa is None:
+                print('{:>8} {:>14} {:>14.2f} {:>9} {:>12}'.format(
+                    sr, '-', t_fast, '-', '-'))
+                continue
+            t_ref, y_ref = time_it(lambda: librosa_path(path), args.runs)
+            num = min(len(y_ref), len(y_fast))
+            diff = np.sqrt(np.mean((y_ref[:num] - y_fast[:num]) ** 2)
+                           / np.mean(y_ref[:num] ** 2))
+            print('{:>8} {:>14.2f} {:>14.2f} {:>8.1f}x {:>12.2e}'.format(
+                sr, t_ref, t_fast, t_ref / t_fast, diff))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+bench_early_exit
+
+Compute saved by early-exit aggregation on a LibriSeVoc list, and the
+decisions it changes. LibriSeVoc utterances are mostly one or two 4 s
+segments long, so --concat joins that many consecutive utterances of the
+same subset into one recording to mimic multi-minute uploads.
+
+Usage: python benchmarks/bench_early_exit.py --model_path model_detection.pth \
+           --data_path /path/to/LibriSeVoc --list test.txt --limit 200 --concat 30
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from eval import load_audio
+from eval_tools import load_list, evaluate
+from model_service import DetectionEngine
+
+
+def group_items(items, concat):
+    """ Consecutive items of the same subset, concat at a time. """
+    groups = []
+    for start in range(0, len(items), concat):
+        chunk = items[start:start + concat]
+        # load_list keeps the items of one subset together
+        for label in sorted(set(item[1:] for item in chunk)):
+            paths = tuple(item[0] for item in chunk if item[1:] == label)
+            groups.append((paths,) + label)
+    return groups
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='model_detection.pth')
+    parser.add_argument('--config_path', type=str, default='model_config_RawNet.yaml')
+    parser.add_argument('--data_path', type=str, required=True)
+    parser.add_argument('--list', type=str, default='test.txt')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Only use the first N names of the list')
+    parser.add_argument('--concat', type=int, default=1,
+                        help='Utterances joined into one recording')
+    parser.add_argument('--deltas', type=float, nargs='*', default=[0.01, 0.05, 0.1])
+    parser.add_argument('--orders', type=str, nargs='*', default=['sequential', 'spread'])
+    parser.add_argument('--batch', type=int, default=4,
+                        help='Segments scored between two checks')
+    args = parser.parse_args()
+
+    items = group_items(load_list(args.data_path, args.list, args.limit), args.concat)
+    # decode up front, the comparison is about scoring
+    waveforms = {}
+    for paths, _, _ in items:
+        waveforms[paths] = np.concatenate([load_audio(path) for path in paths])
+    minutes = sum(len(w) for w in waveforms.values()) / 24000. / 60
+    print('{}: {} recordings, {:.1f} minutes of audio'.format(args.list, len(items), minutes))
+
+    def detect_fn(engine):
+        return lambda paths: engine.detect(waveforms[paths], sr=24000)
+
+    engine = DetectionEngine(model_path=args.model_path, config_path=args.config_path)
+    full = evaluate(detect_fn(engine), items)
+    print('{:>10} {:>6} {:>10} {:>11} {:>9} {:>10} {:>14}'.format(
+        'order', 'delta', 'accuracy', 'segments', 'compute', 'changed', 'ms/recording'))
+    print('{:>10} {:>6} {:>9.2f}% {:>11} {:>8.1f}% {:>10} {:>14.1f}'.format(
+        'all', '-', full['accuracy'], full['segments'], 100.0, 0, full['latency_ms']))
+
+    for order in args.orders:
+        for delta in args.deltas:
+            engine.early_exit_delta = delta
+            engine.segment_order = order
+            engine.early_exit_batch = args.batch
+            stats = evaluate(detect_fn(engine), items)
+            changed = np.sum((full['fake'] > 0.5) != (stats['fake'] > 0.5))
+            print('{:>10} {:>6} {:>9.2f}% {:>11} {:>8.1f}% {:>10} {:>14.1f}'.format(
+                order, delta, stats['accuracy'], stats['evaluated'],
+                100.0 * stats['evaluated'] / stats['segments'], changed,
+                stats['latency_ms']))
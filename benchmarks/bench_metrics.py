@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+bench_metrics
+
+Checks GET /metrics without a Prometheus server, and the cost of the
+instrumentation. A few uploads go through the Flask test client; the
+exposition is then parsed line by line (names, labels, values, cumulative
+buckets matching _count) and every stage of the detection path has to
+show up. The overhead is the mean latency of engine.detect with metrics
+recorded against ECHOWIPE_METRICS=0, on the same waveform.
+
+Usage: python benchmarks/bench_metrics.py --model_path model_detection.pth --runs 20
+"""
+import argparse
+import io
+import os
+import re
+import sys
+import time
+import wave
+
+import numpy as np
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"(,|$)')
+STAGES = ['upload', 'decode', 'resample', 'segment', 'forward', 'sinc_conv',
+          'gru', 'aggregate', 'detect']
+
+
+def parse(text):
+    """ {(name, labels): value} of a text exposition, failing on bad lines. """
+    samples = {}
+    types = {}
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ', 3)
+            types[name] = kind
+            continue
+        if not line or line.startswith('#'):
+            continue
+        match = SAMPLE.match(line)
+        if match is None:
+            raise SystemExit('Bad sample line: {}'.format(line))
+        labels = tuple((name, value) for name, value, _ in LABEL.findall(match.group(3) or ''))
+        samples[(match.group(1), labels)] = float(match.group(4))
+    for (name, labels), value in samples.items():
+        if name.endswith('_count') and types.get(name[:-6]) == 'histogram':
+            inf = samples[(name[:-6] + '_bucket', labels + (('le', '+Inf'),))]
+            if inf != value:
+                raise SystemExit('{} {} does not match its +Inf bucket'.format(name, labels))
+    return samples, types
+
+
+def wav_bytes(waveform, sr=24000):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f_wav:
+        f_wav.setnchannels(1)
+        f_wav.setsampwidth(2)
+        f_wav.setframerate(sr)
+        f_wav.writeframes((np.clip(waveform, -1, 1) * 32767).astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='model_detection.pth')
+    parser.add_argument('--config_path', type=str, default='model_config_RawNet.yaml')
+    parser.add_argument('--seconds', type=float, default=8, help='Duration of the uploads')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ.update(ECHOWIPE_MODEL_PATH=os.path.abspath(args.model_path),
+                      ECHOWIPE_MODEL_CONFIG=os.path.abspath(args.config_path),
+                      ECHOWIPE_CACHE_SIZE='0', ECHOWIPE_CACHE_DB='')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import metrics
+    from app import app
+    from model_service import get_engine
+
+    rng = np.random.RandomState(0)
+    waveform = (rng.randn(int(16000 * args.seconds)) * 0.1).astype(np.float32)
+    client = app.test_client()
+    for _ in range(3):
+        # 16 kHz, so that the resample stage runs
+        response = client.post('/api/detect', data={
+            'audio': (io.BytesIO(wav_bytes(waveform, 16000)), 'clip.wav')})
+        if response.status_code != 200:
+            raise SystemExit('/api/detect answered {}'.format(response.status_code))
+    response = client.get('/metrics')
+    samples, types = parse(response.get_data(as_text=True))
+    print('/metrics: {} samples of {} metrics, content type {}'.format(
+        len(samples), len(types), response.content_type))
+    print('{:>10} {:>8} {:>12}'.format('stage', 'count', 'mean (ms)'))
+    for stage in STAGES:
+        key = (('stage', stage),)
+        count = samples.get(('echowipe_stage_seconds_count', key))
+        if not count:
+            raise SystemExit('Stage {} was not recorded'.format(stage))
+        print('{:>10} {:>8.0f} {:>12.3f}'.format(
+            stage, count, 1000 * samples[('echowipe_stage_seconds_sum', key)] / count))
+    print('segments scored {:.0f}'.format(samples[('echowipe_segments_scored_total', ())]))
+
+    engine = get_engine()
+    waveform = waveform[:int(16000 * min(args.seconds, 4))]
+
+    def mean_ms():
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            engine.detect(waveform, sr=16000)
+        return 1000 * (time.perf_counter() - start) / args.runs
+
+    mean_ms()
+    timings = {True: [], False: []}
+    for _ in range(3):
+        for enabled in [True, False]:
+            metrics.METRICS = enabled
+            timings[enabled].append(mean_ms())
+    metrics.METRICS = True
+    on, off = min(timings[True]), min(timings[False])
+    start = time.perf_counter()
+    for _ in range(100000):
+        with metrics.timer('bench'):
+            pass
+    timer_us = 10 * (time.perf_counter() - start)
+    print('detect {:.2f} ms with metrics, {:.2f} ms without ({:+.2f}%), '
+          'one timer {:.2f} us'.format(on, off, 100 * (on - off) / off, timer_us))
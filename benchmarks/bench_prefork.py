@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+bench_prefork
+
+Memory per worker of a gunicorn-like pre-fork server, with the model
+loaded in each worker after fork (the default), in the master before fork
+(ECHOWIPE_PRELOAD=1, what gunicorn --preload does), and with the weights
+memory-mapped from the checkpoint (ECHOWIPE_MMAP_WEIGHTS=1).
+
+Each mode runs in a fresh master process that imports app.py and forks
+--workers workers; every worker scores a few uploads, then all of them
+are measured at the same time from /proc/<pid>/smaps_rollup (Linux):
+
+  rss      resident pages, shared ones included
+  pss      proportional set size, shared pages divided between sharers
+  private  pages only this worker maps, what an extra worker costs
+
+Usage: python benchmarks/bench_prefork.py --model_path model_detection.pth --workers 4
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MODES = [
+    ('per-worker', {}),
+    ('preload', {'ECHOWIPE_PRELOAD': '1'}),
+    ('mmap', {'ECHOWIPE_MMAP_WEIGHTS': '1'}),
+    ('preload+mmap', {'ECHOWIPE_PRELOAD': '1', 'ECHOWIPE_MMAP_WEIGHTS': '1'}),
+]
+
+
+def smaps_mb(pid):
+    """ rss, pss, private and shared memory of a process in MB. """
+    values = {}
+    with open('/proc/{}/smaps_rollup'.format(pid), 'r') as f_smaps:
+        for line in f_smaps:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1]) / 1024.
+    return {
+        'rss': values['Rss'],
+        'pss': values['Pss'],
+        'private': values['Private_Clean'] + values['Private_Dirty'],
+        'shared': values['Shared_Clean'] + values['Shared_Dirty'],
+    }
+
+
+def run_master(args):
+    # the environment of the mode is set by the parent, before this import
+    sys.path.insert(0, ROOT)
+    import numpy as np
+    import torch
+
+    import app  # noqa: F401, loads the model when ECHOWIPE_PRELOAD=1
+    from model_service import get_engine
+
+    ready_r, ready_w = os.pipe()
+    go_r, go_w = os.pipe()
+    pids = []
+    for _ in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            torch.set_num_threads(args.threads)
+            engine = get_engine()
+            waveform = np.random.RandomState(0).randn(24000 * 8).astype(np.float32)
+            for _ in range(args.requests):
+                engine.detect(waveform * 0.1, sr=24000)
+            os.write(ready_w, b'1')
+            os.read(go_r, 1)
+            os._exit(0)
+        pids.append(pid)
+
+    for _ in pids:
+        os.read(ready_r, 1)
+    # all workers alive and warm: shared pages are split between all of them
+    workers = [smaps_mb(pid) for pid in pids]
+    master = smaps_mb(os.getpid())
+    os.write(go_w, b'1' * len(pids))
+    for pid in pids:
+        os.waitpid(pid, 0)
+    print(json.dumps({'master': master, 'workers': workers}))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='model_detection.pth')
+    parser.add_argument('--config_path', type=str, default='model_config_RawNet.yaml')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=3,
+                        help='Uploads of 8 s scored by each worker before measuring')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='torch threads per worker')
+    parser.add_argument('--modes', type=str, nargs='*', default=[name for name, _ in MODES])
+    parser.add_argument('--master', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.master:
+        run_master(args)
+        sys.exit(0)
+
+    print('{} workers, {} requests each'.format(args.workers, args.requests))
+    print('{:>14} {:>12} {:>12} {:>12} {:>12} {:>14}'.format(
+        'mode', 'master rss', 'worker rss', 'worker pss', 'private', 'total pss'))
+    for name, extra_env in MODES:
+        if name not in args.modes:
+            continue
+        env = dict(os.environ, ECHOWIPE_MODEL_PATH=os.path.abspath(args.model_path),
+                   ECHOWIPE_MODEL_CONFIG=os.path.abspath(args.config_path),
+                   ECHOWIPE_CACHE_SIZE='0', ECHOWIPE_CACHE_DB='',
+                   ECHOWIPE_PRELOAD='0', ECHOWIPE_MMAP_WEIGHTS='0')
+        env.update(extra_env)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--master',
+             '--workers', str(args.workers), '--requests', str(args.requests),
+             '--threads', str(args.threads)],
+            env=env, cwd=ROOT, check=True, stdout=subprocess.PIPE).stdout
+        stats = json.loads(output.decode().strip().splitlines()[-1])
+        workers = stats['workers']
+
+        def mean(key):
+            return sum(w[key] for w in workers) / len(workers)
+
+        print('{:>14} {:>9.0f} MB {:>9.0f} MB {:>9.0f} MB {:>9.0f} MB {:>11.0f} MB'.format(
+            name, stats['master']['rss'], mean('rss'), mean('pss'), mean('private'),
+            stats['master']['pss'] + sum(w['pss'] for w in workers)))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+bench_replicas
+
+Sizing of the replica executor on the machine it runs on. --concurrency
+clients send 4 s segments back to back for --seconds, first to a single
+in-process engine (torch's default thread pool shared by every request),
+then to engines running on ReplicaPools of every replicas x threads
+combination that fits in the cores. Reports throughput, latency
+percentiles and memory, and recommends the configuration with the best
+throughput whose p99 stays within --p99_ms (the best throughput overall
+without it).
+
+Every configuration runs in a fresh process; its memory is the
+proportional set size (see bench_prefork) of that process, which holds
+the DetectionEngine, plus all of its replicas.
+
+Usage: python benchmarks/bench_replicas.py --model_path model_detection.pth \
+           --replicas 1 2 4 --threads 1 2 4 --concurrency 8 --pin
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bench_prefork import smaps_mb
+
+
+def load_test(forward, batch, concurrency, seconds):
+    """ Segments per second and latencies (ms) of closed-loop clients. """
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            forward(batch)
+            elapsed = 1000 * (time.perf_counter() - start)
+            with lock:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.perf_counter() - start
+    return len(latencies) * len(batch) / elapsed, np.array(latencies)
+
+
+def run_configuration(args):
+    """ Load test of one configuration, in this process. """
+    import torch
+    from model_service import DetectionEngine
+
+    batch = np.random.RandomState(0).randn(args.batch, 96000).astype(np.float32) * 0.1
+    engine = DetectionEngine(model_path=args.model_path, config_path=args.config_path,
+                             device='cpu', max_batch_size=None, mmap=args.mmap,
+                             replicas=args.run[0], replica_threads=args.run[1],
+                             replica_cpus='auto' if args.pin else None)
+    # one warm-up batch per replica, sent at once so that each replica
+    # gets one
+    warmup = [threading.Thread(target=engine.forward, args=(batch,))
+              for _ in range(max(args.run[0], 1))]
+    for w in warmup:
+        w.start()
+    for w in warmup:
+        w.join()
+    throughput, latencies = load_test(engine.forward, batch, args.concurrency, args.seconds)
+    pids = [os.getpid()]
+    if engine.pool is not None:
+        pids += [process.pid for process in engine.pool._processes]
+    print(json.dumps({
+        'throughput': throughput,
+        'p50': float(np.percentile(latencies, 50)),
+        'p99': float(np.percentile(latencies, 99)),
+        'max': float(latencies.max()),
+        'pss': sum(smaps_mb(pid)['pss'] for pid in pids),
+        'threads': torch.get_num_threads(),
+    }))
+    if engine.pool is not None:
+        engine.pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='model_detection.pth')
+    parser.add_argument('--config_path', type=str, default='model_config_RawNet.yaml')
+    parser.add_argument('--replicas', type=int, nargs='*', default=[1, 2, 4, 8])
+    parser.add_argument('--threads', type=int, nargs='*', default=[1, 2, 4])
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='Concurrent clients, default twice the cores')
+    parser.add_argument('--batch', type=int, default=1, help='Segments per request')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--pin', action='store_true', help='Pin replicas to disjoint cores')
+    parser.add_argument('--mmap', action='store_true', help='Share the weights through a mapped checkpoint')
+    parser.add_argument('--p99_ms', type=float, default=None, help='Latency budget of the recommendation')
+    parser.add_argument('--run', type=int, nargs=2, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    cores = len(os.sched_getaffinity(0))
+    args.concurrency = args.concurrency or 2 * cores
+    if args.run is not None:
+        run_configuration(args)
+        sys.exit(0)
+
+    print('{} cores, {} clients, {} segment(s) per request, {:.0f} s per configuration'.format(
+        cores, args.concurrency, args.batch, args.seconds))
+    print('{:>22} {:>12} {:>10} {:>10} {:>10} {:>10}'.format(
+        'configuration', 'segments/s', 'p50 (ms)', 'p99 (ms)', 'max (ms)', 'pss (MB)'))
+
+    def measure(replicas, threads):
+        command = [sys.executable, os.path.abspath(__file__), '--run', str(replicas), str(threads),
+                   '--model_path', args.model_path, '--config_path', args.config_path,
+                   '--concurrency', str(args.concurrency), '--batch', str(args.batch),
+                   '--seconds', str(args.seconds)]
+        command += ['--pin'] * args.pin + ['--mmap'] * args.mmap
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+        stats = json.loads(output.decode().strip().splitlines()[-1])
+        name = '{} x {} thread(s)'.format(replicas, threads) if replicas \
+            else 'in-process, {} threads'.format(stats['threads'])
+        print('{:>22} {:>12.2f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.0f}'.format(
+            name, stats['throughput'], stats['p50'], stats['p99'], stats['max'], stats['pss']))
+        return stats
+
+    measure(0, 0)
+    results = []
+    for replicas in args.replicas:
+        for threads in args.threads:
+            if replicas * threads > cores:
+                continue
+            stats = measure(replicas, threads)
+            results.append((replicas, threads, stats['throughput'], stats['p99'], stats['pss']))
+
+    if not results:
+        raise SystemExit('No configuration fits in {} cores'.format(cores))
+    within = [r for r in results if args.p99_ms is None or r[3] <= args.p99_ms]
+    if not within:
+        print('No configuration meets p99 <= {} ms, picking the lowest p99'.format(args.p99_ms))
+        best = min(results, key=lambda r: r[3])
+    else:
+        best = max(within, key=lambda r: (r[2], -r[3]))
+    print('Recommended: ECHOWIPE_REPLICAS={} ECHOWIPE_REPLICA_THREADS={}{}'
+          '  ({:.2f} segments/s, p99 {:.1f} ms, {:.0f} MB)'.format(
+              best[0], best[1], ' ECHOWIPE_REPLICA_CPUS=auto' if args.pin else '',
+              best[2], best[3], best[4]))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+bench_sincconv
+
+Micro-benchmark of the SincConv front end: forward latency of the cached
+filter bank against the original per-call filter construction, and of the
+overlap-save FFT path against direct conv1d. Outputs of all paths are
+checked against each other and the script fails if they diverge.
+
+Usage: python benchmarks/bench_sincconv.py --batch_size 1 --runs 20
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from model import SincConv
+
+
+def legacy_forward(conv, x):
+    """ SincConv.forward as it was: filters rebuilt on every call """
+    hsupp = torch.arange(-(conv.kernel_size-1)/2, (conv.kernel_size-1)/2+1)
+    band_pass = torch.zeros(conv.out_channels, conv.kernel_size)
+    for i in range(len(conv.mel)-1):
+        fmin = conv.mel[i]
+        fmax = conv.mel[i+1]
+        hHigh = (2*fmax/conv.sample_rate)*np.sinc(2*fmax*hsupp/conv.sample_rate)
+        hLow = (2*fmin/conv.sample_rate)*np.sinc(2*fmin*hsupp/conv.sample_rate)
+        hideal = hHigh-hLow
+        band_pass[i, :] = Tensor(np.hamming(conv.kernel_size))*Tensor(hideal)
+    filters = band_pass.to(x.device).view(conv.out_channels, 1, conv.kernel_size)
+    return F.conv1d(x, filters, stride=conv.stride, padding=conv.padding,
+                    dilation=conv.dilation, bias=None, groups=1)
+
+
+def time_it(fn, runs):
+    fn()
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - start) / runs * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--length', type=int, default=96000)
+    parser.add_argument('--out_channels', type=int, default=20)
+    parser.add_argument('--kernel_size', type=int, default=1024)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    conv = SincConv(device='cpu', out_channels=args.out_channels,
+                    kernel_size=args.kernel_size)
+    x = torch.randn(args.batch_size, 1, args.length)
+
+    def run(mode):
+        conv.conv_mode = mode
+        return conv(x)
+
+    with torch.no_grad():
+        reference = legacy_forward(conv, x)
+        diff_direct = (run('direct') - reference).abs().max().item()
+        diff_fft = (run('fft') - reference).abs().max().item()
+        t_legacy = time_it(lambda: legacy_forward(conv, x), args.runs)
+        t_direct = time_it(lambda: run('direct'), args.runs)
+        t_fft = time_it(lambda: run('fft'), args.runs)
+        conv.conv_mode = 'auto'
+        auto_mode = 'fft' if conv.use_fft(x) else 'direct'
+
+    print('input: ({}, 1, {}), {} filters x {} taps'.format(
+        args.batch_size, args.length, args.out_channels, conv.kernel_size))
+    print('max abs diff, direct   : {:.3e}'.format(diff_direct))
+    print('max abs diff, fft      : {:.3e}'.format(diff_fft))
+    print('rebuilt filters   (ms) : {:.3f}'.format(t_legacy))
+    print('cached, direct    (ms) : {:.3f}'.format(t_direct))
+    print('cached, fft       (ms) : {:.3f}'.format(t_fft))
+    print('speedup direct/fft     : {:.2f}x / {:.2f}x'.format(
+        t_legacy / t_direct, t_legacy / t_fft))
+    print('auto mode selects      : {}'.format(auto_mode))
+    if max(diff_direct, diff_fft) > args.tolerance:
+        sys.exit('SincConv outputs differ by more than {}'.format(args.tolerance))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+bench_user_store
+
+Cost of a login lookup and of a signup as the number of users grows, for
+the old users.json store (load the whole file, rewrite it on signup) and
+for user_store.UserStore. Stores are filled with --sizes synthetic users
+in a temporary directory; password hashes are fixed strings, the werkzeug
+hashing itself is the same for both and left out.
+
+Usage: python benchmarks/bench_user_store.py --sizes 100 10000 100000 --runs 200
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from user_store import UserStore
+
+PASSWORD = 'scrypt:32768:8:1$' + 'x' * 16 + '$' + 'f' * 128
+
+
+def user(idx):
+    return {'first': 'First{}'.format(idx), 'last': 'Last{}'.format(idx),
+            'password': PASSWORD, 'created': '01-01-2026 10:00'}
+
+
+def mean_us(fn, runs):
+    start = time.perf_counter()
+    for idx in range(runs):
+        fn(idx)
+    return 1e6 * (time.perf_counter() - start) / runs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='*', default=[100, 10000, 100000])
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+
+    print('{:>10} {:>16} {:>16} {:>16} {:>16}'.format(
+        'users', 'json login (us)', 'json signup (us)', 'sqlite login (us)',
+        'sqlite signup (us)'))
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            users = {'user{}@example.com'.format(idx): user(idx) for idx in range(size)}
+            json_path = os.path.join(tmp, 'users.json')
+            with open(json_path, 'w') as f_json:
+                json.dump(users, f_json, indent=4)
+
+            def json_login(idx):
+                with open(json_path, 'r') as f_json:
+                    loaded = json.load(f_json)
+                return loaded.get('user{}@example.com'.format(idx % size))
+
+            def json_signup(idx):
+                with open(json_path, 'r') as f_json:
+                    loaded = json.load(f_json)
+                loaded['new{}@example.com'.format(idx)] = user(idx)
+                with open(json_path, 'w') as f_json:
+                    json.dump(loaded, f_json, indent=4)
+
+            # the JSON store costs O(users) per call, fewer runs are enough
+            json_runs = max(min(args.runs, 2000000 // size), 3)
+            login_json = mean_us(json_login, json_runs)
+            signup_json = mean_us(json_signup, json_runs)
+
+            store = UserStore(os.path.join(tmp, 'users.db'), json_path=json_path)
+            if store.count() != size + json_runs:
+                raise SystemExit('Imported {} users out of {}'.format(
+                    store.count(), size + json_runs))
+            login_sqlite = mean_us(
+                lambda idx: store.get('user{}@example.com'.format(idx % size)), args.runs)
+            signup_sqlite = mean_us(
+                lambda idx: store.create('signup{}@example.com'.format(idx), PASSWORD),
+                args.runs)
+            if store.create('user0@example.com', PASSWORD):
+                raise SystemExit('Duplicate email accepted')
+            print('{:>10} {:>16.1f} {:>16.1f} {:>16.1f} {:>16.1f}'.format(
+                size, login_json, signup_json, login_sqlite, signup_sqlite))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+bench_variable_length
+
+Compute saved by scoring short clips at their own length, against
+repeat-padding every clip to 96000 samples (eval.pad). Traffic is one
+clip per utterance of a LibriSeVoc list, cropped to a random duration
+(log-uniform between --min_seconds and --max_seconds, so short clips
+dominate); without --data_path the clips are noise and only the compute
+is compared.
+
+Variable-length batches are built like the micro-batcher does: length
+buckets of --bucket_size samples, zero-padded to the longest clip of the
+batch and masked. The script fails if a masked batch does not give the
+outputs of scoring its clips one by one, unpadded.
+
+Usage: python benchmarks/bench_variable_length.py --model_path model_detection.pth \
+           --data_path /path/to/LibriSeVoc --list test.txt --limit 200
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from batch_scheduler import length_buckets, pad_batch
+from eval import load_audio, pad
+from eval_tools import load_list
+from model_service import DetectionEngine
+
+WINDOW = 96000
+
+
+def run(engine, batches):
+    """ Fake probability of every clip, wall time and samples processed. """
+    fake = {}
+    samples = 0
+    start = time.perf_counter()
+    for rows, batch, lengths in batches:
+        probs_binary, _ = engine.forward(batch, lengths)
+        fake.update(zip(rows, probs_binary[:, 0]))
+        samples += batch.size
+    seconds = time.perf_counter() - start
+    return np.array([fake[row] for row in range(len(fake))]), seconds, samples
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='model_detection.pth')
+    parser.add_argument('--config_path', type=str, default='model_config_RawNet.yaml')
+    parser.add_argument('--data_path', type=str, default=None)
+    parser.add_argument('--list', type=str, default='test.txt')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Only use the first N names of the list')
+    parser.add_argument('--num_clips', type=int, default=200,
+                        help='Number of noise clips without --data_path')
+    parser.add_argument('--min_seconds', type=float, default=0.25)
+    parser.add_argument('--max_seconds', type=float, default=4.0)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--bucket_size', type=int, default=24000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    if args.data_path is not None:
+        items = load_list(args.data_path, args.list, args.limit)
+        waveforms = [load_audio(path) for path, _, _ in items]
+        is_real = np.array([binary_label == 1 for _, _, binary_label in items])
+    else:
+        waveforms = [rng.randn(int(24000 * args.max_seconds)).astype(np.float32) * 0.1
+                     for _ in range(args.num_clips)]
+        is_real = None
+    seconds = np.exp(rng.uniform(np.log(args.min_seconds), np.log(args.max_seconds),
+                                 len(waveforms)))
+    clips = []
+    for waveform, duration in zip(waveforms, seconds):
+        length = min(int(24000 * duration), len(waveform))
+        start = rng.randint(0, len(waveform) - length + 1)
+        clips.append(waveform[start:start + length])
+
+    engine = DetectionEngine(model_path=args.model_path, config_path=args.config_path,
+                             variable_length=True)
+    min_len = engine.min_len
+    print('{} clips, {:.2f} s mean, {:.0f}% shorter than 1 s'.format(
+        len(clips), np.mean([len(c) for c in clips]) / 24000.,
+        100.0 * np.mean([len(c) < 24000 for c in clips])))
+
+    padded = [pad(clip, WINDOW) for clip in clips]
+    repeat_batches = []
+    for start in range(0, len(padded), args.batch_size):
+        rows = list(range(start, min(start + args.batch_size, len(padded))))
+        repeat_batches.append((rows, np.stack([padded[row] for row in rows]), None))
+    # clips shorter than one GRU frame are repeat-padded to min_len
+    short = [pad(clip, max(len(clip), min_len)) for clip in clips]
+    variable_batches = []
+    for bucket in length_buckets([len(clip) for clip in short], args.bucket_size):
+        for start in range(0, len(bucket), args.batch_size):
+            rows = bucket[start:start + args.batch_size]
+            batch, lengths = pad_batch([short[row] for row in rows])
+            variable_batches.append((rows, batch, lengths))
+
+    # parity of the masked batches against unpadded clips, one by one
+    rows, batch, lengths = max(variable_batches, key=lambda b: np.ptp(b[2]))
+    masked, _ = engine.forward(batch, lengths)
+    single = np.concatenate([engine.forward(short[row][None])[0] for row in rows])
+    error = float(np.abs(masked - single).max())
+    print('masked batch of {} clips ({} to {} samples) vs one by one: max error {:.2e}'.format(
+        len(rows), lengths.min(), lengths.max(), error))
+    if error > args.tolerance:
+        raise SystemExit('Masked batch does not match unpadded scoring')
+
+    # warm-up
+    engine.forward(*variable_batches[0][1:])
+    fake_repeat, time_repeat, samples_repeat = run(engine, repeat_batches)
+    fake_variable, time_variable, samples_variable = run(engine, variable_batches)
+
+    print('{:>16} {:>10} {:>14} {:>12} {:>10}'.format(
+        'padding', 'seconds', 'samples (M)', 'ms/clip', 'accuracy'))
+    for name, fake, elapsed, samples in [
+            ('repeat to 4 s', fake_repeat, time_repeat, samples_repeat),
+            ('masked buckets', fake_variable, time_variable, samples_variable)]:
+        accuracy = '-' if is_real is None else \
+            '{:.2f}%'.format(100.0 * np.mean((fake <= 0.5) == is_real))
+        print('{:>16} {:>10.2f} {:>14.1f} {:>12.1f} {:>10}'.format(
+            name, elapsed, samples / 1e6, 1000 * elapsed / len(clips), accuracy))
+    print('speedup {:.2f}x, samples processed {:.1f}%, mean |fake delta| {:.4f}, '
+          'decisions changed {}'.format(
+              time_repeat / time_variable, 100.0 * samples_variable / samples_repeat,
+              float(np.mean(np.abs(fake_variable - fake_repeat))),
+              int(np.sum((fake_variable > 0.5) != (fake_repeat > 0.5)))))
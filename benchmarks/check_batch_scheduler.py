@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+check_batch_scheduler
+
+Several BatchScheduler workers scattering batches of the same requests at
+once: a slow forward_fn keeps --workers batches in flight, every request
+spans several of them, and every future has to resolve (within --timeout
+seconds) to the rows of its own segments, in order.
+
+Usage: python benchmarks/check_batch_scheduler.py --workers 4 --requests 200
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from batch_scheduler import BatchScheduler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--segments', type=int, default=7, help='Segments per request')
+    parser.add_argument('--max_batch_size', type=int, default=3)
+    parser.add_argument('--delay_ms', type=float, default=2)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    def slow_forward(batch):
+        # releases the GIL, so the workers finish their batches together
+        time.sleep(args.delay_ms / 1000.)
+        ids = batch[:, 0]
+        return (np.stack([ids, -ids], axis=1),
+                np.repeat(ids[:, None], 7, axis=1))
+
+    scheduler = BatchScheduler(slow_forward, args.max_batch_size, max_wait_ms=1,
+                               num_workers=args.workers)
+    futures = []
+    lock = threading.Lock()
+
+    def client(first):
+        for request in range(first, args.requests, 8):
+            ids = request * 1000 + np.arange(args.segments, dtype=np.float32)
+            future = scheduler.submit(np.repeat(ids[:, None], 16, axis=1))
+            with lock:
+                futures.append((ids, future))
+
+    clients = [threading.Thread(target=client, args=(first,)) for first in range(8)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+
+    deadline = time.monotonic() + args.timeout
+    for ids, future in futures:
+        probs_binary, _ = future.result(timeout=max(deadline - time.monotonic(), 0.01))
+        if not np.array_equal(probs_binary[:, 0], ids):
+            raise SystemExit('Request {} got the rows of other segments'.format(int(ids[0]) // 1000))
+    scheduler.close()
+    print('{} requests of {} segments resolved through {} workers'.format(
+        len(futures), args.segments, args.workers))
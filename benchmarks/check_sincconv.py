@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+check_sincconv
+
+Numerical equivalence of the two SincConv paths: the overlap-save FFT
+convolution against direct conv1d, on random input of several batch
+sizes, lengths (one FFT block, many blocks, a partial last block),
+kernel sizes and paddings. No timing; fails when any output differs by
+more than --atol (plus --rtol of the direct output).
+
+Usage: python benchmarks/check_sincconv.py --atol 1e-5
+"""
+import argparse
+import itertools
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from model import SincConv
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--atol', type=float, default=1e-5)
+    parser.add_argument('--rtol', type=float, default=1e-5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    failures = 0
+    print('{:>6} {:>8} {:>8} {:>8} {:>12}'.format('batch', 'length', 'kernel', 'padding', 'max diff'))
+    for batch, length, kernel_size, padding in itertools.product(
+            [1, 3], [4096, 24011, 96000], [129, 1024], [0, 64]):
+        conv = SincConv(device='cpu', out_channels=20, kernel_size=kernel_size, padding=padding)
+        x = torch.randn(batch, 1, length)
+        with torch.no_grad():
+            conv.conv_mode = 'direct'
+            direct = conv(x)
+            conv.conv_mode = 'fft'
+            fft = conv(x)
+        diff = (fft - direct).abs().max().item()
+        ok = fft.shape == direct.shape and torch.allclose(fft, direct, atol=args.atol, rtol=args.rtol)
+        failures += not ok
+        print('{:>6} {:>8} {:>8} {:>8} {:>12.2e}{}'.format(
+            batch, length, conv.kernel_size, padding, diff, '' if ok else '  FAIL'))
+    if failures:
+        raise SystemExit('{} configurations differ beyond atol={} rtol={}'.format(
+            failures, args.atol, args.rtol))
+    print('FFT and direct SincConv outputs match')
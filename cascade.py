@@ -0,0 +1,213 @@
+"""
+cascade
+
+Two-stage detection: a small screener RawNet (model_config_RawNet_small.yaml,
+trained with main.py --model_config) scores every upload, and only the
+uploads whose screener "fake" probability falls inside the uncertainty
+band [low, high] are escalated to the full RawNet.
+
+The band is calibrated on dev.txt: the narrowest band whose cascade
+accuracy stays within --max_drop points of the full model.
+
+Usage:
+  python cascade.py --screener_path screener.pth --model_path model_detection.pth \
+      --data_path /path/to/LibriSeVoc --calib_list dev.txt --eval_list test.txt
+"""
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+
+from eval import load_audio, resample
+
+# "low,high" band of screener fake probabilities escalated to the full model
+CASCADE_BAND = os.environ.get("ECHOWIPE_CASCADE_BAND", "0.1,0.9")
+
+
+def parse_band(text):
+    low, high = [float(value) for value in text.split(",")]
+    if not 0 <= low <= 0.5 <= high <= 1:
+        raise ValueError("Cascade band should satisfy 0 <= low <= 0.5 <= high <= 1")
+    return low, high
+
+
+class CascadeEngine:
+    """
+    cascade = CascadeEngine(screener, full, band=(0.1, 0.9))
+
+    screener, full: DetectionEngine
+    band: (low, high), screener fake probabilities escalated to full
+
+    detect() has the interface of DetectionEngine.detect; its result also
+    holds the "stage" that decided ("screener" or "full") and the
+    "screener_fake" probability. Streaming goes to the full model.
+    """
+
+    def __init__(self, screener, full, band=(0.1, 0.9)):
+        self.screener = screener
+        self.full = full
+        self.band = band
+        self.device = full.device
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "escalated": 0,
+                       "screener_seconds": 0.0, "full_seconds": 0.0}
+
+    @property
+    def model(self):
+        # loaded lazily by a full model running on replicas
+        return self.full.model
+
+    def detect(self, audio, sr=None, progress=None):
+        # decode and resample once for both stages
+        if isinstance(audio, (str, os.PathLike)):
+            waveform = load_audio(audio)
+        else:
+            waveform = resample(np.asarray(audio, dtype=np.float32), sr)
+
+        start = time.perf_counter()
+        screened = self.screener.detect(waveform, sr=24000)
+        screener_seconds = time.perf_counter() - start
+        escalate = self.band[0] <= screened["fake"] <= self.band[1]
+        if escalate:
+            start = time.perf_counter()
+            result = dict(self.full.detect(waveform, sr=24000, progress=progress),
+                          stage="full")
+            full_seconds = time.perf_counter() - start
+        else:
+            result = dict(screened, stage="screener")
+            full_seconds = 0.0
+        result["screener_fake"] = screened["fake"]
+
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["escalated"] += int(escalate)
+            self._stats["screener_seconds"] += screener_seconds
+            self._stats["full_seconds"] += full_seconds
+        return result
+
+    def score(self, segments):
+        return self.full.score(segments)
+
+    def stats(self):
+        """ Counters since start: requests, escalated, escalation_rate, seconds per stage. """
+        with self._lock:
+            stats = dict(self._stats)
+        stats["escalation_rate"] = stats["escalated"] / float(max(stats["requests"], 1))
+        return stats
+
+
+def calibrate_band(screener_fake, full_fake, binary_labels, max_drop=0.5,
+                   grid=101):
+    """
+    (low, high), stats = calibrate_band(screener_fake, full_fake,
+                                        binary_labels, max_drop=0.5)
+
+    screener_fake, full_fake: per-file fake probabilities of both models
+    binary_labels: 1 for real, 0 for fake (as in main.py)
+    max_drop: largest accepted accuracy loss against full, in points
+
+    Picks the band escalating the fewest files; candidate bounds are
+    quantiles of the screener scores on either side of 0.5.
+    """
+    screener_fake = np.asarray(screener_fake, dtype=np.float64)
+    is_real = np.asarray(binary_labels) == 1
+    wrong_screener = (screener_fake <= 0.5) != is_real
+    wrong_full = (np.asarray(full_fake) <= 0.5) != is_real
+    num = len(screener_fake)
+
+    order = np.argsort(screener_fake, kind='stable')
+    scores = screener_fake[order]
+    # errors saved by escalating the files of a band, as prefix sums
+    gain = np.concatenate([[0], np.cumsum(
+        wrong_screener[order].astype(int) - wrong_full[order].astype(int))])
+
+    lows = np.unique(np.concatenate([[0.5], np.quantile(
+        scores[scores <= 0.5], np.linspace(0, 1, grid))])) \
+        if np.any(scores <= 0.5) else np.array([0.5])
+    highs = np.unique(np.concatenate([[0.5], np.quantile(
+        scores[scores >= 0.5], np.linspace(0, 1, grid))])) \
+        if np.any(scores >= 0.5) else np.array([0.5])
+    # files with low <= score <= high are order[start:stop]
+    starts = np.searchsorted(scores, lows, side='left')[:, None]
+    stops = np.searchsorted(scores, highs, side='right')[None, :]
+
+    errors = wrong_screener.sum() - (gain[stops] - gain[starts])
+    escalated = stops - starts
+    accuracy = 100.0 * (1 - errors / float(num))
+    full_accuracy = 100.0 * (1 - wrong_full.sum() / float(num))
+    feasible = accuracy >= full_accuracy - max_drop
+    # the whole range always escalates everything, so feasible is not empty
+    cost = np.where(feasible, escalated, num + 1)
+    i, j = np.unravel_index(np.argmin(cost - 1e-6 * accuracy), cost.shape)
+    band = (float(lows[i]), float(highs[j]))
+    return band, cascade_stats(screener_fake, full_fake, binary_labels, band)
+
+
+def cascade_stats(screener_fake, full_fake, binary_labels, band):
+    """ Accuracy of each stage and of the cascade, escalation rate. """
+    screener_fake = np.asarray(screener_fake)
+    full_fake = np.asarray(full_fake)
+    is_real = np.asarray(binary_labels) == 1
+    escalate = (screener_fake >= band[0]) & (screener_fake <= band[1])
+    cascade_fake = np.where(escalate, full_fake, screener_fake)
+
+    def accuracy(fake):
+        return 100.0 * float(np.mean((fake <= 0.5) == is_real))
+
+    return {
+        "screener_accuracy": accuracy(screener_fake),
+        "full_accuracy": accuracy(full_fake),
+        "cascade_accuracy": accuracy(cascade_fake),
+        "escalation_rate": float(np.mean(escalate)),
+        "decisions_changed": int(np.sum((cascade_fake > 0.5) != (full_fake > 0.5))),
+    }
+
+
+if __name__ == '__main__':
+    from eval_tools import load_list, evaluate
+    from model_service import DetectionEngine
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='model_detection.pth')
+    parser.add_argument('--config_path', type=str, default='model_config_RawNet.yaml')
+    parser.add_argument('--screener_path', type=str, default='model_screener.pth')
+    parser.add_argument('--screener_config', type=str, default='model_config_RawNet_small.yaml')
+    parser.add_argument('--data_path', type=str, required=True)
+    parser.add_argument('--calib_list', type=str, default='dev.txt')
+    parser.add_argument('--eval_list', type=str, default='test.txt')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Only use the first N names of each list')
+    parser.add_argument('--max_drop', type=float, default=0.5,
+                        help='Accuracy loss against the full model accepted on the calibration list, in points')
+    args = parser.parse_args()
+
+    screener = DetectionEngine(model_path=args.screener_path, config_path=args.screener_config)
+    full = DetectionEngine(model_path=args.model_path, config_path=args.config_path)
+
+    def run(list_path):
+        items = load_list(args.data_path, list_path, args.limit)
+        stats_screener = evaluate(screener.detect, items)
+        stats_full = evaluate(full.detect, items)
+        labels = np.array([binary_label for _, _, binary_label in items])
+        return stats_screener, stats_full, labels
+
+    calib_screener, calib_full, calib_labels = run(args.calib_list)
+    band, stats = calibrate_band(calib_screener['fake'], calib_full['fake'],
+                                 calib_labels, args.max_drop)
+    print('Calibrated band on {}: {:.4f},{:.4f}  (ECHOWIPE_CASCADE_BAND={:.4f},{:.4f})'.format(
+        args.calib_list, band[0], band[1], band[0], band[1]))
+
+    for list_path, (stats_screener, stats_full, labels) in [
+            (args.calib_list, (calib_screener, calib_full, calib_labels)),
+            (args.eval_list, run(args.eval_list))]:
+        stats = cascade_stats(stats_screener['fake'], stats_full['fake'], labels, band)
+        latency = stats_screener['latency_ms'] + stats['escalation_rate'] * stats_full['latency_ms']
+        print('{}: {} files, accuracy screener {:.2f}% full {:.2f}% cascade {:.2f}%, '
+              'escalated {:.1f}%, decisions changed {}, '
+              'latency/file screener {:.1f} ms full {:.1f} ms cascade {:.1f} ms'.format(
+                  list_path, stats_full['files'], stats['screener_accuracy'],
+                  stats['full_accuracy'], stats['cascade_accuracy'],
+                  100 * stats['escalation_rate'], stats['decisions_changed'],
+                  stats_screener['latency_ms'], stats_full['latency_ms'], latency))
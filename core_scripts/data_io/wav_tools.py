@@ -16,8 +16,11 @@ from __future__ import absolute_import
 
 import os
 import sys
+import fractions
+import functools
 import numpy as np
 import scipy.io.wavfile
+import scipy.signal
 import soundfile
 import core_scripts.data_io.io_tools as nii_io_tk
 
@@ -174,6 +177,194 @@ def flacReadAsFloat(wavFileIn):
     return sr, x
 
 
+# WAVE format tags
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+def wavHeaderRead(stream):
+    """ fmt, data_size = wavHeaderRead(stream)
+    Parse the RIFF/WAVE header from a binary stream, leaving the stream at
+    the first byte of the data chunk.
+
+    Args:
+        stream: binary file-like object positioned at the start of the file
+    Return:
+        fmt: dict with format_tag, channels, sr, block_align, bits
+        data_size: size of the data chunk in bytes, None if the writer left
+                   it open (0 or 0xFFFFFFFF), i.e. data runs to the end
+    Raise:
+        ValueError if the stream is not a supported WAVE file
+    """
+    riff = stream.read(12)
+    if len(riff) < 12 or riff[0:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise ValueError("Not a RIFF/WAVE stream")
+    fmt = None
+    while True:
+        chunk = stream.read(8)
+        if len(chunk) < 8:
+            raise ValueError("WAVE stream has no data chunk")
+        chunk_id = chunk[0:4]
+        chunk_size = int.from_bytes(chunk[4:8], 'little')
+        if chunk_id == b'data':
+            if fmt is None:
+                raise ValueError("WAVE data chunk before fmt chunk")
+            if chunk_size in (0, 0xFFFFFFFF):
+                chunk_size = None
+            return fmt, chunk_size
+        body = stream.read(chunk_size + (chunk_size & 1))
+        if chunk_id == b'fmt ':
+            if len(body) < 16:
+                raise ValueError("Truncated WAVE fmt chunk")
+            format_tag = int.from_bytes(body[0:2], 'little')
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                # first two bytes of the sub-format GUID hold the real tag
+                format_tag = int.from_bytes(body[24:26], 'little')
+            fmt = {'format_tag': format_tag,
+                   'channels': int.from_bytes(body[2:4], 'little'),
+                   'sr': int.from_bytes(body[4:8], 'little'),
+                   'block_align': int.from_bytes(body[12:14], 'little'),
+                   'bits': int.from_bytes(body[14:16], 'little')}
+
+def wavDataToFloat(data, fmt):
+    """ wavData = wavDataToFloat(data, fmt)
+    Convert the raw bytes of a WAVE data chunk into a mono float waveform.
+
+    Args:
+        data: bytes-like object, data chunk (trailing partial frame ignored)
+        fmt: dict returned by wavHeaderRead
+    Return:
+        wavData: np.float32, (length, ) in (-1, 1), channels averaged
+    """
+    channels = fmt['channels']
+    bits = fmt['bits']
+    tag = fmt['format_tag']
+    if channels < 1:
+        raise ValueError("WAVE stream has no channel")
+    frame_bytes = channels * bits // 8
+    num_frames = len(data) // frame_bytes if frame_bytes else 0
+
+    if tag == WAVE_FORMAT_IEEE_FLOAT and bits in (32, 64):
+        dtype, scale = ('<f4' if bits == 32 else '<f8'), 1.0
+    elif tag == WAVE_FORMAT_PCM and bits == 8:
+        dtype, scale = np.uint8, 1.0 / 128
+    elif tag == WAVE_FORMAT_PCM and bits == 16:
+        dtype, scale = '<i2', 1.0 / np.power(2.0, 15)
+    elif tag == WAVE_FORMAT_PCM and bits == 32:
+        dtype, scale = '<i4', 1.0 / np.power(2.0, 31)
+    elif tag == WAVE_FORMAT_PCM and bits == 24:
+        # three bytes per sample: shift into the top of an int32
+        raw = np.frombuffer(data, dtype=np.uint8, count=num_frames * frame_bytes)
+        raw = raw.reshape(-1, 3).astype(np.int32)
+        samples = (raw[:, 0] << 8) | (raw[:, 1] << 16) | (raw[:, 2] << 24)
+        return _downmix(samples.reshape(num_frames, channels),
+                        1.0 / np.power(2.0, 31))
+    else:
+        raise ValueError("Unsupported WAVE encoding: tag %d, %d bits" % (
+            tag, bits))
+
+    samples = np.frombuffer(data, dtype=dtype, count=num_frames * channels)
+    samples = samples.reshape(num_frames, channels)
+    if dtype is np.uint8:
+        samples = samples.astype(np.float32) - 128
+    return _downmix(samples, scale)
+
+def _downmix(samples, scale):
+    # one float32 buffer: cast the first channel, add the others into it in
+    # place, then apply scale and 1/channels in a single multiply
+    channels = samples.shape[1]
+    wav = samples[:, 0].astype(np.float32)
+    for idx in range(1, channels):
+        wav += samples[:, idx]
+    scale = scale / channels
+    if scale != 1.0:
+        wav *= np.float32(scale)
+    return wav
+
+def waveReadFromStream(stream):
+    """ sr, wavData = waveReadFromStream(stream)
+    Decode a WAVE byte stream (PCM 8/16/24/32 bit or 32/64 bit float)
+    without going through a file on disk.
+
+    Args:
+        stream: binary file-like object positioned at the start of the file
+    Return:
+        sr: sampling_rate
+        wavData: waveform in np.float32 (-1, 1), channels averaged
+    """
+    fmt, data_size = wavHeaderRead(stream)
+    if hasattr(stream, 'getbuffer'):
+        # in-memory stream: view the data chunk, no copy
+        start = stream.tell()
+        buf = stream.getbuffer()
+        end = len(buf) if data_size is None else min(len(buf), start + data_size)
+        data = buf[start:end]
+        stream.seek(end)
+    else:
+        data = stream.read(-1 if data_size is None else data_size)
+    return fmt['sr'], wavDataToFloat(data, fmt)
+
+
+def waveReadFast(wavFileIn):
+    """ sr, wavData = waveReadFast(wavFileIn)
+    Read a WAVE file by parsing its header and loading the data chunk with
+    a single np.fromfile, without going through librosa / soundfile.
+
+    Supports the encodings of wavDataToFloat; raises ValueError for other
+    files so that callers can fall back to a generic decoder.
+    Return:
+        sr: sampling_rate
+        wavData: waveform in np.float32 (-1, 1), channels averaged
+    """
+    with open(wavFileIn, 'rb') as f_in:
+        fmt, data_size = wavHeaderRead(f_in)
+        data = np.fromfile(f_in, dtype=np.uint8,
+                           count=-1 if data_size is None else data_size)
+    return fmt['sr'], wavDataToFloat(data, fmt)
+
+# largest up or down factor of a polyphase filter (about 20k taps); the
+# sampling rate comes from the upload, so ratios are capped and the cache
+# of filters is bounded
+MAX_POLY_RATIO = 1024
+
+@functools.lru_cache(maxsize=16)
+def _polyphaseFilter(up, down):
+    # same anti-aliasing low-pass as scipy.signal.resample_poly's default,
+    # designed once per ratio instead of once per call; float32 taps keep
+    # upfirdn in single precision for float32 input
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = scipy.signal.firwin(2 * half_len + 1, 1. / max_rate,
+                            window=('kaiser', 5.0)).astype(np.float32)
+    h.setflags(write=False)
+    return h
+
+def resamplePoly(wavData, orig_sr, target_sr):
+    """ wavData = resamplePoly(wavData, orig_sr, target_sr)
+    Polyphase resampling of a 1-D waveform from orig_sr to target_sr.
+
+    The FIR filter bank of each (orig_sr, target_sr) ratio is designed on
+    first use and cached. Ratios whose factors exceed MAX_POLY_RATIO (e.g.
+    23999 -> 24000 Hz) are approximated by the closest ratio within it,
+    a relative rate error below 1e-6 for common rates.
+    """
+    if orig_sr == target_sr:
+        return wavData
+    ratio = fractions.Fraction(int(target_sr), int(orig_sr))
+    if max(ratio.numerator, ratio.denominator) > MAX_POLY_RATIO:
+        ratio = ratio.limit_denominator(MAX_POLY_RATIO)
+        if ratio.numerator > MAX_POLY_RATIO:
+            raise ValueError("Cannot resample from {} to {} Hz".format(
+                orig_sr, target_sr))
+    up, down = ratio.numerator, ratio.denominator
+    if up == down:
+        return wavData
+    h = _polyphaseFilter(up, down)
+    # resample_poly scales its window argument in place: hand it a copy
+    out = scipy.signal.resample_poly(wavData, up, down, window=h.copy())
+    return out.astype(np.float32, copy=False)
+
+
 def buffering(x, n, p=0, opt=None):
     """buffering(x, n, p=0, opt=None)
     input
@@ -0,0 +1,161 @@
+"""
+distill
+
+Knowledge distillation of RawNet into a smaller student, used by
+main.py --teacher_path.
+
+The frozen teacher's log-probabilities of both heads (fc2_binary_gru and
+fc2_multi_gru) are the soft targets. They are computed during the first
+epoch, stored per dataset index, and saved to disk once every index has
+been seen, so later epochs and later runs with the same teacher do not
+run the teacher at all. The inputs are the deterministic, repeat-padded
+4 s crops of Dataset_LibriSeVoc, so cached outputs stay valid as long as
+every index holds the same file: the cache is keyed by the ordered list of
+files and labels too, since Dataset_LibriSeVoc lists them in os.listdir
+order.
+"""
+import hashlib
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset
+
+from result_cache import file_checksum
+
+
+class IndexedDataset(Dataset):
+    """ Wrap a dataset so that items also carry their index. """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return tuple(self.dataset[index]) + (index,)
+
+
+class TeacherCache:
+    """
+    cache = TeacherCache(teacher, teacher_path, split, items, cache_dir)
+
+    items: list of (path, label) of each dataset index, in order
+
+    Teacher log-probabilities per dataset index of one split, kept in
+    memory and in cache_dir/<teacher checksum>_<split>_<size>_<items
+    hash>.npz once complete.
+    """
+
+    def __init__(self, teacher, teacher_path, split, items, cache_dir):
+        self.teacher = teacher
+        size = len(items)
+        self.path = os.path.join(cache_dir, '{}_{}_{}_{}.npz'.format(
+            file_checksum(teacher_path), split, size, items_checksum(items)))
+        if os.path.exists(self.path):
+            cached = np.load(self.path)
+            self.binary = cached['binary']
+            self.multi = cached['multi']
+            self.filled = np.ones(size, dtype=bool)
+        else:
+            self.binary = np.zeros((size, 2), dtype=np.float32)
+            self.multi = np.zeros((size, 7), dtype=np.float32)
+            self.filled = np.zeros(size, dtype=bool)
+
+    @property
+    def complete(self):
+        return bool(self.filled.all())
+
+    def lookup(self, batch_x, index):
+        """ Teacher (log_probs_binary, log_probs_multi) of a batch. """
+        index = index.numpy()
+        missing = ~self.filled[index]
+        if missing.any():
+            with torch.no_grad():
+                out_binary, out_multi = self.teacher(
+                    batch_x[torch.from_numpy(missing).to(batch_x.device)])
+            self.binary[index[missing]] = out_binary.float().cpu().numpy()
+            self.multi[index[missing]] = out_multi.float().cpu().numpy()
+            self.filled[index[missing]] = True
+        return (torch.from_numpy(self.binary[index]).to(batch_x.device),
+                torch.from_numpy(self.multi[index]).to(batch_x.device))
+
+    def save(self):
+        """ Write the cache once every index has been seen. """
+        if self.complete and not os.path.exists(self.path):
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            np.savez(self.path, binary=self.binary, multi=self.multi)
+
+
+def items_checksum(items):
+    """ Short hash of an ordered list of (path, label). """
+    digest = hashlib.sha256()
+    for path, label in items:
+        digest.update('{}\t{}\n'.format(path, label).encode())
+    return digest.hexdigest()[:16]
+
+
+def distillation_loss(student_out, teacher_out, temperature, lamda):
+    """
+    KL divergence of the student to the teacher at a temperature, for both
+    heads weighted by lamda / 1 - lamda like the hard loss of main.py.
+
+    Both models output log-softmax, which differs from the logits by a
+    constant per row, so dividing it by the temperature is enough.
+    """
+    losses = []
+    for student, teacher in zip(student_out, teacher_out):
+        losses.append(F.kl_div(F.log_softmax(student / temperature, dim=1),
+                               F.log_softmax(teacher / temperature, dim=1),
+                               reduction='batchmean', log_target=True)
+                      * temperature ** 2)
+    return lamda * losses[0] + (1 - lamda) * losses[1]
+
+
+def segment_latency(model, device, runs=10, batch_size=1, length=96000):
+    """ Mean forward time in ms of a (batch_size, length) input. """
+    model.eval()
+    x = torch.randn(batch_size, length).to(device)
+    with torch.no_grad():
+        model(x)
+        if str(device).startswith('cuda'):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(runs):
+            model(x)
+        if str(device).startswith('cuda'):
+            torch.cuda.synchronize()
+    return 1000 * (time.perf_counter() - start) / runs
+
+
+def compare_to_teacher(dev_loader, student, teacher_cache, device):
+    """
+    Binary accuracy of student and teacher, and how often the student
+    agrees with the teacher's binary and vocoder decisions, in %.
+    """
+    student.eval()
+    num_total = 0
+    correct_student = correct_teacher = agree_binary = agree_multi = 0
+    for batch_x, batch_y_multi, batch_y_binary, index in dev_loader:
+        batch_x = batch_x.to(device)
+        batch_y_binary = batch_y_binary.view(-1).type(torch.int64).to(device)
+        with torch.no_grad():
+            out_binary, out_multi = student(batch_x)
+        teacher_binary, teacher_multi = teacher_cache.lookup(batch_x, index)
+        pred_binary = out_binary.argmax(dim=1)
+        num_total += batch_x.size(0)
+        correct_student += (pred_binary == batch_y_binary).sum().item()
+        correct_teacher += (teacher_binary.argmax(dim=1) == batch_y_binary).sum().item()
+        agree_binary += (pred_binary == teacher_binary.argmax(dim=1)).sum().item()
+        agree_multi += (out_multi.argmax(dim=1) == teacher_multi.argmax(dim=1)).sum().item()
+    teacher_cache.save()
+    scale = 100.0 / max(num_total, 1)
+    return {
+        "student_accuracy": correct_student * scale,
+        "teacher_accuracy": correct_teacher * scale,
+        "binary_agreement": agree_binary * scale,
+        "multi_agreement": agree_multi * scale,
+    }
@@ -0,0 +1,71 @@
+"""
+early_exit
+
+Sequential early exit over the segments of a file.
+
+Segments are scored a few at a time; after each batch, a Hoeffding-Serfling
+bound on the running mean of the "fake" probability decides whether the
+segments left could still move the file mean across the 0.5 decision
+boundary. The k-th check spends delta / (k * (k + 1)) of the error budget,
+so the bound holds at every check at once. It assumes the scored segments
+are a random sample of the file; with the deterministic orders below it
+is a heuristic stopping rule whose effect is measured by
+benchmarks/bench_early_exit.py.
+
+Segment orders:
+  sequential  from the start of the file
+  spread      van der Corput order over the file, so that every prefix
+              covers it evenly: 0, 1/2, 1/4, 3/4, 1/8, ...
+"""
+import math
+import os
+
+import numpy as np
+
+SEGMENT_ORDERS = ("sequential", "spread")
+# error budget of the bound, 0 disables early exit
+EARLY_EXIT_DELTA = float(os.environ.get("ECHOWIPE_EARLY_EXIT_DELTA", "0"))
+EARLY_EXIT_ORDER = os.environ.get("ECHOWIPE_EARLY_EXIT_ORDER", "spread")
+# segments scored between two checks
+EARLY_EXIT_BATCH = int(os.environ.get("ECHOWIPE_EARLY_EXIT_BATCH", "4"))
+
+
+def segment_order(num_segments, order="sequential"):
+    """ Indices of the segments in the order they are scored. """
+    if order not in SEGMENT_ORDERS:
+        raise ValueError("Unknown segment order {}".format(order))
+    if order == "sequential" or num_segments <= 2:
+        return np.arange(num_segments)
+
+    picked = np.zeros(num_segments, dtype=bool)
+    indices = []
+    k = 0
+    while len(indices) < num_segments:
+        # radical inverse of k in base 2
+        point, denom, rest = 0.0, 1.0, k
+        while rest:
+            denom *= 2
+            point += (rest & 1) / denom
+            rest >>= 1
+        idx = int(point * num_segments)
+        if not picked[idx]:
+            picked[idx] = True
+            indices.append(idx)
+        k += 1
+    return np.array(indices)
+
+
+def confidence_radius(num_scored, num_segments, num_checks, delta):
+    """ Half-width of the anytime interval at the k-th check. """
+    delta_k = delta / (num_checks * (num_checks + 1))
+    # finite population correction: sampling without replacement
+    correction = 1 - (num_scored - 1) / float(num_segments)
+    return math.sqrt(correction * math.log(2 / delta_k) / (2 * num_scored))
+
+
+def decided(mean_fake, num_scored, num_segments, num_checks, delta):
+    """ Whether the remaining segments can be skipped. """
+    if num_scored >= num_segments:
+        return True
+    return abs(mean_fake - 0.5) > confidence_radius(
+        num_scored, num_segments, num_checks, delta)
@@ -2,13 +2,8 @@ import argparse
 import sys
 import os
 import numpy as np
-import torch
-from torch import nn
-from torch import Tensor
 import yaml
-from model import RawNet
-from torch.nn import functional as F
-import librosa
+import core_scripts.data_io.wav_tools as nii_wav_tk
 import json
 from datetime import datetime
 
@@ -17,85 +12,97 @@ def pad(x, max_len=96000):
     x_len = x.shape[0]
     if x_len >= max_len:
         return x[:max_len]
-    # need to pad
-    num_repeats = int(max_len / x_len)+1
-    padded_x = np.tile(x, (1, num_repeats))[:, :max_len][0]
-    return padded_x	
+    # need to pad: np.resize repeats x cyclically, same as tiling it
+    return np.resize(x, max_len)
 
-def load_sample(sample_path, max_len = 96000):
-    
-    y_list = []
-    y, sr = librosa.load(sample_path, sr=None)
+def segment(y, max_len=96000, hop=None, min_len=None):
+    """
+    segments = segment(y, max_len=96000, hop=None, min_len=None)
+
+    Cut a waveform into a contiguous (num_segments, max_len) array.
+
+    Windows start every hop samples (default: max_len, no overlap). When the
+    windows do not end on the last sample, one more window aligned to the
+    end of y covers the tail, so no audio is dropped. Waveforms shorter than
+    max_len are repeat-padded into a single segment, of max_len samples or,
+    with min_len set, of max(len(y), min_len) samples.
+    """
+    if hop is None:
+        hop = max_len
+    y = np.ascontiguousarray(y, dtype=np.float32)
+    if len(y) <= max_len:
+        if min_len is not None:
+            return pad(y, max(len(y), min_len))[np.newaxis, :]
+        return pad(y, max_len)[np.newaxis, :]
+
+    num_full = (len(y) - max_len) // hop + 1
+    if hop == max_len and num_full * max_len == len(y):
+        # exact multiple: a reshaped view, no copy at all
+        return y.reshape(num_full, max_len)
+
+    windows = np.lib.stride_tricks.sliding_window_view(y, max_len)
+    starts = np.arange(num_full) * hop
+    if starts[-1] + max_len < len(y):
+        starts = np.append(starts, len(y) - max_len)
+    # a single gather into one contiguous array
+    return windows[starts]
+
+def load_audio(sample_path):
+    """ Decode an audio file into a 24 kHz float waveform. """
+    try:
+        # PCM / float WAV: header parse and one read, no librosa
+        sr, y = nii_wav_tk.waveReadFast(sample_path)
+    except ValueError:
+        import librosa
+        y, sr = librosa.load(sample_path, sr=None)
+    return resample(y, sr)
+
+def resample(y, sr):
     
     if sr != 24000:
-        y = librosa.resample(y, orig_sr = sr, target_sr = 24000)
-        
-    if(len(y) <= 96000):
-        return [Tensor(pad(y, max_len))]
-        
-    for i in range(int(len(y)/96000)):
-        if (i+1) ==  range(int(len(y)/96000)):
-            y_seg = y[i*96000 : ]
-        else:
-            y_seg = y[i*96000 : (i+1)*96000]
-        # print(len(y_seg))
-        y_pad = pad(y_seg, max_len)
-        y_inp = Tensor(y_pad)
-        
-        y_list.append(y_inp)
-        
-    return y_list
+        y = nii_wav_tk.resamplePoly(y, sr, 24000)
+    return y
+
+def load_sample(sample_path, max_len = 96000):
     
-    # print(json_text)
+    return segment(load_audio(sample_path), max_len)
+
+def prepare_sample(y, sr, max_len = 96000):
     
-    with open(output_path, 'w') as json_w:
-        json.dump(json_text, json_w)
+    return segment(resample(y, sr), max_len)
     
 
 if __name__ == '__main__':
+    from early_exit import EARLY_EXIT_ORDER, SEGMENT_ORDERS
+
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_path', type=str, help='This path should be an external path point to an audio file')
     parser.add_argument('--model_path', type=str, help='This path should be an external path point to an audio file')
+    parser.add_argument('--batch_size', type=int, default=32, help='Number of 4-second segments scored per forward')
+    parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'torchscript', 'onnx'], help='torchscript and onnx expect an artifact written by export_model.py')
+    parser.add_argument('--quantize', type=str, default=None, choices=['dynamic'], help='Quantize a float checkpoint to int8 at load time (checkpoints from quantize.py are detected automatically)')
+    parser.add_argument('--early_exit', type=float, default=None, help='Stop scoring segments once the decision holds with this error budget, e.g. 0.05')
+    parser.add_argument('--segment_order', type=str, default=EARLY_EXIT_ORDER, choices=SEGMENT_ORDERS, help='Order in which segments are scored with --early_exit, default ECHOWIPE_EARLY_EXIT_ORDER or spread like the service')
+    parser.add_argument('--variable_length', action='store_true', help='Score audio shorter than 4 s at its own length instead of repeat-padding it')
     args = parser.parse_args()
 
     input_path = args.input_path
     model_path = args.model_path
 
-    # load model config
-    dir_yaml = "model_config_RawNet.yaml"
+    # the engine lives in model_service, which imports this module
+    from model_service import DetectionEngine, MULTI_LABELS
 
-    with open(dir_yaml, 'r') as f_yaml:
-        parser1 = yaml.safe_load(f_yaml)
-    
-    # load cuda
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    print('Device: {}'.format(device))
-    
-    # init model
-    model = RawNet(parser1['model'], device)
-    model =(model).to(device)
-    
-    model.load_state_dict(torch.load(model_path, map_location=device))
+    engine = DetectionEngine(model_path = model_path, batch_size = args.batch_size, quantize = args.quantize, backend = args.backend,
+                             early_exit_delta = args.early_exit, segment_order = args.segment_order,
+                             variable_length = args.variable_length)
+    print('Device: {}'.format(engine.device))
     print('Model loaded : {}'.format(model_path))
-    
-    model.eval()
-    
-    out_list_multi = []
-    out_list_binary = []
-    for m_batch in load_sample(input_path):
-        m_batch = m_batch.to(device=device, dtype=torch.float).unsqueeze(0)
-        logits, multi_logits = model(m_batch)
-        
-        probs = F.softmax(logits, dim=-1)
-        probs_multi = F.softmax(multi_logits, dim=-1)
-        # print(probs)
-        # out_list.append([probs[i, 1].item() for i in range(probs.size(0))][0])
-        out_list_multi.append(probs_multi.tolist()[0])
-        out_list_binary.append(probs.tolist()[0])
-
-    result_multi = np.average(out_list_multi, axis=0).tolist()
-    result_binary = np.average(out_list_binary, axis=0).tolist()
+
+    result = engine.detect(input_path)
+    result_multi = [result['multi'][name] for name in MULTI_LABELS]
+    result_binary = [result['fake'], result['real']]
 
     print('Multi classification result : gt:{}, wavegrad:{}, diffwave:{}, parallel wave gan:{}, wavernn:{}, wavenet:{}, melgan:{}'.format(result_multi[0], result_multi[1], result_multi[2], result_multi[3], result_multi[4], result_multi[5], result_multi[6]))
     print('Binary classification result : fake:{}, real:{}'.format(result_binary[0], result_binary[1]))
-   
+    if 'evaluated' in result:
+        print('Segments evaluated : {} of {}'.format(result['evaluated'], result['segments']))
@@ -0,0 +1,90 @@
+"""
+eval_tools
+
+Scoring of the dev.txt / test.txt / train.txt lists against LibriSeVoc.
+
+The lists hold bare file names; every name exists once per subset folder
+of the data set (gt plus one folder per vocoder), so each entry expands to
+one real and six fake utterances. Labels follow Dataset_LibriSeVoc in
+main.py: multi-class label 0 for gt, 1.. for the other folders in listing
+order, and binary label 1 (real) only for gt.
+"""
+import os
+import resource
+import time
+
+import numpy as np
+
+
+def load_list(data_path, list_path, limit=None):
+    """
+    items = load_list(data_path, list_path, limit=None)
+
+    items: list of (path, multi_label, binary_label)
+    limit: keep only the first limit file names of the list
+    """
+    with open(list_path, 'r') as f_list:
+        names = [line.strip() for line in f_list if line.strip()]
+    if limit:
+        names = names[:limit]
+
+    subsets = os.listdir(data_path)
+    labelled = [(x, 0) for x in subsets if x.startswith('gt')]
+    labelled += [(x, i + 1) for i, x in
+                 enumerate([x for x in subsets if not x.startswith('gt')])]
+    items = []
+    for subset_name, multi_label in labelled:
+        binary_label = 1 if multi_label == 0 else 0
+        for name in names:
+            path = os.path.join(data_path, subset_name, name)
+            if os.path.exists(path):
+                items.append((path, multi_label, binary_label))
+    return items
+
+
+def evaluate(detect_fn, items):
+    """
+    stats = evaluate(detect_fn, items)
+
+    detect_fn: callable, path -> result dict of DetectionEngine.detect
+    items: output of load_list
+
+    stats: dict with binary "accuracy" (%), mean "latency_ms" per file,
+           the per-file "fake" probabilities, the number of "files" and the
+           total number of "segments" and of segments "evaluated"
+    """
+    fake_probs = np.zeros(len(items))
+    labels = np.zeros(len(items))
+    elapsed = 0.0
+    segments = evaluated = 0
+    for idx, (path, _, binary_label) in enumerate(items):
+        start = time.perf_counter()
+        result = detect_fn(path)
+        elapsed += time.perf_counter() - start
+        fake_probs[idx] = result["fake"]
+        labels[idx] = binary_label
+        segments += result["segments"]
+        evaluated += result.get("evaluated", result["segments"])
+
+    # binary_label 1 is real, i.e. a correct call has fake <= 0.5
+    correct = (fake_probs <= 0.5) == (labels == 1)
+    return {
+        "files": len(items),
+        "accuracy": 100 * float(np.mean(correct)) if len(items) else 0.0,
+        "latency_ms": 1000 * elapsed / max(len(items), 1),
+        "fake": fake_probs,
+        "segments": segments,
+        "evaluated": evaluated,
+    }
+
+
+def current_rss_mb():
+    """ Resident set size of this process in MB (peak RSS off Linux). """
+    try:
+        with open('/proc/self/status', 'r') as f_status:
+            for line in f_status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
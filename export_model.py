@@ -0,0 +1,152 @@
+"""
+export_model
+
+Export a trained RawNet into a frozen serving artifact.
+
+  torchscript  traced, frozen TorchScript module; BatchNorm folded into
+               the preceding Conv1d of every Residual_block, SincConv
+               filters (and their spectra) baked in as constants
+  onnx         the same folded graph as an ONNX model with a dynamic batch
+               axis, input "waveform", outputs "binary" and "multi"
+               (log-probabilities of both heads)
+
+The artifacts are loaded by DetectionEngine(backend='torchscript'|'onnx')
+without importing model.py; the onnx backend does not need torch at all.
+
+Usage:
+  python export_model.py --model_path model_detection.pth \
+      --format onnx --output_path model_detection.onnx --check_audio a.wav
+"""
+import argparse
+import copy
+
+import torch
+import yaml
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from model import RawNet, Residual_block
+
+EXPORT_FORMATS = ('torchscript', 'onnx')
+
+
+def fold_batchnorm(model):
+    """
+    folded = fold_batchnorm(model)
+
+    Copy of an eval-mode RawNet where bn2 of each Residual_block is folded
+    into conv1. bn1 only feeds a value Residual_block.forward discards, so
+    it is dropped as well.
+    """
+    folded = copy.deepcopy(model).eval()
+    for module in folded.modules():
+        if isinstance(module, Residual_block):
+            module.conv1 = fuse_conv_bn_eval(module.conv1, module.bn2)
+            module.bn2 = nn.Identity()
+            if not module.first:
+                module.bn1 = nn.Identity()
+    return folded
+
+
+def export_torchscript(model, output_path, length=96000, batch_size=2):
+    """
+    Trace, freeze and save model for inputs of (batch, length); the batch
+    axis stays dynamic, the length is fixed at export time.
+    """
+    model = fold_batchnorm(model)
+    example = torch.randn(batch_size, length)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example, check_trace=False)
+    frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+    torch.jit.save(frozen, output_path)
+    return frozen
+
+
+def export_onnx(model, output_path, length=96000, batch_size=2):
+    """
+    Write model to ONNX for inputs of (batch, length); the batch axis is
+    dynamic, the length is fixed at export time.
+    """
+    model = fold_batchnorm(model)
+    # the FFT path has no portable ONNX lowering
+    model.Sinc_conv.conv_mode = 'direct'
+    example = torch.randn(batch_size, length)
+    torch.onnx.export(model, (example,), output_path,
+                      input_names=['waveform'],
+                      output_names=['binary', 'multi'],
+                      dynamic_axes={'waveform': {0: 'batch'},
+                                    'binary': {0: 'batch'},
+                                    'multi': {0: 'batch'}},
+                      opset_version=18)
+
+
+def check_export(model, exported, length=96000, batch_sizes=(1, 3)):
+    """ Largest absolute difference of the probabilities of both heads. """
+    max_diff = 0.0
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            x = torch.randn(batch_size, length)
+            for ref, out in zip(model(x), exported(x)):
+                max_diff = max(max_diff,
+                               (ref.exp() - out.exp()).abs().max().item())
+    return max_diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='model_detection.pth')
+    parser.add_argument('--config_path', type=str, default='model_config_RawNet.yaml')
+    parser.add_argument('--output_path', type=str, default=None,
+                        help='Default: model_detection.ts.pt or model_detection.onnx')
+    parser.add_argument('--format', type=str, default='torchscript', choices=EXPORT_FORMATS)
+    parser.add_argument('--length', type=int, default=96000,
+                        help='Number of samples per segment, fixed in the artifact')
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    parser.add_argument('--check_audio', type=str, nargs='*', default=[],
+                        help='Audio files scored with the torch and the exported backend')
+    args = parser.parse_args()
+    if args.output_path is None:
+        args.output_path = {'torchscript': 'model_detection.ts.pt',
+                            'onnx': 'model_detection.onnx'}[args.format]
+
+    with open(args.config_path, 'r') as f_yaml:
+        d_args = yaml.safe_load(f_yaml)['model']
+
+    model = RawNet(d_args, 'cpu')
+    model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+    model.eval()
+
+    if args.format == 'onnx':
+        import onnxruntime
+
+        export_onnx(model, args.output_path, args.length)
+        session = onnxruntime.InferenceSession(
+            args.output_path, providers=['CPUExecutionProvider'])
+        exported = lambda x: [torch.from_numpy(out) for out in
+                              session.run(None, {'waveform': x.numpy()})]
+    else:
+        export_torchscript(model, args.output_path, args.length)
+        exported = torch.jit.load(args.output_path, map_location='cpu')
+
+    max_diff = check_export(model, exported, args.length)
+    print('Exported {} to {} ({})'.format(args.model_path, args.output_path, args.format))
+    print('Max abs difference of probabilities: {:.3e}'.format(max_diff))
+
+    if args.check_audio:
+        from model_service import DetectionEngine
+
+        engine_torch = DetectionEngine(model_path=args.model_path,
+                                       config_path=args.config_path, device='cpu')
+        engine_export = DetectionEngine(model_path=args.output_path,
+                                        device='cpu', backend=args.format)
+        for path in args.check_audio:
+            ref = engine_torch.detect(path)
+            out = engine_export.detect(path)
+            diff = max(abs(ref['fake'] - out['fake']),
+                       max(abs(ref['multi'][k] - out['multi'][k]) for k in ref['multi']))
+            print('{}: fake torch {:.6f} {} {:.6f}, max abs diff {:.3e}'.format(
+                path, ref['fake'], args.format, out['fake'], diff))
+            max_diff = max(max_diff, diff)
+
+    if max_diff > args.tolerance:
+        raise SystemExit('Exported model differs by more than {}'.format(args.tolerance))
@@ -0,0 +1,258 @@
+"""
+job_queue
+
+Background detection jobs for long recordings.
+
+A job holds the upload, spooled to a temporary file by the request; a
+bounded pool of worker threads decodes it and scores its segments with the
+per-process DetectionEngine, publishing the share of segments scored and
+the running average of the probabilities as it goes. Finished jobs are
+kept for JOB_TTL seconds and, when a callback URL was given, POSTed to it
+as JSON. Callbacks only go to public addresses, or to the hosts of
+ECHOWIPE_CALLBACK_HOSTS when it is set, and redirects are not followed.
+
+Jobs live in the memory of the process that accepted them: behind several
+gunicorn workers, GET /api/jobs/<id> has to reach the same worker (one
+worker with threads, or sticky routing).
+"""
+import ipaddress
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from metrics import QUEUE_DEPTH
+from upload_io import decode_upload
+
+# detection threads per process; all of them share one engine
+JOB_WORKERS = int(os.environ.get("ECHOWIPE_JOB_WORKERS", "2"))
+# jobs queued or running at once, further submissions are refused
+MAX_JOBS = int(os.environ.get("ECHOWIPE_MAX_JOBS", "32"))
+# seconds a finished job stays visible
+JOB_TTL = float(os.environ.get("ECHOWIPE_JOB_TTL", "3600"))
+# longest recording accepted as a job
+MAX_JOB_SECONDS = float(os.environ.get("ECHOWIPE_MAX_JOB_SECONDS", "14400"))
+# largest upload accepted as a job, instead of ECHOWIPE_MAX_UPLOAD_MB; the
+# default holds 4 hours of 24 kHz mono PCM16
+MAX_JOB_BYTES = int(float(os.environ.get("ECHOWIPE_MAX_JOB_MB", "700"))
+                    * 1024 * 1024)
+CALLBACK_TIMEOUT = float(os.environ.get("ECHOWIPE_CALLBACK_TIMEOUT", "10"))
+# comma separated hosts callbacks may go to, private ones included; when
+# empty, any host that resolves to public addresses only
+CALLBACK_HOSTS = [host.strip().lower() for host in
+                  os.environ.get("ECHOWIPE_CALLBACK_HOSTS", "").split(",")
+                  if host.strip()]
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(RuntimeError):
+    """ Raised by JobQueue.submit when MAX_JOBS jobs are pending. """
+
+
+def check_callback_url(url, hosts=CALLBACK_HOSTS):
+    """
+    Raise ValueError unless url is an http(s) URL of an allowed host: one
+    of hosts, or with hosts empty, a host without any loopback, private,
+    link-local or otherwise non-global address.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError("callback_url should be an http(s) URL")
+    if hosts:
+        if parsed.hostname.lower() not in hosts:
+            raise ValueError("callback_url host is not allowed")
+        return
+    try:
+        infos = socket.getaddrinfo(parsed.hostname, parsed.port or 80,
+                                   proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError) as e:
+        raise ValueError("callback_url host cannot be resolved: {}".format(e))
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not address.is_global or address.is_multicast:
+            raise ValueError("callback_url should not be a private address")
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # a redirect could point the callback to a host check_callback_url refuses
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_callback_opener = urllib.request.build_opener(_NoRedirect)
+
+
+class Job:
+    """ State of one detection job; read it through JobQueue.get. """
+
+    def __init__(self, stream, callback_url=None):
+        self.id = uuid.uuid4().hex
+        self.stream = stream
+        self.callback_url = callback_url
+        self.status = "queued"
+        self.segments = None
+        self.scored = 0
+        self.partial = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def to_dict(self):
+        state = {
+            "id": self.id,
+            "status": self.status,
+            "segments": self.segments,
+            "scored": self.scored,
+            "progress": round(100.0 * self.scored / self.segments, 1)
+            if self.segments else (100.0 if self.status == "done" else 0.0),
+        }
+        latest = self.result or self.partial
+        if latest is not None:
+            state["fake"] = latest["fake"]
+            state["real"] = latest["real"]
+            state["label"] = latest["label"]
+        if self.result is not None:
+            state["result"] = self.result
+        if self.error is not None:
+            state["error"] = self.error
+        return state
+
+
+class JobQueue:
+    """
+    jobs = JobQueue(engine_fn, workers=JOB_WORKERS, max_jobs=MAX_JOBS,
+                    ttl=JOB_TTL, max_seconds=MAX_JOB_SECONDS,
+                    max_bytes=MAX_JOB_BYTES)
+
+    engine_fn: callable returning the DetectionEngine, called in the workers
+    workers: int, number of jobs scored at once
+    max_jobs: int, upper bound of queued plus running jobs
+    ttl: float, seconds a finished job can still be fetched
+    max_seconds: float, longest recording accepted
+    max_bytes: int, largest upload accepted
+    """
+
+    def __init__(self, engine_fn, workers=JOB_WORKERS, max_jobs=MAX_JOBS,
+                 ttl=JOB_TTL, max_seconds=MAX_JOB_SECONDS,
+                 max_bytes=MAX_JOB_BYTES):
+        self.engine_fn = engine_fn
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="rawnet-job")
+        self._jobs = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, stream, callback_url=None):
+        """
+        job_id = jobs.submit(stream, callback_url=None)
+
+        stream: seekable binary file of the uploaded audio, e.g. a
+          temporary file; once submitted, the job reads and closes it
+        callback_url: http(s) URL receiving the final job state as JSON
+        """
+        if callback_url:
+            check_callback_url(callback_url)
+        job = Job(stream, callback_url or None)
+        with self._lock:
+            self._expire()
+            if self._pending >= self.max_jobs:
+                raise JobQueueFull("{} jobs are pending".format(self._pending))
+            self._pending += 1
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job)
+        return job.id
+
+    @property
+    def pending(self):
+        """ Jobs queued or running. """
+        return self._pending
+
+    def get(self, job_id):
+        """ Snapshot dict of a job, or None when unknown or expired. """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else job.to_dict()
+
+    def _run(self, job):
+        with self._lock:
+            job.status = "running"
+        try:
+            waveform, sr = decode_upload(job.stream, self.max_seconds,
+                                         self.max_bytes)
+            job.stream.close()
+            result = self.engine_fn().detect(
+                waveform, sr=sr,
+                progress=lambda scored, total, partial:
+                self._progress(job, scored, total, partial))
+        except Exception as e:
+            with self._lock:
+                job.status = "failed"
+                job.error = str(e)
+        else:
+            with self._lock:
+                job.status = "done"
+                job.result = result
+                job.segments = job.scored = result["segments"]
+        finally:
+            job.stream.close()
+            with self._lock:
+                job.finished = time.time()
+                self._pending -= 1
+                state = job.to_dict()
+        if job.callback_url:
+            self._callback(job.callback_url, state)
+
+    def _progress(self, job, scored, total, partial):
+        with self._lock:
+            job.segments = total
+            job.scored = scored
+            job.partial = partial
+
+    def _callback(self, url, state):
+        request = urllib.request.Request(
+            url, data=json.dumps(state).encode(),
+            headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            # resolved again: the host may point elsewhere by now
+            check_callback_url(url)
+            _callback_opener.open(request, timeout=CALLBACK_TIMEOUT).close()
+        except Exception as e:
+            logger.warning("Callback of job %s to %s failed: %s",
+                           state["id"], url, e)
+
+    def _expire(self):
+        deadline = time.time() - self.ttl
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished is not None and job.finished < deadline]:
+            del self._jobs[job_id]
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """ Return the per-process JobQueue, created on first use. """
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                from model_service import get_engine
+
+                _job_queue = JobQueue(get_engine)
+                QUEUE_DEPTH.set_function(lambda: _job_queue.pending,
+                                         queue="jobs")
+    return _job_queue
@@ -10,6 +10,8 @@ from torch import nn
 from torch import Tensor
 from torch.utils.data import DataLoader, Dataset
 from model import RawNet
+from distill import (IndexedDataset, TeacherCache, distillation_loss,
+                     segment_latency, compare_to_teacher)
 from core_scripts.startup_config import set_random_seed
 from pdb import set_trace
 from tqdm import tqdm
@@ -144,6 +146,19 @@ if __name__ == '__main__':
     parser.add_argument('--num_epochs', type=int, default=100)
     parser.add_argument('--lr', type=float, default=0.0001 )
     parser.add_argument('--weight_decay', type=float, default=0.0001)
+    parser.add_argument('--model_config', type=str, default='model_config_RawNet.yaml',
+                        help='model_config_RawNet_small.yaml trains the cascade screener')
+    parser.add_argument('--init_path', type=str, default=None,
+                        help='Start from this checkpoint, e.g. a pruned model written by prune.py')
+    # distillation: a frozen teacher RawNet provides soft targets
+    parser.add_argument('--teacher_path', type=str, default=None,
+                        help='Checkpoint of the teacher; enables distillation into --model_config')
+    parser.add_argument('--teacher_config', type=str, default='model_config_RawNet.yaml')
+    parser.add_argument('--temperature', type=float, default=2.0)
+    parser.add_argument('--alpha', type=float, default=0.5,
+                        help='Weight of the distillation loss, 1 - alpha for the labels')
+    parser.add_argument('--logit_cache_dir', type=str, default=None,
+                        help='Teacher outputs cache, default <model_save_path>/teacher_logits')
 
     args = parser.parse_args()
 
@@ -164,7 +179,7 @@ if __name__ == '__main__':
     dev_dataloader = DataLoader(dev_set, batch_size=batch_size, shuffle=True, drop_last=False)
 
     # load model config
-    dir_yaml = os.path.splitext('model_config_RawNet')[0] + '.yaml'
+    dir_yaml = args.model_config
     with open(dir_yaml, 'r') as f_yaml:
         parser1 = yaml.safe_load(f_yaml)
 
@@ -174,6 +189,8 @@ if __name__ == '__main__':
 
     # init model
     model = RawNet(parser1['model'], device)
+    if args.init_path is not None:
+        model.load_state_dict(torch.load(args.init_path, map_location='cpu'))
     model =(model).to(device)
     optimizer = torch.optim.Adam(model.parameters(), lr = lr, weight_decay = weight_decay)
 
@@ -182,11 +199,34 @@ if __name__ == '__main__':
     if not os.path.exists(model_save_path):
             os.mkdir(model_save_path)
 
+    teacher = None
+    train_cache = dev_cache = None
+    if args.teacher_path is not None:
+        with open(args.teacher_config, 'r') as f_yaml:
+            teacher = RawNet(yaml.safe_load(f_yaml)['model'], device)
+        teacher.load_state_dict(torch.load(args.teacher_path, map_location=device))
+        teacher = teacher.to(device).eval()
+        for param in teacher.parameters():
+            param.requires_grad = False
+
+        # items carry their index, the key of the teacher outputs cache
+        train_dataloader = DataLoader(IndexedDataset(train_set), batch_size=batch_size, shuffle=True, drop_last=False)
+        dev_dataloader = DataLoader(IndexedDataset(dev_set), batch_size=batch_size, shuffle=True, drop_last=False)
+        cache_dir = args.logit_cache_dir or os.path.join(model_save_path, 'teacher_logits')
+        train_cache = TeacherCache(teacher, args.teacher_path, 'train',
+                                   list(zip(train_set.path_list_train, train_set.y_list_train)), cache_dir)
+        dev_cache = TeacherCache(teacher, args.teacher_path, 'dev',
+                                 list(zip(dev_set.path_list_dev, dev_set.y_list_dev)), cache_dir)
+        print('Distillation from {}: teacher {} parameters, student {} parameters'.format(
+            args.teacher_path, sum(p.numel() for p in teacher.parameters()),
+            sum(p.numel() for p in model.parameters())))
+
     def evaluate_accuracy(dev_loader, model, device):
         num_correct = 0.0
         num_total = 0.0
         model.eval()
-        for batch_x, batch_y_multi, batch_y_binary in dev_loader:
+        for batch in dev_loader:
+            batch_x, batch_y_multi, batch_y_binary = batch[:3]
             
             batch_size = batch_x.size(0)
             num_total += batch_size
@@ -203,7 +243,7 @@ if __name__ == '__main__':
         return 100 * (num_correct / num_total)
 
 
-    def train_epoch(train_loader, model, lr, optim, device, lamda):
+    def train_epoch(train_loader, model, lr, optim, device, lamda, teacher_cache=None):
         running_loss = 0
         num_correct_binary = 0.0
         num_correct_multi = 0.0
@@ -217,7 +257,8 @@ if __name__ == '__main__':
         criterion_binary = nn.CrossEntropyLoss()
         criterion_multi = nn.CrossEntropyLoss()
         
-        for batch_x, batch_y_multi, batch_y_binary in tqdm(train_loader,total=len(train_loader)):
+        for batch in tqdm(train_loader,total=len(train_loader)):
+            batch_x, batch_y_multi, batch_y_binary = batch[:3]
             #print(batch_x.shape, batch_y_binary.shape, batch_y_multi.shape)
             batch_size = batch_x.size(0)
             num_total += batch_size
@@ -233,6 +274,12 @@ if __name__ == '__main__':
             
             batch_loss = lamda * criterion_binary(batch_out_binary, batch_y_binary) + (1- lamda) * criterion_multi(batch_out_multi, batch_y_multi)
             
+            if teacher_cache is not None:
+                soft_loss = distillation_loss((batch_out_binary, batch_out_multi),
+                                              teacher_cache.lookup(batch_x, batch[3]),
+                                              args.temperature, lamda)
+                batch_loss = args.alpha * soft_loss + (1 - args.alpha) * batch_loss
+            
             #print(batch_loss)
             
             # binary acc
@@ -254,6 +301,9 @@ if __name__ == '__main__':
             batch_loss.backward()
             optim.step()
         
+        if teacher_cache is not None:
+            # from now on the teacher does not run on the training set
+            teacher_cache.save()
         running_loss /= num_total
         train_accuracy = ((num_correct_binary+num_correct_multi)/num_total)*50
         return running_loss, train_accuracy, out_write
@@ -261,11 +311,19 @@ if __name__ == '__main__':
 
 best_acc = 99
 for epoch in range(num_epochs):
-    running_loss, train_accuracy, out_write = train_epoch(train_dataloader, model, lr, optimizer, device, lamda = LAMDA)
+    running_loss, train_accuracy, out_write = train_epoch(train_dataloader, model, lr, optimizer, device, lamda = LAMDA, teacher_cache = train_cache)
     valid_accuracy = evaluate_accuracy(dev_dataloader, model, device)
     print(out_write)
     print('epoch: {} -loss: {}  - valid binary accuracy: {:.2f}'.format(epoch, running_loss, valid_accuracy))
+    if teacher is not None:
+        stats = compare_to_teacher(dev_dataloader, model, dev_cache, device)
+        print('student vs teacher on dev: binary accuracy {:.2f} / {:.2f}, agreement binary {:.2f} multi {:.2f}'.format(
+            stats['student_accuracy'], stats['teacher_accuracy'], stats['binary_agreement'], stats['multi_agreement']))
     if valid_accuracy > best_acc:
         print('best model find at epoch', epoch)
     best_acc = max(valid_accuracy, best_acc)
-    torch.save(model.state_dict(), os.path.join(model_save_path, 'epoch_{}.pth'.format(epoch)))
\ No newline at end of file
+    torch.save(model.state_dict(), os.path.join(model_save_path, 'epoch_{}.pth'.format(epoch)))
+
+if teacher is not None:
+    print('latency per 4s segment on {}: student {:.2f} ms, teacher {:.2f} ms'.format(
+        device, segment_latency(model, device), segment_latency(teacher, device)))
@@ -0,0 +1,255 @@
+"""
+metrics
+
+Prometheus metrics of the detection path, in the text exposition format
+(version 0.0.4) served by GET /metrics; no client library needed.
+
+  echowipe_stage_seconds{stage}     histogram of the time spent in each
+                                    stage of a detection: upload, decode,
+                                    resample, segment, forward (one model
+                                    call on a batch), sinc_conv and gru
+                                    (inside forward, torch backend),
+                                    aggregate and detect (whole call)
+  echowipe_batch_size               histogram of the batches sent to the model
+  echowipe_segments_scored_total    segments that went through the model
+  echowipe_cache_requests_total     result cache lookups by result
+  echowipe_queue_depth{queue}       segments waiting for the micro-batcher,
+                                    requests admitted (see admission) and
+                                    background jobs pending
+  echowipe_model_load_seconds       time to load each model
+  echowipe_cascade{stat}            requests, escalations and seconds per
+                                    stage of the cascade
+
+With a cascade, the stages of both models are counted together.
+Every gunicorn worker keeps its own metrics: scrape the workers one by one
+or run one worker with threads. Metrics of ReplicaPool replica processes
+stop at the forward stage. ECHOWIPE_METRICS=0 turns all recording off.
+
+Usage:
+  with metrics.timer("decode"):
+      waveform, sr = decode_upload(stream)
+  text = metrics.render()
+"""
+import bisect
+import os
+import threading
+import time
+
+# record metrics, 0 turns every timer and counter into a no-op
+METRICS = os.environ.get("ECHOWIPE_METRICS", "1") == "1"
+
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return ["# HELP {} {}".format(self.name, self.documentation),
+                "# TYPE {} {}".format(self.name, self.kind)]
+
+
+class Counter(_Metric):
+    """ counter = Counter(name, documentation, labelnames=()); counter.inc(n, **labels) """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not METRICS:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ["{}{} {}".format(self.name, _format_labels(self.labelnames, key),
+                                 _format_value(value)) for key, value in values]
+
+
+class Gauge(_Metric):
+    """
+    gauge = Gauge(name, documentation, labelnames=())
+
+    gauge.set(value, **labels), or gauge.set_function(fn, **labels) to
+    read fn() at every exposition.
+    """
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, fn, **labels):
+        self.set(fn, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = []
+        for key, value in values:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    continue
+            lines.append("{}{} {}".format(
+                self.name, _format_labels(self.labelnames, key), _format_value(value)))
+        return lines
+
+
+class Histogram(_Metric):
+    """ histogram = Histogram(name, documentation, labelnames=(), buckets=STAGE_BUCKETS) """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not METRICS:
+            return
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per bucket counts (last one: +Inf), sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][idx] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name,
+                    _format_labels(self.labelnames, key, [("le", _format_value(bound))]),
+                    cumulative))
+            labels = _format_labels(self.labelnames, key)
+            lines.append("{}_sum{} {}".format(self.name, labels, _format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    """ registry = Registry(); registry.register(metric); registry.render() """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "echowipe_stage_seconds", "Seconds spent in each stage of the detection path.",
+    ["stage"]))
+BATCH_SIZES = REGISTRY.register(Histogram(
+    "echowipe_batch_size", "Segments per batch sent to the model.",
+    buckets=BATCH_BUCKETS))
+SEGMENTS_SCORED = REGISTRY.register(Counter(
+    "echowipe_segments_scored_total", "Segments scored by the model."))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    "echowipe_cache_requests_total", "Result cache lookups.", ["result"]))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "echowipe_queue_depth", "Items waiting or in flight in each queue.", ["queue"]))
+MODEL_LOAD_SECONDS = REGISTRY.register(Gauge(
+    "echowipe_model_load_seconds", "Seconds taken to load each model.", ["model"]))
+CASCADE = REGISTRY.register(Gauge(
+    "echowipe_cascade", "Cascade requests, escalations and seconds per stage.",
+    ["stat"]))
+
+
+class timer:
+    """ with timer(stage): ... observes the elapsed seconds of the block. """
+
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, stage=self.stage)
+        return False
+
+
+def instrument_model(model):
+    """
+    Time the SincConv front end and the GRU of a RawNet with forward
+    hooks, as the sinc_conv and gru stages.
+    """
+    if not METRICS:
+        return []
+    starts = threading.local()
+    hooks = []
+    for stage, module in [("sinc_conv", getattr(model, "Sinc_conv", None)),
+                          ("gru", getattr(model, "gru", None))]:
+        if module is None:
+            continue
+
+        def pre_hook(module, inputs, stage=stage):
+            setattr(starts, stage, time.perf_counter())
+
+        def hook(module, inputs, output, stage=stage):
+            STAGE_SECONDS.observe(time.perf_counter() - getattr(starts, stage),
+                                  stage=stage)
+
+        hooks.append(module.register_forward_pre_hook(pre_hook))
+        hooks.append(module.register_forward_hook(hook))
+    return hooks
+
+
+def render():
+    """ Text exposition of every metric. """
+    return REGISTRY.render()
@@ -19,7 +19,8 @@ class SincConv(nn.Module):
 
 
     def __init__(self, device,out_channels, kernel_size,in_channels=1,sample_rate=24000,
-                 stride=1, padding=0, dilation=1, bias=False, groups=1):
+                 stride=1, padding=0, dilation=1, bias=False, groups=1,
+                 conv_mode='auto'):
 
         super(SincConv,self).__init__()
 
@@ -45,8 +46,20 @@ class SincConv(nn.Module):
             raise ValueError('SincConv does not support bias.')
         if groups > 1:
             raise ValueError('SincConv does not support groups.')
+        if conv_mode not in ('auto', 'direct', 'fft'):
+            raise ValueError('SincConv conv_mode should be auto, direct or fft.')
+        self.conv_mode = conv_mode
         
         
+        # the band-pass filters have no learnable parameter: build them once
+        # and only rebuild them if sample_rate or kernel_size is changed
+        self.register_buffer('band_pass', self._make_band_pass(),
+                             persistent=False)
+        self._band_pass_key = (self.sample_rate, self.kernel_size)
+        # filter spectra for the FFT path, {(n_fft, device, dtype): tensor}
+        self._spectra = {}
+
+    def _make_band_pass(self):
         # initialize filterbanks using Mel scale
         NFFT = 512
         f=int(self.sample_rate/2)*np.linspace(0,1,int(NFFT/2)+1)
@@ -56,35 +69,90 @@ class SincConv(nn.Module):
         filbandwidthsmel=np.linspace(fmelmin,fmelmax,self.out_channels+1)
         filbandwidthsf=self.to_hz(filbandwidthsmel)  # Mel to Hz conversion
         self.mel=filbandwidthsf
-        self.hsupp=torch.arange(-(self.kernel_size-1)/2, (self.kernel_size-1)/2+1)
-        self.band_pass=torch.zeros(self.out_channels,self.kernel_size)
-    
-       
-        
-    def forward(self,x):
-        for i in range(len(self.mel)-1):
-            fmin=self.mel[i]
-            fmax=self.mel[i+1]
-            hHigh=(2*fmax/self.sample_rate)*np.sinc(2*fmax*self.hsupp/self.sample_rate)
-            hLow=(2*fmin/self.sample_rate)*np.sinc(2*fmin*self.hsupp/self.sample_rate)
-            hideal=hHigh-hLow
-            
-            self.band_pass[i,:]=Tensor(np.hamming(self.kernel_size))*Tensor(hideal)
         
-        band_pass_filter=self.band_pass.to(self.device)
-
-        self.filters = (band_pass_filter).view(self.out_channels, 1, self.kernel_size)
+        # all filters at once, (out_channels, 1) x (kernel_size, )
+        hsupp=np.arange(-(self.kernel_size-1)/2, (self.kernel_size-1)/2+1)
+        fmin=self.mel[:-1, np.newaxis]
+        fmax=self.mel[1:, np.newaxis]
+        hHigh=(2*fmax/self.sample_rate)*np.sinc(2*fmax*hsupp/self.sample_rate)
+        hLow=(2*fmin/self.sample_rate)*np.sinc(2*fmin*hsupp/self.sample_rate)
+        hideal=hHigh-hLow
+        
+        band_pass=np.hamming(self.kernel_size)*hideal
+        return torch.tensor(band_pass, dtype=torch.float32).view(
+            self.out_channels, 1, self.kernel_size)
+        
+    def use_fft(self, x):
+        """ Whether forward(x) takes the FFT path. """
+        if self.conv_mode != 'auto':
+            return self.conv_mode == 'fft'
+        # the FFT path wins for long kernels over much longer inputs;
+        # it only covers plain stride-1 correlation in fp32/fp64
+        return (self.stride == 1 and self.dilation == 1
+                and x.dtype in (torch.float32, torch.float64)
+                and self.kernel_size >= 64
+                and x.shape[-1] + 2 * self.padding >= 2 * self.kernel_size)
+
+    def _fft_size(self, x_len):
+        # overlap-save block: a power of two of about 8 kernels, or a single
+        # block covering the whole input when that is shorter
+        n_fft = 2 ** int(np.ceil(np.log2(8 * self.kernel_size)))
+        return min(n_fft, 2 ** int(np.ceil(np.log2(x_len))))
+
+    def _spectrum(self, n_fft, filters):
+        key = (n_fft, filters.device, filters.dtype)
+        spectrum = self._spectra.get(key)
+        if spectrum is None:
+            # conv1d is a correlation: convolve with the flipped filters
+            spectrum = torch.fft.rfft(torch.flip(filters, dims=[-1]), n=n_fft)
+            self._spectra[key] = spectrum
+        return spectrum
+
+    def _fft_conv1d(self, x, filters):
+        """ F.conv1d(x, filters) by overlap-save FFT convolution. """
+        if self.padding:
+            x = F.pad(x, (self.padding, self.padding))
+        x_len = x.shape[-1]
+        out_len = x_len - self.kernel_size + 1
+        n_fft = self._fft_size(x_len)
+        step = n_fft - self.kernel_size + 1
+        nb_blocks = (out_len + step - 1) // step
+        
+        # (batch, 1, x_len) -> (batch, 1, nb_blocks, n_fft), a strided view
+        x = F.pad(x, (0, (nb_blocks - 1) * step + n_fft - x_len))
+        blocks = x.unfold(-1, n_fft, step)
+        
+        spectrum = self._spectrum(n_fft, filters)
+        # (batch, 1, nb_blocks, freq) x (out_channels, 1, freq)
+        y = torch.fft.irfft(torch.fft.rfft(blocks, n=n_fft) * spectrum, n=n_fft)
+        y = y[..., self.kernel_size - 1:]
+        return y.reshape(y.shape[0], y.shape[1], -1)[..., :out_len]
         
-        return F.conv1d(x, self.filters, stride=self.stride,
+    def forward(self,x):
+        if self._band_pass_key != (self.sample_rate, self.kernel_size):
+            self.band_pass = self._make_band_pass().to(self.band_pass.device)
+            self._band_pass_key = (self.sample_rate, self.kernel_size)
+            self._spectra = {}
+        
+        filters = self.band_pass
+        if filters.dtype != x.dtype:
+            filters = filters.to(x.dtype)
+        
+        if self.use_fft(x):
+            return self._fft_conv1d(x, filters)
+        return F.conv1d(x, filters, stride=self.stride,
                         padding=self.padding, dilation=self.dilation,
                          bias=None, groups=1)
 
 
         
 class Residual_block(nn.Module):
-    def __init__(self, nb_filts, first = False):
+    def __init__(self, nb_filts, first = False, mid_filts = None):
         super(Residual_block, self).__init__()
         self.first = first
+        # channels between conv1 and conv2, nb_filts[1] unless pruned
+        if mid_filts is None:
+            mid_filts = nb_filts[1]
         
         if not self.first:
             self.bn1 = nn.BatchNorm1d(num_features = nb_filts[0])
@@ -92,13 +160,13 @@ class Residual_block(nn.Module):
         self.lrelu = nn.LeakyReLU(negative_slope=0.3)
         
         self.conv1 = nn.Conv1d(in_channels = nb_filts[0],
-			out_channels = nb_filts[1],
+			out_channels = mid_filts,
 			kernel_size = 3,
 			padding = 1,
 			stride = 1)
         
-        self.bn2 = nn.BatchNorm1d(num_features = nb_filts[1])
-        self.conv2 = nn.Conv1d(in_channels = nb_filts[1],
+        self.bn2 = nn.BatchNorm1d(num_features = mid_filts)
+        self.conv2 = nn.Conv1d(in_channels = mid_filts,
 			out_channels = nb_filts[1],
 			padding = 1,
 			kernel_size = 3,
@@ -116,7 +184,8 @@ class Residual_block(nn.Module):
             self.downsample = False
         self.mp = nn.MaxPool1d(3)
         
-    def forward(self, x):
+    def forward(self, x, mask = None):
+        """ mask: optional (batch, 1, time), 0 on the padding after each row """
         identity = x
         if not self.first:
             out = self.bn1(x)
@@ -124,9 +193,15 @@ class Residual_block(nn.Module):
         else:
             out = x
             
+        if mask is not None:
+            # the convolutions have to see zeros past the end, as they
+            # would at the end of an unpadded input
+            x = x * mask
         out = self.conv1(x)
         out = self.bn2(out)
         out = self.lrelu(out)
+        if mask is not None:
+            out = out * mask
         out = self.conv2(out)
         
         if self.downsample:
@@ -155,13 +230,15 @@ class RawNet(nn.Module):
         
         self.first_bn = nn.BatchNorm1d(num_features = d_args['filts'][0])
         self.selu = nn.SELU(inplace=True)
-        self.block0 = nn.Sequential(Residual_block(nb_filts = d_args['filts'][1], first = True))
-        self.block1 = nn.Sequential(Residual_block(nb_filts = d_args['filts'][1]))
-        self.block2 = nn.Sequential(Residual_block(nb_filts = d_args['filts'][2]))
+        # inner width of each of the six blocks, set by prune.py
+        mid_filts = d_args.get('mid_filts') or [None] * 6
+        self.block0 = nn.Sequential(Residual_block(nb_filts = d_args['filts'][1], first = True, mid_filts = mid_filts[0]))
+        self.block1 = nn.Sequential(Residual_block(nb_filts = d_args['filts'][1], mid_filts = mid_filts[1]))
+        self.block2 = nn.Sequential(Residual_block(nb_filts = d_args['filts'][2], mid_filts = mid_filts[2]))
         d_args['filts'][2][0] = d_args['filts'][2][1]
-        self.block3 = nn.Sequential(Residual_block(nb_filts = d_args['filts'][2]))
-        self.block4 = nn.Sequential(Residual_block(nb_filts = d_args['filts'][2]))
-        self.block5 = nn.Sequential(Residual_block(nb_filts = d_args['filts'][2]))
+        self.block3 = nn.Sequential(Residual_block(nb_filts = d_args['filts'][2], mid_filts = mid_filts[3]))
+        self.block4 = nn.Sequential(Residual_block(nb_filts = d_args['filts'][2], mid_filts = mid_filts[4]))
+        self.block5 = nn.Sequential(Residual_block(nb_filts = d_args['filts'][2], mid_filts = mid_filts[5]))
         self.avgpool = nn.AdaptiveAvgPool1d(1)
 
         self.fc_attention0 = self._make_attention_fc(in_features = d_args['filts'][1][-1],
@@ -196,61 +273,88 @@ class RawNet(nn.Module):
         self.sig = nn.Sigmoid()
         self.logsoftmax = nn.LogSoftmax(dim=1)
         
-    def forward(self, x, y = None):
+    def forward(self, x, y = None, lengths = None):
+        """
+        lengths: optional (batch, ) valid samples of each row; the rest of
+                 the row is padding that does not change the outputs, see
+                 min_samples for the shortest valid length
+        """
         #print("start_forward")
         
         nb_samp = x.shape[0]
         len_seq = x.shape[1]
         x=x.view(nb_samp,1,len_seq)
         
+        x = self.front_end(x)
+        if lengths is not None:
+            return self._forward_masked(x, lengths)
+        
+        for block, fc_attention in self.stages():
+            x = self.attention(block(x), fc_attention)
+
+        output_binary, output_multi, _ = self.classify(x)
+      
+        return output_binary, output_multi
+        
+        
+
+    def _forward_masked(self, x, lengths):
+        # valid frames after the valid SincConv and its max pooling
+        frames = torch.div(torch.as_tensor(lengths, device=x.device)
+                           - (self.Sinc_conv.kernel_size - 1), 3,
+                           rounding_mode='floor')
+        for block, fc_attention in self.stages():
+            mask = (torch.arange(x.shape[-1], device=x.device)
+                    < frames[:, None]).unsqueeze(1).to(x.dtype)
+            for layer in block:
+                x = layer(x, mask)
+            # a max pooling window is valid when all of it is
+            frames = torch.div(frames, 3, rounding_mode='floor')
+            x = self.attention(x, fc_attention, frames)
+
+        output_binary, output_multi, _ = self.classify(x, lengths=frames)
+        return output_binary, output_multi
+
+    @property
+    def min_samples(self):
+        """ Shortest input leaving one GRU frame: SincConv, then 7 poolings by 3 """
+        return self.Sinc_conv.kernel_size - 1 + 3 ** 7
+
+    def front_end(self, x):
+        """ (batch, 1, samples) -> (batch, filts[0], frames), one frame per 3 samples """
         x = self.Sinc_conv(x)    
         x = F.max_pool1d(torch.abs(x), 3)
         x = self.first_bn(x)
         x =  self.selu(x)
-        
-        x0 = self.block0(x)
-        y0 = self.avgpool(x0).view(x0.size(0), -1) # torch.Size([batch, filter])
-        y0 = self.fc_attention0(y0)
-        y0 = self.sig(y0).view(y0.size(0), y0.size(1), -1)  # torch.Size([batch, filter, 1])
-        x = x0 * y0 + y0  # (batch, filter, time) x (batch, filter, 1)
-        
-
-        x1 = self.block1(x)
-        y1 = self.avgpool(x1).view(x1.size(0), -1) # torch.Size([batch, filter])
-        y1 = self.fc_attention1(y1)
-        y1 = self.sig(y1).view(y1.size(0), y1.size(1), -1)  # torch.Size([batch, filter, 1])
-        x = x1 * y1 + y1 # (batch, filter, time) x (batch, filter, 1)
-
-        x2 = self.block2(x)
-        y2 = self.avgpool(x2).view(x2.size(0), -1) # torch.Size([batch, filter])
-        y2 = self.fc_attention2(y2)
-        y2 = self.sig(y2).view(y2.size(0), y2.size(1), -1)  # torch.Size([batch, filter, 1])
-        x = x2 * y2 + y2 # (batch, filter, time) x (batch, filter, 1)
-
-        x3 = self.block3(x)
-        y3 = self.avgpool(x3).view(x3.size(0), -1) # torch.Size([batch, filter])
-        y3 = self.fc_attention3(y3)
-        y3 = self.sig(y3).view(y3.size(0), y3.size(1), -1)  # torch.Size([batch, filter, 1])
-        x = x3 * y3 + y3 # (batch, filter, time) x (batch, filter, 1)
-
-        x4 = self.block4(x)
-        y4 = self.avgpool(x4).view(x4.size(0), -1) # torch.Size([batch, filter])
-        y4 = self.fc_attention4(y4)
-        y4 = self.sig(y4).view(y4.size(0), y4.size(1), -1)  # torch.Size([batch, filter, 1])
-        x = x4 * y4 + y4 # (batch, filter, time) x (batch, filter, 1)
-
-        x5 = self.block5(x)
-        y5 = self.avgpool(x5).view(x5.size(0), -1) # torch.Size([batch, filter])
-        y5 = self.fc_attention5(y5)
-        y5 = self.sig(y5).view(y5.size(0), y5.size(1), -1)  # torch.Size([batch, filter, 1])
-        x = x5 * y5 + y5 # (batch, filter, time) x (batch, filter, 1)
-
+        return x
+
+    def classify(self, x, hidden=None, lengths=None):
+        """
+        output_binary, output_multi, hidden = self.classify(x, hidden=None,
+                                                            lengths=None)
+
+        x: (batch, filter, time) output of the last stage
+        hidden: initial GRU state, zeros when None; the returned one is the
+                state after the last frame
+        lengths: optional (batch, ) valid frames of each row; the GRU then
+                 runs on a packed sequence and stops at the last valid frame
+        """
         x = self.bn_before_gru(x)
         x = self.selu(x)
         x = x.permute(0, 2, 1)     #(batch, filt, time) >> (batch, time, filt)
-        self.gru.flatten_parameters()
-        x, _ = self.gru(x)
-        x = x[:,-1,:]
+        if hasattr(self.gru, 'flatten_parameters'):
+            # not available on the dynamically quantized GRU
+            self.gru.flatten_parameters()
+        if lengths is not None:
+            x = nn.utils.rnn.pack_padded_sequence(
+                x, torch.as_tensor(lengths).cpu(), batch_first=True,
+                enforce_sorted=False)
+            _, hidden = self.gru(x, hidden)
+            # last layer, after the last valid frame of each row
+            x = hidden[-1]
+        else:
+            x, hidden = self.gru(x, hidden)
+            x = x[:,-1,:]
 
         x_binary = self.fc1_binary_gru(x)
         x_binary = self.fc2_binary_gru(x_binary)
@@ -261,10 +365,25 @@ class RawNet(nn.Module):
         x_multi = self.fc2_multi_gru(x_multi)
 
         output_multi = self.logsoftmax(x_multi)
-      
-        return output_binary, output_multi
-        
-        
+        return output_binary, output_multi, hidden
+
+    def stages(self):
+        """ (residual block, attention FC) of the six stages, in order """
+        return [(self.block0, self.fc_attention0), (self.block1, self.fc_attention1),
+                (self.block2, self.fc_attention2), (self.block3, self.fc_attention3),
+                (self.block4, self.fc_attention4), (self.block5, self.fc_attention5)]
+
+    def attention(self, x, fc_attention, lengths=None):
+        # (batch, filter, time) -> (batch, filter) -> (batch, filter, 1)
+        if lengths is None:
+            mean = x.mean(dim=-1)
+        else:
+            # mean over the valid frames of each row
+            mask = (torch.arange(x.shape[-1], device=x.device) < lengths[:, None]).to(x.dtype)
+            mean = torch.einsum('bft,bt->bf', x, mask) / lengths[:, None].to(x.dtype)
+        y = self.sig(fc_attention(mean)).unsqueeze(-1)
+        # x * y + y in one kernel
+        return torch.addcmul(y, x, y)
 
     def _make_attention_fc(self, in_features, l_out_features):
 
@@ -290,7 +409,7 @@ class RawNet(nn.Module):
         return nn.Sequential(*layers)
 
     def summary(self, input_size, batch_size=-1, device="cuda", print_fn = None):
-        if print_fn == None: printfn = print
+        if print_fn == None: print_fn = print
         model = self
         
         def register_hook(module):
@@ -311,13 +430,12 @@ class RawNet(nn.Module):
                     if len(summary[m_key]["output_shape"]) != 0:
                         summary[m_key]["output_shape"][0] = batch_size
                         
-                params = 0
-                if hasattr(module, "weight") and hasattr(module.weight, "size"):
-                    params += torch.prod(torch.LongTensor(list(module.weight.size())))
-                    summary[m_key]["trainable"] = module.weight.requires_grad
-                if hasattr(module, "bias") and hasattr(module.bias, "size"):
-                    params += torch.prod(torch.LongTensor(list(module.bias.size())))
-                summary[m_key]["nb_params"] = params
+                # own parameters only (GRU has no .weight), so that the
+                # blocks containing other layers are not counted twice
+                own_params = list(module.parameters(recurse=False))
+                summary[m_key]["nb_params"] = sum(p.numel() for p in own_params)
+                if own_params:
+                    summary[m_key]["trainable"] = any(p.requires_grad for p in own_params)
                 
             if (
 				not isinstance(module, nn.Sequential)
@@ -361,8 +479,29 @@ class RawNet(nn.Module):
 				"{0:,}".format(summary[layer]["nb_params"]),
 			)
             total_params += summary[layer]["nb_params"]
-            total_output += np.prod(summary[layer]["output_shape"])
+            output_shape = summary[layer]["output_shape"]
+            if output_shape and isinstance(output_shape[0], list):
+                total_output += sum(abs(np.prod(shape)) for shape in output_shape)
+            else:
+                total_output += abs(np.prod(output_shape))
             if "trainable" in summary[layer]:
                 if summary[layer]["trainable"] == True:
                     trainable_params += summary[layer]["nb_params"]
             print_fn(line_new)
+
+        # assume 4 bytes/number (float on cuda).
+        total_input_size = abs(np.prod(input_size) * batch_size * 4. / (1024 ** 2.))
+        total_output_size = abs(2. * total_output * 4. / (1024 ** 2.))  # x2 for gradients
+        total_params_size = abs(total_params * 4. / (1024 ** 2.))
+        total_size = total_params_size + total_output_size + total_input_size
+
+        print_fn("================================================================")
+        print_fn("Total params: {0:,}".format(total_params))
+        print_fn("Trainable params: {0:,}".format(trainable_params))
+        print_fn("Non-trainable params: {0:,}".format(total_params - trainable_params))
+        print_fn("----------------------------------------------------------------")
+        print_fn("Input size (MB): %0.2f" % total_input_size)
+        print_fn("Forward/backward pass size (MB): %0.2f" % total_output_size)
+        print_fn("Params size (MB): %0.2f" % total_params_size)
+        print_fn("Estimated Total Size (MB): %0.2f" % total_size)
+        print_fn("----------------------------------------------------------------")
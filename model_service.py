@@ -1,35 +1,486 @@
-import subprocess
-import sys
-import re
+import gc
+import os
+import threading
+import time
+
+import numpy as np
+import yaml
+
+# torch is optional when serving through onnxruntime
+try:
+    import torch
+except ImportError:
+    torch = None
+
+from eval import load_audio, resample, segment
+from batch_scheduler import BatchScheduler
+from result_cache import ResultCache, file_checksum
+from early_exit import (EARLY_EXIT_DELTA, EARLY_EXIT_ORDER, EARLY_EXIT_BATCH,
+                        SEGMENT_ORDERS, decided, segment_order)
+from metrics import (BATCH_SIZES, CACHE_REQUESTS, CASCADE, MODEL_LOAD_SECONDS,
+                     QUEUE_DEPTH, SEGMENTS_SCORED, instrument_model, timer)
+from replica_pool import REPLICAS, REPLICA_THREADS, REPLICA_CPUS, ReplicaPool
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_PATH = os.environ.get("ECHOWIPE_MODEL_PATH",
+                            os.path.join(BASE_DIR, "model_detection.pth"))
+CONFIG_PATH = os.environ.get("ECHOWIPE_MODEL_CONFIG",
+                             os.path.join(BASE_DIR, "model_config_RawNet.yaml"))
+# micro-batching of concurrent requests, 0 disables it
+MAX_BATCH_SIZE = int(os.environ.get("ECHOWIPE_MAX_BATCH_SIZE", "16"))
+MAX_WAIT_MS = float(os.environ.get("ECHOWIPE_MAX_WAIT_MS", "10"))
+# segments per forward when a single file is scored on its own
+BATCH_SIZE = int(os.environ.get("ECHOWIPE_BATCH_SIZE", "32"))
+# score uploads shorter than a segment at their own length instead of
+# repeat-padding them to 4 s; the micro-batcher groups them into length
+# buckets of LENGTH_BUCKET samples, padded with a mask
+VARIABLE_LENGTH = os.environ.get("ECHOWIPE_VARIABLE_LENGTH", "0") == "1"
+LENGTH_BUCKET = int(os.environ.get("ECHOWIPE_LENGTH_BUCKET", "24000"))
+# "dynamic" quantizes a float checkpoint to int8 at load time;
+# checkpoints written by quantize.py are recognised without it
+QUANTIZE = os.environ.get("ECHOWIPE_QUANTIZE") or None
+# "torch": RawNet from model.py and a state dict
+# "torchscript" / "onnx": artifacts written by export_model.py
+BACKEND = os.environ.get("ECHOWIPE_BACKEND", "torch")
+BACKENDS = ("torch", "torchscript", "onnx")
+# intra-op threads of the onnxruntime session, 0 lets onnxruntime decide
+ORT_THREADS = int(os.environ.get("ECHOWIPE_ORT_THREADS", "0"))
+# result cache: in-memory LRU entries (0 disables), ttl in seconds and an
+# optional sqlite file shared by the workers of a node
+CACHE_SIZE = int(os.environ.get("ECHOWIPE_CACHE_SIZE", "1024"))
+CACHE_TTL = float(os.environ.get("ECHOWIPE_CACHE_TTL", "86400"))
+CACHE_DB = os.environ.get("ECHOWIPE_CACHE_DB") or None
+CACHE_DB_SIZE = int(os.environ.get("ECHOWIPE_CACHE_DB_SIZE", "100000"))
+
+# pre-fork sharing: with ECHOWIPE_PRELOAD=1, app.py loads the engine at
+# import, i.e. once in the master under gunicorn --preload, and the
+# workers share its weight pages copy-on-write (CPU only)
+PRELOAD = os.environ.get("ECHOWIPE_PRELOAD", "0") == "1"
+# map the checkpoint file and use its pages as the weights instead of
+# copying them; processes loading the same file share the page cache
+MMAP_WEIGHTS = os.environ.get("ECHOWIPE_MMAP_WEIGHTS", "0") == "1"
+
+# cascade: a small screener RawNet answers the uploads it is sure about,
+# see cascade.py; unset serves the full model only
+SCREENER_PATH = os.environ.get("ECHOWIPE_SCREENER_PATH") or None
+SCREENER_CONFIG = os.environ.get(
+    "ECHOWIPE_SCREENER_CONFIG",
+    os.path.join(BASE_DIR, "model_config_RawNet_small.yaml"))
+
+# order of the outputs of fc2_multi_gru
+MULTI_LABELS = ["gt", "wavegrad", "diffwave", "parallel wave gan",
+                "wavernn", "wavenet", "melgan"]
+
+
+class DetectionEngine:
+    """
+    Long-lived RawNet detector.
+
+    The config is parsed and the checkpoint is loaded once, in the
+    constructor; every call to detect() afterwards is a plain forward pass.
+    With max_batch_size set, segments of concurrent detect() calls are
+    coalesced into shared forwards by a BatchScheduler. With a cache, a
+    waveform that was scored before is answered without running the model.
+    With early_exit_delta set, segments are scored in the given order and
+    scoring stops once the decision is settled, see early_exit.
+    With variable_length set, uploads shorter than a segment are scored at
+    their own length (at least RawNet.min_samples) rather than
+    repeat-padded to 96000 samples; torch backend only.
+    With mmap set, the float weights of the torch backend are the pages of
+    the memory-mapped checkpoint (which needs the zip format of
+    torch.save).
+    With replicas set, forwards run on a ReplicaPool of that many CPU
+    processes with replica_threads threads each, pinned to replica_cpus,
+    and the micro-batcher runs one batch per replica at a time; the model
+    of this process is then only loaded when engine.model is first used
+    (stateful streaming).
+    """
+
+    def __init__(self, model_path=MODEL_PATH, config_path=CONFIG_PATH,
+                 device=None, batch_size=BATCH_SIZE, max_batch_size=None,
+                 max_wait_ms=MAX_WAIT_MS, quantize=None, backend="torch",
+                 cache=None, early_exit_delta=None,
+                 segment_order=EARLY_EXIT_ORDER,
+                 early_exit_batch=EARLY_EXIT_BATCH, variable_length=False,
+                 bucket_size=LENGTH_BUCKET, mmap=False, replicas=0,
+                 replica_threads=0, replica_cpus=None):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend {}".format(backend))
+        if segment_order not in SEGMENT_ORDERS:
+            raise ValueError("Unknown segment order {}".format(segment_order))
+        if device is None:
+            device = 'cuda' if torch is not None and torch.cuda.is_available() \
+                else 'cpu'
+        self.device = device
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.backend = backend
+        self.early_exit_delta = early_exit_delta or None
+        self.segment_order = segment_order
+        self.early_exit_batch = early_exit_batch
+
+        self._model = None
+        self._model_args = (model_path, config_path, quantize, mmap)
+        self._model_lock = threading.Lock()
+        self.session = None
+        if backend == "onnx":
+            start = time.perf_counter()
+            self.device = 'cpu'
+            self.session = self._load_onnx(model_path)
+            MODEL_LOAD_SECONDS.set(time.perf_counter() - start,
+                                   model=os.path.basename(model_path))
+        elif not replicas:
+            # the replicas hold their own copy, see the model property
+            self._model = self._load_model(*self._model_args)
+
+        self.min_len = None
+        if variable_length:
+            self.min_len = self._min_len(config_path) if replicas \
+                else self._min_len()
+
+        # identifies the weights and how they are run, see ResultCache
+        self.model_key = "{}:{}:{}".format(file_checksum(model_path), backend,
+                                           quantize or "float")
+        if self.early_exit_delta:
+            self.model_key += ":early_exit:{}:{}".format(self.early_exit_delta,
+                                                         segment_order)
+        if variable_length:
+            self.model_key += ":variable_length"
+        self.cache = cache
+
+        self.pool = None
+        if replicas:
+            if str(self.device).startswith('cuda'):
+                raise ValueError("Replicas run on CPU only")
+            self.pool = ReplicaPool(
+                replicas, replica_threads, replica_cpus,
+                model_path=model_path, config_path=config_path,
+                quantize=quantize, backend=backend, mmap=mmap,
+                variable_length=variable_length)
+
+        self.scheduler = None
+        if max_batch_size:
+            self.scheduler = BatchScheduler(self.forward, max_batch_size,
+                                            max_wait_ms, bucket_size,
+                                            num_workers=max(replicas, 1))
+
+    @property
+    def model(self):
+        """ The torch model (None with onnx), loaded on first use with replicas. """
+        if self._model is None and self.session is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = self._load_model(*self._model_args)
+        return self._model
+
+    def _load_model(self, model_path, config_path, quantize, mmap):
+        start = time.perf_counter()
+        if self.backend == "torchscript":
+            # self-contained graph, model.py is not needed
+            model = torch.jit.load(model_path, map_location=self.device).eval()
+        else:
+            model = self._load_rawnet(model_path, config_path,
+                                      quantize, mmap).eval()
+            instrument_model(model)
+        MODEL_LOAD_SECONDS.set(time.perf_counter() - start,
+                               model=os.path.basename(model_path))
+        return model
+
+    def _min_len(self, config_path=None):
+        from model import Residual_block
+
+        if config_path is not None:
+            # replicas check their own model (they run with variable_length
+            # too); the shortest length only depends on the architecture
+            from model import RawNet
+
+            if self.backend != "torch":
+                raise ValueError("variable_length needs the torch backend")
+            with open(config_path, 'r') as f_yaml:
+                config = yaml.safe_load(f_yaml)
+            return RawNet(config['model'], 'cpu').min_samples
+        # masking needs the float Residual_block stages of model.py
+        if self.backend != "torch" or not all(
+                isinstance(module, Residual_block)
+                for block, _ in self.model.stages()
+                for module in block.children()):
+            raise ValueError("variable_length needs the torch backend "
+                             "without static quantization")
+        return self.model.min_samples
+
+    def _load_rawnet(self, model_path, config_path, quantize, mmap=False):
+        from model import RawNet
+        from quantize import (quantize_model, load_quantized,
+                              is_quantized_checkpoint)
+
+        with open(config_path, 'r') as f_yaml:
+            self.config = yaml.safe_load(f_yaml)
+
+        # quantized checkpoints hold packed params, not only tensors
+        checkpoint = torch.load(model_path, map_location='cpu',
+                                weights_only=False, mmap=mmap)
+        model = RawNet(self.config['model'], self.device)
+        if quantize or is_quantized_checkpoint(checkpoint):
+            # int8 kernels are CPU only
+            self.device = model.device = model.Sinc_conv.device = 'cpu'
+        if is_quantized_checkpoint(checkpoint):
+            return load_quantized(model, checkpoint)
+        # assign keeps the mapped tensors instead of copying them into the
+        # freshly initialised ones
+        model.load_state_dict(checkpoint, assign=mmap)
+        model = model.to(self.device)
+        if quantize:
+            model = quantize_model(model.eval(), quantize)
+        return model
+
+    def _load_onnx(self, model_path):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = \
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = ORT_THREADS
+        return onnxruntime.InferenceSession(
+            model_path, options, providers=['CPUExecutionProvider'])
+
+    def forward(self, batch, lengths=None):
+        """
+        probs_binary, probs_multi = engine.forward(batch, lengths=None)
+
+        batch: (batch, length) float32 array of 24 kHz segments
+        lengths: optional (batch, ) valid samples of each row, the rest is
+                 padding (variable_length only)
+        probs_binary, probs_multi: (batch, 2) and (batch, 7) arrays
+        """
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        BATCH_SIZES.observe(len(batch))
+        SEGMENTS_SCORED.inc(len(batch))
+        with timer("forward"):
+            return self._forward(batch, lengths)
+
+    def _forward(self, batch, lengths=None):
+        if self.pool is not None:
+            return self.pool.forward(batch, lengths)
+        if self.session is not None:
+            logits, multi_logits = self.session.run(None, {"waveform": batch})
+        else:
+            with torch.no_grad():
+                x = torch.from_numpy(batch).to(self.device)
+                if lengths is None:
+                    outputs = self.model(x)
+                else:
+                    outputs = self.model(x, lengths=torch.as_tensor(lengths))
+            logits, multi_logits = [out.cpu().numpy() for out in outputs]
+        return softmax(logits), softmax(multi_logits)
+
+    def detect(self, audio, sr=None, progress=None):
+        """
+        result = engine.detect(audio, sr=None, progress=None)
+
+        audio: path to an audio file, or a 1-D float waveform
+        sr: sampling rate of the waveform (ignored for paths)
+        progress: optional callable, progress(scored, total, partial), called
+                  after every batch_size segments with the result dict of
+                  the segments scored so far
+
+        result: dict with the averaged binary probabilities ("fake", "real"),
+                the 7-way vocoder probabilities ("multi", keyed by
+                MULTI_LABELS), the "label", the number of "segments",
+                with early exit the number of segments "evaluated" and,
+                when a cache is set, "cache": "hit" or "miss"
+        """
+        with timer("detect"):
+            return self._detect(audio, sr, progress)
+
+    def _detect(self, audio, sr=None, progress=None):
+        if isinstance(audio, (str, os.PathLike)):
+            with timer("decode"):
+                waveform = load_audio(audio)
+        else:
+            with timer("resample"):
+                waveform = resample(np.asarray(audio, dtype=np.float32), sr)
+        waveform = np.ascontiguousarray(waveform, dtype=np.float32)
+
+        if self.cache is not None:
+            key = self.cache.key(waveform)
+            result = self.cache.get(key)
+            CACHE_REQUESTS.inc(result="miss" if result is None else "hit")
+            if result is not None:
+                return dict(result, cache="hit")
+
+        with timer("segment"):
+            segments = segment(waveform, min_len=self.min_len)
+        if progress is None and self.early_exit_delta is None:
+            probs_binary, probs_multi = self.score(segments)
+        else:
+            probs_binary, probs_multi = self.score_progressive(segments,
+                                                               progress)
+        with timer("aggregate"):
+            result = build_result(probs_binary.mean(axis=0),
+                                  probs_multi.mean(axis=0), len(segments))
+        if self.early_exit_delta is not None:
+            result["evaluated"] = len(probs_binary)
+        if self.cache is not None:
+            self.cache.put(key, result)
+            result = dict(result, cache="miss")
+        return result
+
+    def score(self, segments):
+        """
+        probs_binary, probs_multi = engine.score(segments)
+
+        segments: (num_segments, length) array
+
+        Segments go through the BatchScheduler when it is enabled, otherwise
+        through chunks of at most batch_size segments per forward.
+        """
+        if self.scheduler is not None:
+            return self.scheduler.submit(segments).result()
+        outputs = [self.forward(segments[start:start + self.batch_size])
+                   for start in range(0, len(segments), self.batch_size)]
+        return (np.concatenate([probs for probs, _ in outputs]),
+                np.concatenate([probs for _, probs in outputs]))
+
+    def score_progressive(self, segments, progress=None):
+        """
+        probs_binary, probs_multi = engine.score_progressive(segments,
+                                                             progress=None)
+
+        Same as score(), in chunks of batch_size segments; progress is
+        called after each chunk, see detect(). With early exit, chunks of
+        early_exit_batch segments follow segment_order and only the
+        segments scored before the decision settled are returned.
+        """
+        num_segments = len(segments)
+        if self.early_exit_delta is None:
+            order, chunk = None, self.batch_size
+        else:
+            order = segment_order(num_segments, self.segment_order)
+            chunk = self.early_exit_batch
+        outputs_binary, outputs_multi = [], []
+        sum_binary, sum_multi = 0.0, 0.0
+        for check, start in enumerate(range(0, num_segments, chunk), 1):
+            if order is None:
+                batch = segments[start:start + chunk]
+            else:
+                batch = segments[order[start:start + chunk]]
+            probs_binary, probs_multi = self.score(batch)
+            outputs_binary.append(probs_binary)
+            outputs_multi.append(probs_multi)
+            sum_binary = sum_binary + probs_binary.sum(axis=0)
+            sum_multi = sum_multi + probs_multi.sum(axis=0)
+            scored = start + len(probs_binary)
+            if progress is not None:
+                progress(scored, num_segments,
+                         build_result(sum_binary / scored, sum_multi / scored,
+                                      scored))
+            if self.early_exit_delta is not None and decided(
+                    sum_binary[0] / scored, scored, num_segments, check,
+                    self.early_exit_delta):
+                break
+        return np.concatenate(outputs_binary), np.concatenate(outputs_multi)
+
+
+def softmax(logits):
+    # the models output log-softmax, softmax of it gives the probabilities
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    probs = np.exp(logits)
+    return probs / probs.sum(axis=-1, keepdims=True)
+
+
+def build_result(result_binary, result_multi, num_segments):
+    fake, real = float(result_binary[0]), float(result_binary[1])
+    return {
+        "fake": fake,
+        "real": real,
+        "label": "FAKE (AI)" if fake > real else "REAL",
+        "multi": {name: float(p) for name, p in zip(MULTI_LABELS, result_multi)},
+        "segments": num_segments,
+    }
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def _attach_cache(engine):
+    if CACHE_SIZE or CACHE_DB:
+        engine.cache = ResultCache(
+            engine.model_key, max_entries=CACHE_SIZE, ttl=CACHE_TTL,
+            db_path=CACHE_DB, max_disk_entries=CACHE_DB_SIZE)
+    return engine
+
+
+def _register_gauges(engine):
+    screener = getattr(engine, "screener", None)
+    for name, detector in [("batcher", getattr(engine, "full", engine)),
+                           ("screener_batcher", screener)]:
+        if detector is not None and detector.scheduler is not None:
+            QUEUE_DEPTH.set_function(detector.scheduler.depth, queue=name)
+    if screener is not None:
+        for stat in ["requests", "escalated", "screener_seconds",
+                     "full_seconds", "escalation_rate"]:
+            CASCADE.set_function(lambda stat=stat: engine.stats()[stat],
+                                 stat=stat)
+
+
+def get_engine():
+    """
+    Return the per-process DetectionEngine, loading it on first use; a
+    CascadeEngine in front of it when ECHOWIPE_SCREENER_PATH is set.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = _attach_cache(DetectionEngine(
+                    max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                    quantize=QUANTIZE, backend=BACKEND,
+                    early_exit_delta=EARLY_EXIT_DELTA,
+                    segment_order=EARLY_EXIT_ORDER,
+                    variable_length=VARIABLE_LENGTH, mmap=MMAP_WEIGHTS,
+                    replicas=REPLICAS, replica_threads=REPLICA_THREADS,
+                    replica_cpus=REPLICA_CPUS))
+                if SCREENER_PATH is not None:
+                    from cascade import CascadeEngine, CASCADE_BAND, parse_band
+
+                    screener = _attach_cache(DetectionEngine(
+                        model_path=SCREENER_PATH, config_path=SCREENER_CONFIG,
+                        max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                        mmap=MMAP_WEIGHTS))
+                    engine = CascadeEngine(screener, engine,
+                                           parse_band(CASCADE_BAND))
+                _register_gauges(engine)
+                _engine = engine
+    return _engine
+
+
+def preload_engine():
+    """
+    engine = preload_engine()
+
+    Load the per-process engine before the gunicorn workers are forked
+    (app.py with ECHOWIPE_PRELOAD=1 under gunicorn --preload). Nothing
+    writes to the weights afterwards, so their pages stay shared. The
+    objects alive at this point are also moved out of reach of the
+    garbage collector, whose bookkeeping would otherwise write to (and
+    un-share) the pages holding them in every worker.
+    """
+    engine = get_engine()
+    if str(engine.device).startswith('cuda'):
+        raise RuntimeError("ECHOWIPE_PRELOAD needs a CPU engine, "
+                           "CUDA cannot be used after fork()")
+    gc.collect()
+    gc.freeze()
+    return engine
 
-MODEL_PATH = r"model_detection.pth"
-EVAL_SCRIPT = r"eval.py"
 
 def detect_voice(audio_path):
-    command = [
-        sys.executable,
-        EVAL_SCRIPT,
-        "--input_path", audio_path,
-        "--model_path", MODEL_PATH
-    ]
-
-    try:
-        result = subprocess.run(
-            command,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-
-        output = result.stdout
-        print("MODEL OUTPUT:\n", output)
-
-        fake = float(re.search(r"fake:\s*([0-9.]+)", output).group(1))
-        real = float(re.search(r"real:\s*([0-9.]+)", output).group(1))
-
-        return fake, real, output
-
-    except subprocess.CalledProcessError as e:
-        print("❌ MODEL ERROR OUTPUT:\n", e.stdout)
-        print("❌ MODEL STDERR:\n", e.stderr)
-        raise RuntimeError(e.stderr)
+    """
+    fake, real, result = detect_voice(audio_path)
+
+    Kept for callers of the old subprocess-based API; result is the dict
+    returned by DetectionEngine.detect.
+    """
+    result = get_engine().detect(audio_path)
+    return result["fake"], result["real"], result
@@ -0,0 +1,267 @@
+"""
+profiler
+
+Per-layer profile of a RawNet forward pass, using forward hooks like
+RawNet.summary: FLOPs, wall time averaged over several runs, activation
+memory and the share of the total of each, for every leaf module and for
+the stages they belong to (SincConv, the six residual/attention stages,
+the GRU and the two heads).
+
+FLOPs are 2 x the multiply-accumulates of SincConv, Conv1d, Linear and
+GRU layers (SincConv on its FFT path is counted as the FFTs and spectrum
+products it runs); element-wise layers (BatchNorm, activations, pooling)
+count as 0. Activation memory is the size of the outputs a layer produces
+in one forward pass. Time spent outside any module (abs, max_pool1d, the
+attention product, permute) is reported as "unattributed".
+
+Usage:
+  python profiler.py --model_path model_detection.pth --batch_sizes 1 8 \
+      --lengths 96000 --runs 10 --json profile.json --csv profile.csv
+"""
+import argparse
+import copy
+import csv
+import json
+import math
+import time
+from collections import OrderedDict
+
+import torch
+import yaml
+from torch import nn
+
+from model import RawNet, SincConv
+
+
+def module_macs(module, inputs, output):
+    """ Multiply-accumulates of one call of a layer, 0 for element-wise ones. """
+    if isinstance(output, (list, tuple)):
+        output = output[0]
+    if isinstance(module, SincConv):
+        if module.use_fft(inputs[0]):
+            return _fft_conv_macs(module, inputs[0], output)
+        return module.out_channels * module.kernel_size * output.shape[-1] * output.shape[0]
+    if isinstance(module, nn.Conv1d):
+        return (output.shape[1] * module.in_channels // module.groups
+                * module.kernel_size[0] * output.shape[-1] * output.shape[0])
+    if isinstance(module, nn.Linear):
+        return module.in_features * module.out_features * (output.numel() // output.shape[-1])
+    if isinstance(module, nn.GRU):
+        batch, steps = inputs[0].shape[:2]
+        macs = 0
+        for layer in range(module.num_layers):
+            in_size = module.input_size if layer == 0 else module.hidden_size
+            macs += 3 * (in_size + module.hidden_size) * module.hidden_size * steps * batch
+        return macs
+    return 0
+
+
+def _fft_conv_macs(module, x, output):
+    # overlap-save: one rfft per block, then per filter a complex product
+    # and an irfft, at about 2.5 n log2(n) FLOPs per real FFT
+    n_fft = module._fft_size(x.shape[-1] + 2 * module.padding)
+    step = n_fft - module.kernel_size + 1
+    nb_blocks = (output.shape[-1] + step - 1) // step
+    fft_flops = 2.5 * n_fft * math.log2(n_fft)
+    flops = nb_blocks * (fft_flops + module.out_channels * (6 * (n_fft // 2 + 1) + fft_flops))
+    return int(flops * x.shape[0]) // 2
+
+
+def _output_bytes(output):
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    if isinstance(output, (list, tuple)):
+        return sum(_output_bytes(o) for o in output)
+    return 0
+
+
+def stage_of(name):
+    """ Stage a module belongs to, from its name in RawNet. """
+    top = name.split('.')[0]
+    if top == 'Sinc_conv':
+        return 'sinc_conv'
+    for prefix in ['block', 'fc_attention']:
+        if top.startswith(prefix):
+            return 'stage' + top[len(prefix):]
+    if top in ['bn_before_gru', 'gru']:
+        return 'gru'
+    if top.startswith('fc1_') or top.startswith('fc2_'):
+        return 'heads'
+    return 'other'
+
+
+def profile_model(model, batch_size=1, length=96000, runs=10, device='cpu'):
+    """
+    profile = profile_model(model, batch_size=1, length=96000, runs=10)
+
+    profile: dict with the totals of one forward pass of a
+             (batch_size, length) input, a "layers" list with one entry
+             per leaf module and a "stages" list
+    """
+    model.eval()
+    cuda = str(device).startswith('cuda')
+    layers = OrderedDict()
+    timing = [False]
+    starts = {}
+
+    def sync():
+        if cuda:
+            torch.cuda.synchronize()
+
+    def pre_hook(module, inputs):
+        if timing[0]:
+            sync()
+            starts[module] = time.perf_counter()
+
+    def make_hook(name):
+        def hook(module, inputs, output):
+            entry = layers[name]
+            if timing[0]:
+                sync()
+                entry['seconds'] += time.perf_counter() - starts.pop(module)
+            else:
+                # shapes, FLOPs and memory of the untimed pass
+                entry['calls'] += 1
+                entry['flops'] += 2 * module_macs(module, inputs, output)
+                entry['activation_bytes'] += _output_bytes(output)
+                out = output[0] if isinstance(output, (list, tuple)) else output
+                entry['output_shape'] = list(out.shape)
+        return hook
+
+    hooks = []
+    for name, module in model.named_modules():
+        if name and not list(module.children()):
+            layers[name] = {
+                'layer': name, 'type': module.__class__.__name__,
+                'stage': stage_of(name), 'output_shape': None,
+                'params': sum(p.numel() for p in module.parameters()),
+                'calls': 0, 'flops': 0, 'activation_bytes': 0, 'seconds': 0.0}
+            hooks.append(module.register_forward_pre_hook(pre_hook))
+            hooks.append(module.register_forward_hook(make_hook(name)))
+
+    x = torch.randn(batch_size, length).to(device)
+    try:
+        with torch.no_grad():
+            # first pass: warm-up, shapes and counts
+            model(x)
+            timing[0] = True
+            total = 0.0
+            for _ in range(runs):
+                sync()
+                start = time.perf_counter()
+                model(x)
+                sync()
+                total += time.perf_counter() - start
+    finally:
+        for h in hooks:
+            h.remove()
+
+    total_ms = 1000 * total / runs
+    total_flops = sum(entry['flops'] for entry in layers.values())
+    total_bytes = sum(entry['activation_bytes'] for entry in layers.values())
+
+    def finish(entry):
+        entry['time_ms'] = 1000 * entry.pop('seconds') / runs
+        entry['activation_mb'] = entry.pop('activation_bytes') / 2.0 ** 20
+        entry['flops_pct'] = 100.0 * entry['flops'] / max(total_flops, 1)
+        entry['time_pct'] = 100.0 * entry['time_ms'] / total_ms
+        entry['activation_pct'] = 100.0 * entry['activation_mb'] * 2 ** 20 / max(total_bytes, 1)
+        return entry
+
+    stages = OrderedDict()
+    for entry in layers.values():
+        stage = stages.setdefault(entry['stage'], {
+            'stage': entry['stage'], 'params': 0, 'flops': 0,
+            'activation_bytes': 0, 'seconds': 0.0})
+        for key in ['params', 'flops', 'activation_bytes', 'seconds']:
+            stage[key] += entry[key]
+    layers = [finish(entry) for entry in layers.values() if entry['calls']]
+    stages = [finish(stage) for stage in stages.values()]
+    attributed = sum(stage['time_ms'] for stage in stages)
+    return {
+        'batch_size': batch_size,
+        'length': length,
+        'runs': runs,
+        'device': str(device),
+        'params': sum(p.numel() for p in model.parameters()),
+        'flops': total_flops,
+        'activation_mb': total_bytes / 2.0 ** 20,
+        'time_ms': total_ms,
+        'unattributed_ms': max(total_ms - attributed, 0.0),
+        'layers': layers,
+        'stages': stages,
+    }
+
+
+def print_profile(profile, print_fn=print):
+    print_fn('batch {} x {} samples on {}: {:.2f} GFLOPs, {:.1f} MB activations, '
+             '{:.2f} ms ({:.2f} ms unattributed)'.format(
+                 profile['batch_size'], profile['length'], profile['device'],
+                 profile['flops'] / 1e9, profile['activation_mb'],
+                 profile['time_ms'], profile['unattributed_ms']))
+    line = '{:>34} {:>14} {:>10} {:>9} {:>7} {:>9} {:>7} {:>9} {:>7}'
+    print_fn(line.format('Layer (type)', 'Output Shape', 'Param #', 'GFLOPs', '%',
+                         'ms', '%', 'MB', '%'))
+    rows = [(entry['layer'] + ' (' + entry['type'] + ')', str(entry['output_shape']), entry)
+            for entry in profile['layers']] + \
+        [(stage['stage'], '', stage) for stage in profile['stages']]
+    for name, shape, entry in rows:
+        print_fn('{:>34} {:>14} {:>10,} {:>9.3f} {:>7.1f} {:>9.3f} {:>7.1f} {:>9.2f} {:>7.1f}'.format(
+            name[-34:], shape, entry['params'], entry['flops'] / 1e9, entry['flops_pct'],
+            entry['time_ms'], entry['time_pct'], entry['activation_mb'],
+            entry['activation_pct']))
+
+
+def write_csv(profiles, path):
+    """ One row per layer and per stage of every profile. """
+    fields = ['batch_size', 'length', 'kind', 'name', 'type', 'stage', 'output_shape',
+              'params', 'calls', 'flops', 'flops_pct', 'time_ms', 'time_pct',
+              'activation_mb', 'activation_pct']
+    with open(path, 'w', newline='') as f_csv:
+        writer = csv.DictWriter(f_csv, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        for profile in profiles:
+            common = {'batch_size': profile['batch_size'], 'length': profile['length']}
+            for entry in profile['layers']:
+                writer.writerow(dict(entry, kind='layer', name=entry['layer'], **common))
+            for stage in profile['stages']:
+                writer.writerow(dict(stage, kind='stage', name=stage['stage'], **common))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default=None,
+                        help='Checkpoint, random weights when not given')
+    parser.add_argument('--config_path', type=str, default='model_config_RawNet.yaml')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--batch_sizes', type=int, nargs='*', default=[1])
+    parser.add_argument('--lengths', type=int, nargs='*', default=[96000],
+                        help='Input lengths in samples at 24 kHz')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--json', type=str, default=None)
+    parser.add_argument('--csv', type=str, default=None)
+    args = parser.parse_args()
+
+    with open(args.config_path, 'r') as f_yaml:
+        config = yaml.safe_load(f_yaml)
+    model = RawNet(copy.deepcopy(config['model']), args.device)
+    if args.model_path is not None:
+        model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+    model = model.to(args.device).eval()
+
+    profiles = []
+    for batch_size in args.batch_sizes:
+        for length in args.lengths:
+            profile = profile_model(model, batch_size, length, args.runs, args.device)
+            print_profile(profile)
+            print()
+            profiles.append(profile)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f_json:
+            json.dump({'model_path': args.model_path, 'config_path': args.config_path,
+                       'model': config['model'], 'profiles': profiles}, f_json, indent=2)
+        print('Profile written to {}'.format(args.json))
+    if args.csv is not None:
+        write_csv(profiles, args.csv)
+        print('Profile written to {}'.format(args.csv))
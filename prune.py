@@ -0,0 +1,295 @@
+"""
+prune
+
+Structured channel pruning of a trained RawNet.
+
+Channels are scored from the weights that read and write them, and the
+lowest-scoring ones are removed, giving a smaller dense RawNet and the
+matching config. Three kinds of channel groups are pruned:
+
+  inner      the channels between conv1 and conv2 of each Residual_block
+             (bn2 included), independent per block; stored in the config
+             as model.mid_filts
+  stream     the 128 channels shared by block2..block5 through their
+             residual connections, the attention FCs 2..5, bn_before_gru
+             and the GRU input features; stored as filts[2][1] / filts[3]
+  gru        the hidden units of each GRU layer, read by the next layer
+             or by fc1_binary_gru / fc1_multi_gru; stored as gru_node,
+             so every layer keeps the same number
+
+The 20 SincConv channels are left alone: the filter bank is derived from
+its size, so dropping filters would change the remaining ones.
+
+Usage:
+  python prune.py --model_path model_detection.pth --ratios 0.25 0.5 0.75 \
+      --output_dir pruned --data_path /path/to/LibriSeVoc --limit 200 \
+      --finetune_epochs 3
+"""
+import argparse
+import copy
+import csv
+import os
+import subprocess
+import sys
+
+import numpy as np
+import torch
+import yaml
+from torch import nn
+
+from model import RawNet, SincConv
+from profiler import module_macs
+
+STREAM_BLOCKS = ['block2', 'block3', 'block4', 'block5']
+STREAM_ATTENTION = ['fc_attention2', 'fc_attention3', 'fc_attention4', 'fc_attention5']
+
+
+def _l1(weight, dim):
+    # L1 norm of every slice along dim
+    dims = [d for d in range(weight.dim()) if d != dim]
+    return weight.detach().abs().sum(dim=dims).cpu().numpy()
+
+
+def _normalized(score):
+    return score / max(float(score.sum()), 1e-12)
+
+
+def channel_scores(model):
+    """
+    scores = channel_scores(model)
+
+    scores: dict, "inner" a list of six arrays (one score per inner
+            channel of block0..block5), "stream" one array over the
+            shared channels of block2..block5, "gru" one array per GRU
+            layer over its hidden units
+    """
+    inner = []
+    for block, _ in model.stages():
+        block = block[0]
+        # bn2 scale times what conv2 reads from the channel
+        scale = block.bn2.weight.detach().abs() / torch.sqrt(
+            block.bn2.running_var + block.bn2.eps)
+        inner.append(scale.cpu().numpy() * _l1(block.conv2.weight, 1))
+
+    terms = []
+    for name in STREAM_BLOCKS:
+        block = getattr(model, name)[0]
+        terms.append(_l1(block.conv2.weight, 0))
+        if block.downsample:
+            terms.append(_l1(block.conv_downsample.weight, 0))
+        else:
+            terms.append(_l1(block.conv1.weight, 1))
+    for name in STREAM_ATTENTION:
+        fc = getattr(model, name)[0]
+        terms.append(_l1(fc.weight, 0))
+        terms.append(_l1(fc.weight, 1))
+    terms.append(np.abs(model.bn_before_gru.weight.detach().cpu().numpy()))
+    terms.append(_l1(model.gru.weight_ih_l0, 1))
+    stream = sum(_normalized(term) for term in terms)
+
+    gru = []
+    for layer in range(model.gru.num_layers):
+        # what the unit writes: its rows of the r, z and n gates
+        rows = _l1(getattr(model.gru, 'weight_ih_l{}'.format(layer)), 0) \
+            + _l1(getattr(model.gru, 'weight_hh_l{}'.format(layer)), 0)
+        terms = [rows.reshape(3, -1).sum(axis=0),
+                 _l1(getattr(model.gru, 'weight_hh_l{}'.format(layer)), 1)]
+        if layer + 1 < model.gru.num_layers:
+            terms.append(_l1(getattr(model.gru, 'weight_ih_l{}'.format(layer + 1)), 1))
+        else:
+            terms.append(_l1(model.fc1_binary_gru.weight, 1))
+            terms.append(_l1(model.fc1_multi_gru.weight, 1))
+        gru.append(sum(_normalized(term) for term in terms))
+    return {"inner": inner, "stream": stream, "gru": gru}
+
+
+def _keep(score, ratio, minimum=2):
+    num_keep = max(int(round(len(score) * (1 - ratio))), min(minimum, len(score)))
+    # strongest channels, in their original order
+    return np.sort(np.argsort(-score, kind='stable')[:num_keep])
+
+
+def _copy_conv(dst, src, in_idx=None, out_idx=None):
+    weight = src.weight.detach()
+    bias = src.bias.detach() if src.bias is not None else None
+    if out_idx is not None:
+        weight = weight[out_idx]
+        bias = bias[out_idx] if bias is not None else None
+    if in_idx is not None:
+        weight = weight[:, in_idx]
+    dst.weight.data.copy_(weight)
+    if bias is not None:
+        dst.bias.data.copy_(bias)
+
+
+def _copy_bn(dst, src, idx=None):
+    for name in ['weight', 'bias', 'running_mean', 'running_var']:
+        value = getattr(src, name).detach()
+        getattr(dst, name).data.copy_(value if idx is None else value[idx])
+    dst.num_batches_tracked.data.copy_(src.num_batches_tracked)
+
+
+def prune_model(model, d_args, ratio):
+    """
+    pruned, pruned_args = prune_model(model, d_args, ratio)
+
+    model: float RawNet in eval mode
+    d_args: its 'model' config section, as read from the yaml file
+    ratio: fraction of the channels of every group that is removed
+    """
+    scores = channel_scores(model)
+    keep_inner = [_keep(score, ratio) for score in scores["inner"]]
+    keep_stream = _keep(scores["stream"], ratio)
+    keep_gru = [_keep(score, ratio) for score in scores["gru"]]
+    width = len(keep_stream)
+
+    pruned_args = copy.deepcopy(d_args)
+    pruned_args['filts'][2] = [d_args['filts'][2][0], width]
+    pruned_args['filts'][3] = [width, width]
+    pruned_args['mid_filts'] = [len(idx) for idx in keep_inner]
+    pruned_args['gru_node'] = len(keep_gru[0])
+    pruned = RawNet(copy.deepcopy(pruned_args), 'cpu').eval()
+    # every tensor not sliced below is copied as is
+    pruned.load_state_dict({name: value for name, value in model.state_dict().items()
+                            if pruned.state_dict()[name].shape == value.shape},
+                           strict=False)
+
+    for idx, (name, (src, _)) in enumerate(zip(
+            ['block{}'.format(i) for i in range(6)], model.stages())):
+        src, dst = src[0], getattr(pruned, name)[0]
+        stream_in = keep_stream if name in STREAM_BLOCKS[1:] else None
+        stream_out = keep_stream if name in STREAM_BLOCKS else None
+        _copy_conv(dst.conv1, src.conv1, in_idx=stream_in, out_idx=keep_inner[idx])
+        _copy_bn(dst.bn2, src.bn2, keep_inner[idx])
+        _copy_conv(dst.conv2, src.conv2, in_idx=keep_inner[idx], out_idx=stream_out)
+        if not src.first:
+            _copy_bn(dst.bn1, src.bn1, stream_in)
+        if src.downsample:
+            _copy_conv(dst.conv_downsample, src.conv_downsample, out_idx=stream_out)
+    for name in STREAM_ATTENTION:
+        src, dst = getattr(model, name)[0], getattr(pruned, name)[0]
+        dst.weight.data.copy_(src.weight.detach()[keep_stream][:, keep_stream])
+        dst.bias.data.copy_(src.bias.detach()[keep_stream])
+    _copy_bn(pruned.bn_before_gru, model.bn_before_gru, keep_stream)
+
+    hidden = model.gru.hidden_size
+    keep_in = keep_stream
+    for layer, keep in enumerate(keep_gru):
+        # gate rows of the kept units, r, z and n stacked
+        rows = np.concatenate([keep, hidden + keep, 2 * hidden + keep])
+        for name, cols in [('weight_ih_l', keep_in), ('weight_hh_l', keep),
+                           ('bias_ih_l', None), ('bias_hh_l', None)]:
+            value = getattr(model.gru, name + str(layer)).detach()[rows]
+            if cols is not None:
+                value = value[:, cols]
+            getattr(pruned.gru, name + str(layer)).data.copy_(value)
+        keep_in = keep
+    for name in ['fc1_binary_gru', 'fc1_multi_gru']:
+        getattr(pruned, name).weight.data.copy_(getattr(model, name).weight.detach()[:, keep_in])
+    return pruned, pruned_args
+
+
+def count_macs(model, length=96000):
+    """ Multiply-accumulates of one forward of a (1, length) input. """
+    macs = [0]
+
+    def hook(module, inputs, output):
+        macs[0] += module_macs(module, inputs, output)
+
+    hooks = [m.register_forward_hook(hook) for m in model.modules()
+             if isinstance(m, (SincConv, nn.Conv1d, nn.Linear, nn.GRU))]
+    with torch.no_grad():
+        model(torch.zeros(1, length))
+    for h in hooks:
+        h.remove()
+    return macs[0]
+
+
+if __name__ == '__main__':
+    from distill import segment_latency
+    from eval_tools import load_list, evaluate
+    from model_service import DetectionEngine
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='model_detection.pth')
+    parser.add_argument('--config_path', type=str, default='model_config_RawNet.yaml')
+    parser.add_argument('--ratios', type=float, nargs='*', default=[0.25, 0.5, 0.75],
+                        help='Fractions of channels removed')
+    parser.add_argument('--output_dir', type=str, default='pruned')
+    parser.add_argument('--report', type=str, default=None,
+                        help='CSV report, default <output_dir>/prune_report.csv')
+    parser.add_argument('--data_path', type=str, default=None,
+                        help='LibriSeVoc root, needed for dev accuracy and fine-tuning')
+    parser.add_argument('--dev_list', type=str, default='dev.txt')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Only use the first N names of the dev list')
+    parser.add_argument('--finetune_epochs', type=int, default=0,
+                        help='Fine-tune each pruned model with main.py for this many epochs')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    with open(args.config_path, 'r') as f_yaml:
+        config = yaml.safe_load(f_yaml)
+    model = RawNet(copy.deepcopy(config['model']), 'cpu')
+    model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+    model.eval()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    dev_items = load_list(args.data_path, args.dev_list, args.limit) \
+        if args.data_path is not None else None
+
+    rows = []
+    for ratio in [0.0] + [r for r in args.ratios if r > 0]:
+        if ratio == 0:
+            pruned, pruned_args = model, config['model']
+            model_path, config_path = args.model_path, args.config_path
+        else:
+            pruned, pruned_args = prune_model(model, config['model'], ratio)
+            name = 'pruned_{:02d}'.format(int(round(100 * ratio)))
+            model_path = os.path.join(args.output_dir, name + '.pth')
+            config_path = os.path.join(args.output_dir, name + '.yaml')
+            torch.save(pruned.state_dict(), model_path)
+            with open(config_path, 'w') as f_yaml:
+                yaml.safe_dump(dict(config, model=pruned_args), f_yaml,
+                               default_flow_style=None, sort_keys=False)
+
+            if args.finetune_epochs and args.data_path is not None:
+                save_dir = os.path.join(args.output_dir, name + '_finetune')
+                subprocess.check_call([
+                    sys.executable, 'main.py', '--data_path', args.data_path,
+                    '--model_config', config_path, '--init_path', model_path,
+                    '--num_epochs', str(args.finetune_epochs),
+                    '--model_save_path', save_dir])
+                model_path = os.path.join(
+                    save_dir, 'epoch_{}.pth'.format(args.finetune_epochs - 1))
+                pruned.load_state_dict(torch.load(model_path, map_location='cpu'))
+
+        accuracy = None
+        if dev_items is not None:
+            engine = DetectionEngine(model_path=model_path, config_path=config_path,
+                                     device='cpu')
+            accuracy = evaluate(engine.detect, dev_items)['accuracy']
+        rows.append({
+            'ratio': ratio,
+            'params': sum(p.numel() for p in pruned.parameters()),
+            'gmacs': count_macs(pruned) / 1e9,
+            'latency_ms': segment_latency(pruned, 'cpu', runs=args.runs),
+            'dev_accuracy': accuracy,
+            'model_path': model_path,
+            'config_path': config_path,
+        })
+
+    report = args.report or os.path.join(args.output_dir, 'prune_report.csv')
+    with open(report, 'w', newline='') as f_csv:
+        writer = csv.DictWriter(f_csv, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print('{:>6} {:>12} {:>8} {:>16} {:>14}  {}'.format(
+        'ratio', 'params', 'GMACs', 'ms / 4s segment', 'dev accuracy', 'model'))
+    for row in rows:
+        print('{:>6.2f} {:>12} {:>8.2f} {:>16.2f} {:>14}  {}'.format(
+            row['ratio'], row['params'], row['gmacs'], row['latency_ms'],
+            '-' if row['dev_accuracy'] is None else '{:.2f}%'.format(row['dev_accuracy']),
+            row['model_path']))
+    print('Report written to {}'.format(report))
@@ -0,0 +1,205 @@
+"""
+quantize
+
+Int8 inference for RawNet on CPU.
+
+Two schemes are supported:
+  dynamic      int8 weights for nn.GRU and nn.Linear (GRU, attention FCs and
+               both heads), activations quantized on the fly
+  static_conv  dynamic, plus static int8 for the six Residual_block stages,
+               calibrated on a few utterances
+
+Usage (from the repo root):
+  python quantize.py --model_path model_detection.pth \
+      --output_path model_detection_int8.pth --data_path /path/to/LibriSeVoc \
+      --eval_lists dev.txt test.txt --limit 50
+"""
+import argparse
+import copy
+import os
+import time
+import warnings
+
+import numpy as np
+import torch
+import yaml
+from torch import nn
+
+from model import RawNet
+
+QUANT_SCHEMES = ('dynamic', 'static_conv')
+RESIDUAL_BLOCKS = ['block{}'.format(i) for i in range(6)]
+
+
+def quantize_dynamic(model):
+    """ Copy of model with dynamic int8 GRU and Linear layers. """
+    return torch.ao.quantization.quantize_dynamic(
+        copy.deepcopy(model).cpu().eval(), {nn.GRU, nn.Linear},
+        dtype=torch.qint8)
+
+
+def _quantize_blocks(model, calib_batches=None):
+    # each Residual_block stage is converted with FX graph mode; its input
+    # is quantized on entry and dequantized on exit, so the attention and
+    # everything after it stay in float
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    block_inputs = {name: [] for name in RESIDUAL_BLOCKS}
+    if calib_batches:
+        hooks = [getattr(model, name).register_forward_pre_hook(
+                     lambda module, inp, name=name:
+                     block_inputs[name].append(inp[0]))
+                 for name in RESIDUAL_BLOCKS]
+        with torch.no_grad():
+            for batch in calib_batches:
+                model(batch)
+        for hook in hooks:
+            hook.remove()
+
+    qconfig_mapping = get_default_qconfig_mapping(
+        torch.backends.quantized.engine)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for name in RESIDUAL_BLOCKS:
+            block = getattr(model, name)
+            example = block_inputs[name][:1] or \
+                [torch.randn(1, block[0].conv1.in_channels, 64)]
+            prepared = prepare_fx(block, qconfig_mapping,
+                                  example_inputs=(example[0],))
+            with torch.no_grad():
+                for inp in block_inputs[name]:
+                    prepared(inp)
+            setattr(model, name, convert_fx(prepared))
+    return model
+
+
+def quantize_model(model, scheme='dynamic', calib_batches=None):
+    """
+    qmodel = quantize_model(model, scheme='dynamic', calib_batches=None)
+
+    model: float RawNet, left untouched
+    scheme: one of QUANT_SCHEMES
+    calib_batches: list of (batch, length) tensors, required by static_conv
+    """
+    if scheme not in QUANT_SCHEMES:
+        raise ValueError('Unknown quantization scheme {}'.format(scheme))
+    qmodel = quantize_dynamic(model)
+    if scheme == 'static_conv':
+        if not calib_batches:
+            raise ValueError('static_conv needs calibration data')
+        qmodel = _quantize_blocks(qmodel, calib_batches)
+    return qmodel
+
+
+def save_quantized(qmodel, path, scheme):
+    torch.save({'quantization': scheme, 'state_dict': qmodel.state_dict()},
+               path)
+
+
+def is_quantized_checkpoint(checkpoint):
+    return isinstance(checkpoint, dict) and 'quantization' in checkpoint
+
+
+def load_quantized(model, checkpoint):
+    """
+    qmodel = load_quantized(model, checkpoint)
+
+    model: freshly built float RawNet with the checkpoint's config
+    checkpoint: dict loaded from a file written by save_quantized
+    """
+    qmodel = quantize_dynamic(model)
+    if checkpoint['quantization'] == 'static_conv':
+        # observers are left empty, scales come from the state dict
+        qmodel = _quantize_blocks(qmodel)
+    qmodel.load_state_dict(checkpoint['state_dict'])
+    return qmodel.eval()
+
+
+if __name__ == '__main__':
+    from eval import load_sample
+    from eval_tools import load_list, evaluate, current_rss_mb
+    from model_service import DetectionEngine
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='model_detection.pth')
+    parser.add_argument('--output_path', type=str, default='model_detection_int8.pth')
+    parser.add_argument('--config_path', type=str, default='model_config_RawNet.yaml')
+    parser.add_argument('--scheme', type=str, default='dynamic', choices=QUANT_SCHEMES)
+    parser.add_argument('--data_path', type=str, default=None,
+                        help='LibriSeVoc root, needed for calibration and the accuracy report')
+    parser.add_argument('--calib_list', type=str, default='dev.txt')
+    parser.add_argument('--num_calib', type=int, default=16,
+                        help='Number of utterances used to calibrate static_conv')
+    parser.add_argument('--eval_lists', type=str, nargs='*', default=['dev.txt', 'test.txt'])
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Only use the first N names of each list')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    with open(args.config_path, 'r') as f_yaml:
+        d_args = yaml.safe_load(f_yaml)['model']
+
+    rss_start = current_rss_mb()
+    model = RawNet(copy.deepcopy(d_args), 'cpu')
+    model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+    model.eval()
+    rss_float = current_rss_mb() - rss_start
+
+    calib_batches = None
+    if args.scheme == 'static_conv':
+        if args.data_path is None:
+            parser.error('--scheme static_conv needs --data_path')
+        items = load_list(args.data_path, args.calib_list)
+        picked = np.random.RandomState(0).permutation(len(items))[:args.num_calib]
+        calib_batches = [torch.from_numpy(load_sample(items[i][0])) for i in picked]
+
+    qmodel = quantize_model(model, args.scheme, calib_batches)
+    save_quantized(qmodel, args.output_path, args.scheme)
+    print('Quantized model ({}) saved to {}'.format(args.scheme, args.output_path))
+
+    # validate: the saved file must load back into the same outputs
+    rss_start = current_rss_mb()
+    reloaded = load_quantized(RawNet(copy.deepcopy(d_args), 'cpu'),
+                              torch.load(args.output_path, map_location='cpu',
+                                         weights_only=False))
+    rss_quant = current_rss_mb() - rss_start
+    x = torch.randn(2, 96000)
+    with torch.no_grad():
+        diff = (reloaded(x)[0] - qmodel(x)[0]).abs().max().item()
+        diff_float = (model(x)[0].exp() - qmodel(x)[0].exp()).abs().max().item()
+    print('Reload check, max abs diff of log-probs : {:.3e}'.format(diff))
+    print('Float vs int8, max abs diff of probs    : {:.3e}'.format(diff_float))
+
+    def segment_latency(m):
+        with torch.no_grad():
+            m(x[:1])
+            start = time.perf_counter()
+            for _ in range(args.runs):
+                m(x[:1])
+        return 1000 * (time.perf_counter() - start) / args.runs
+
+    print('{:>10} {:>14} {:>14} {:>16}'.format(
+        '', 'file size(MB)', 'RSS delta(MB)', 'ms / 4s segment'))
+    for name, m, path, rss in [('float', model, args.model_path, rss_float),
+                               ('int8', reloaded, args.output_path, rss_quant)]:
+        print('{:>10} {:>14.1f} {:>14.1f} {:>16.2f}'.format(
+            name, os.path.getsize(path) / 2**20, rss, segment_latency(m)))
+
+    if args.data_path is not None:
+        engine_float = DetectionEngine(model_path=args.model_path,
+                                       config_path=args.config_path, device='cpu')
+        engine_quant = DetectionEngine(model_path=args.output_path,
+                                       config_path=args.config_path, device='cpu')
+        for list_path in args.eval_lists:
+            items = load_list(args.data_path, list_path, args.limit)
+            stats_float = evaluate(engine_float.detect, items)
+            stats_quant = evaluate(engine_quant.detect, items)
+            flips = np.sum((stats_float['fake'] > 0.5) != (stats_quant['fake'] > 0.5))
+            print('{}: {} files, accuracy float {:.2f}% int8 {:.2f}% '
+                  '(delta {:+.2f}), decisions changed {}, '
+                  'latency/file float {:.1f} ms int8 {:.1f} ms'.format(
+                      list_path, stats_float['files'], stats_float['accuracy'],
+                      stats_quant['accuracy'],
+                      stats_quant['accuracy'] - stats_float['accuracy'], flips,
+                      stats_float['latency_ms'], stats_quant['latency_ms']))
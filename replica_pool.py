@@ -0,0 +1,231 @@
+"""
+replica_pool
+
+CPU inference on several RawNet replicas, each in its own process with
+its own intra-op thread budget (torch.set_num_threads is per process)
+and optionally pinned to a set of cores, so that concurrent batches do
+not oversubscribe the node the way a single shared thread pool does.
+
+A batch goes to the replica with the fewest batches in flight. Replicas
+are spawned lazily by the process that first uses the pool, so a pool
+created before gunicorn forks its workers ends up with one set of
+replicas per worker.
+
+cpus:
+  None     no pinning
+  "auto"   disjoint blocks of threads cores of the current affinity set,
+           replica i on block i (wrapping around when there are more
+           replicas than blocks)
+  list     one core set per replica, or a string "0-3;4-7"
+"""
+import os
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import Future
+
+# replica processes serving the detection engine, 0 runs it in-process
+REPLICAS = int(os.environ.get("ECHOWIPE_REPLICAS", "0"))
+# intra-op threads per replica, 0 splits the cores evenly
+REPLICA_THREADS = int(os.environ.get("ECHOWIPE_REPLICA_THREADS", "0"))
+# core pinning: unset, "auto" or explicit sets such as "0-3;4-7"
+REPLICA_CPUS = os.environ.get("ECHOWIPE_REPLICA_CPUS") or None
+
+
+def parse_cpus(text):
+    """ "0-3;4,6" -> [{0, 1, 2, 3}, {4, 6}] """
+    cpu_sets = []
+    for group in text.split(";"):
+        cpus = set()
+        for part in group.split(","):
+            if "-" in part:
+                first, last = part.split("-")
+                cpus.update(range(int(first), int(last) + 1))
+            elif part.strip():
+                cpus.add(int(part))
+        cpu_sets.append(cpus)
+    return cpu_sets
+
+
+def plan_cpus(num_replicas, threads, cpus=None):
+    """ Core set of every replica (None: not pinned). """
+    if cpus is None:
+        return [None] * num_replicas
+    if isinstance(cpus, str) and cpus != "auto":
+        cpus = parse_cpus(cpus)
+    if cpus == "auto":
+        available = sorted(os.sched_getaffinity(0))
+        blocks = [set(available[start:start + threads])
+                  for start in range(0, len(available) - threads + 1, threads)]
+        cpus = blocks or [set(available)]
+    return [set(cpus[idx % len(cpus)]) for idx in range(num_replicas)]
+
+
+def _replica_main(engine_kwargs, threads, cpus, tasks, results):
+    import torch
+    from model_service import DetectionEngine
+
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+    engine = DetectionEngine(device="cpu", max_batch_size=None,
+                             **engine_kwargs)
+    results.put((None, "ready", None))
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, batch, lengths = task
+        try:
+            results.put((task_id, engine.forward(batch, lengths), None))
+        except Exception as e:
+            results.put((task_id, None, RuntimeError(repr(e))))
+
+
+class ReplicaPool:
+    """
+    pool = ReplicaPool(num_replicas, threads=0, cpus=None, **engine_kwargs)
+
+    num_replicas: int, replica processes
+    threads: int, torch threads per replica, 0 splits the usable cores
+             evenly (at least 1 each)
+    cpus: core pinning, see the module docstring
+    engine_kwargs: DetectionEngine arguments of the replicas (model_path,
+                   config_path, quantize, backend, mmap, ...)
+
+    forward() has the interface of DetectionEngine.forward and may be
+    called from several threads at once.
+    """
+
+    def __init__(self, num_replicas, threads=0, cpus=None, **engine_kwargs):
+        if num_replicas < 1:
+            raise ValueError("num_replicas should be >= 1")
+        if not threads:
+            threads = max(len(os.sched_getaffinity(0)) // num_replicas, 1)
+        self.num_replicas = num_replicas
+        self.threads = threads
+        self.cpu_sets = plan_cpus(num_replicas, threads, cpus)
+        self.engine_kwargs = engine_kwargs
+        self._lock = threading.Lock()
+        self._pid = None
+        self._processes = []
+
+    def forward(self, batch, lengths=None):
+        self._ensure_replicas()
+        future = Future()
+        with self._lock:
+            # least loaded replica, the first one on ties
+            idx = min(range(self.num_replicas), key=lambda i: self._load[i])
+            self._load[idx] += 1
+            task_id = self._next_id
+            self._next_id += 1
+            self._pending[task_id] = (idx, future)
+        self._tasks[idx].put((task_id, batch, lengths))
+        return future.result()
+
+    def loads(self):
+        """ Batches in flight per replica. """
+        with self._lock:
+            return list(self._load) if self._pid == os.getpid() else \
+                [0] * self.num_replicas
+
+    def close(self):
+        """ Stop the replicas after the batches sent to them are scored. """
+        if self._pid != os.getpid():
+            return
+        for tasks in self._tasks:
+            tasks.put(None)
+        for process in self._processes:
+            process.join()
+        self._results.put(None)
+        self._collector.join()
+        self._pid = None
+        self._processes = []
+
+    def _ensure_replicas(self):
+        # like the BatchScheduler thread, replicas started by the gunicorn
+        # master are not usable from a forked worker
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            # spawn: the parent runs threads (Flask, the micro-batcher)
+            context = multiprocessing.get_context("spawn")
+            self._results = context.Queue()
+            self._tasks = [context.Queue() for _ in range(self.num_replicas)]
+            for tasks in self._tasks:
+                # batches left for a dead replica must not block exit
+                tasks.cancel_join_thread()
+            self._processes = [
+                context.Process(target=_replica_main, daemon=True,
+                                name="rawnet-replica-{}".format(idx),
+                                args=(self.engine_kwargs, self.threads, cpus,
+                                      self._tasks[idx], self._results))
+                for idx, cpus in enumerate(self.cpu_sets)]
+            for process in self._processes:
+                process.start()
+            self._load = [0] * self.num_replicas
+            self._pending = {}
+            self._next_id = 0
+            # wait for every replica to load its model, a failing one
+            # stops the pool from starting
+            try:
+                for _ in self._processes:
+                    self._wait_ready()
+            except RuntimeError:
+                for process in self._processes:
+                    process.terminate()
+                raise
+            self._collector = threading.Thread(
+                target=self._collect, name="rawnet-replica-results",
+                daemon=True)
+            self._collector.start()
+            self._pid = pid
+
+    def _wait_ready(self):
+        while True:
+            try:
+                self._results.get(timeout=1)
+                return
+            except queue.Empty:
+                dead = [p.name for p in self._processes if not p.is_alive()]
+                if dead:
+                    raise RuntimeError("Replica {} failed to start".format(
+                        dead[0]))
+
+    def _collect(self):
+        while True:
+            try:
+                item = self._results.get(timeout=1)
+            except queue.Empty:
+                self._fail_dead()
+                continue
+            if item is None:
+                return
+            task_id, output, error = item
+            with self._lock:
+                idx, future = self._pending.pop(task_id)
+                self._load[idx] -= 1
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(output)
+
+    def _fail_dead(self):
+        # batches sent to a replica that died would wait forever
+        dead = {idx for idx, process in enumerate(self._processes)
+                if not process.is_alive()}
+        if not dead:
+            return
+        with self._lock:
+            lost = [(task_id, future) for task_id, (idx, future)
+                    in self._pending.items() if idx in dead]
+            for task_id, _ in lost:
+                del self._pending[task_id]
+            for idx in dead:
+                # never picked again
+                self._load[idx] = float("inf")
+        for _, future in lost:
+            future.set_exception(RuntimeError("Replica died"))
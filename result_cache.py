@@ -0,0 +1,144 @@
+"""
+result_cache
+
+Detection results keyed by the content of the decoded 24 kHz waveform.
+
+Two tiers:
+  memory  per-process LRU of up to max_entries results
+  sqlite  optional file shared by all gunicorn workers of a node, with
+          least-recently-used eviction beyond max_disk_entries
+
+Entries older than ttl seconds are ignored and eventually deleted. The
+model checksum is part of every key, so results of an older checkpoint
+are never served by a new one.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """ Hex blake2b digest of a file. """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f_in:
+        for chunk in iter(lambda: f_in.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    cache = ResultCache(model_key, max_entries=1024, ttl=86400,
+                        db_path=None, max_disk_entries=100000)
+
+    model_key: str identifying the model (checksum, backend, ...)
+    max_entries: size of the in-memory LRU, 0 disables that tier
+    ttl: seconds an entry stays valid
+    db_path: sqlite file of the shared tier, None disables that tier
+    max_disk_entries: upper bound of rows kept in the sqlite file
+    """
+
+    # evict on disk only every so many inserts
+    EVICT_EVERY = 64
+
+    def __init__(self, model_key, max_entries=1024, ttl=86400,
+                 db_path=None, max_disk_entries=100000):
+        self.model_key = model_key
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.max_disk_entries = max_disk_entries
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._inserts = 0
+        if db_path is not None:
+            self._connect().execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " created REAL NOT NULL, accessed REAL NOT NULL)")
+            self._connect().execute(
+                "CREATE INDEX IF NOT EXISTS results_accessed"
+                " ON results (accessed)")
+
+    def key(self, waveform):
+        """ Cache key of a contiguous float32 waveform. """
+        digest = hashlib.blake2b(self.model_key.encode(), digest_size=20)
+        digest.update(memoryview(waveform).cast('B'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """ Cached result dict, or None. """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, result = entry
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    return result
+                del self._memory[key]
+
+        if self.db_path is None:
+            return None
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT value, created FROM results WHERE key = ? AND created >= ?",
+            (key, now - self.ttl)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE results SET accessed = ? WHERE key = ?",
+                     (now, key))
+        result = json.loads(row[0])
+        self._remember(key, row[1], result)
+        return result
+
+    def put(self, key, result):
+        now = time.time()
+        self._remember(key, now, result)
+        if self.db_path is None:
+            return
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO results (key, value, created, accessed)"
+            " VALUES (?, ?, ?, ?)", (key, json.dumps(result), now, now))
+        with self._lock:
+            self._inserts += 1
+            evict = self._inserts % self.EVICT_EVERY == 0
+        if evict:
+            self._evict(conn, now)
+
+    def _remember(self, key, created, result):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._memory[key] = (created, result)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM results WHERE created < ?",
+                     (now - self.ttl,))
+        conn.execute(
+            "DELETE FROM results WHERE key IN (SELECT key FROM results"
+            " ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,))
+
+    def _connect(self):
+        # sqlite3 connections must not be shared between threads, nor
+        # inherited through fork()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
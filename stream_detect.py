@@ -0,0 +1,255 @@
+"""
+stream_detect
+
+Incremental detection over audio that is still arriving.
+
+StreamDetector takes PCM frames in chunks of any size, keeps the last
+window of audio in a fixed ring buffer and scores the window every hop
+samples, as soon as it is filled. Each window yields its binary and
+vocoder scores together with the running average over the windows seen
+so far; memory does not grow with the length of the stream.
+
+Windows are cut at the sampling rate of the stream and resampled to
+24 kHz one at a time, so that no resampler state has to be carried
+across chunks.
+
+StatefulStreamDetector has the same interface but runs RawNet through
+stream_model.StreamingRawNet: each hop only computes its new frames and
+the GRU state is carried over, instead of re-running a full window. It
+takes 24 kHz streams only: resampling hop by hop would put filter edge
+transients at every hop boundary, which the GRU state would carry on.
+"""
+import os
+
+import numpy as np
+
+import core_scripts.data_io.wav_tools as nii_wav_tk
+from eval import pad, resample
+from model_service import build_result
+from upload_io import check_sample_rate
+from stream_frames import FRAME
+
+# window length of RawNet, in samples at 24 kHz (see eval.load_sample)
+WINDOW = 96000
+# default hop between two windows, in samples at 24 kHz
+STREAM_HOP = int(os.environ.get("ECHOWIPE_STREAM_HOP", "48000"))
+# bytes read from the request body at a time
+READ_BYTES = 8192
+
+# raw encodings accepted besides "wav", as (format_tag, bits)
+ENCODINGS = {
+    "pcm16": (nii_wav_tk.WAVE_FORMAT_PCM, 16),
+    "pcm24": (nii_wav_tk.WAVE_FORMAT_PCM, 24),
+    "pcm32": (nii_wav_tk.WAVE_FORMAT_PCM, 32),
+    "float32": (nii_wav_tk.WAVE_FORMAT_IEEE_FLOAT, 32),
+}
+# (format_tag, bits) nii_wav_tk.wavDataToFloat can decode
+SUPPORTED_FORMATS = set(ENCODINGS.values()) | {
+    (nii_wav_tk.WAVE_FORMAT_PCM, 8), (nii_wav_tk.WAVE_FORMAT_IEEE_FLOAT, 64)}
+# channels of a stream, averaged to mono
+MAX_CHANNELS = 32
+
+
+def stream_format(encoding, sr, channels):
+    """ fmt dict of nii_wav_tk.wavDataToFloat for a raw PCM stream. """
+    if encoding not in ENCODINGS:
+        raise ValueError("Unknown encoding {}".format(encoding))
+    format_tag, bits = ENCODINGS[encoding]
+    return check_format({'format_tag': format_tag, 'channels': channels,
+                         'sr': sr, 'block_align': channels * bits // 8,
+                         'bits': bits})
+
+
+def check_format(fmt):
+    """
+    fmt = check_format(fmt)
+
+    Raise ValueError unless fmt (from stream_format or a WAVE header)
+    describes frames iter_stream_samples can decode at an accepted rate.
+    """
+    check_sample_rate(fmt['sr'])
+    if not 1 <= fmt['channels'] <= MAX_CHANNELS:
+        raise ValueError("channels should be in 1..{}".format(MAX_CHANNELS))
+    if (fmt['format_tag'], fmt['bits']) not in SUPPORTED_FORMATS:
+        raise ValueError("Unsupported sample format ({}, {} bits)".format(
+            fmt['format_tag'], fmt['bits']))
+    if fmt['block_align'] != fmt['channels'] * fmt['bits'] // 8:
+        raise ValueError("block_align does not match channels and bits")
+    return fmt
+
+
+class StreamDetector:
+    """
+    detector = StreamDetector(engine, sr=24000, hop=STREAM_HOP)
+
+    engine: DetectionEngine, windows are scored through engine.score
+    sr: sampling rate of the pushed samples
+    hop: samples at 24 kHz between the starts of two windows, 1..96000
+
+    for window in detector.push(samples): ...   # as audio arrives
+    for window in detector.finish(): ...         # at the end of the stream
+    result = detector.result()
+    """
+
+    def __init__(self, engine, sr=24000, hop=STREAM_HOP):
+        if not 0 < hop <= WINDOW:
+            raise ValueError("hop should be in 1..{}".format(WINDOW))
+        self.engine = engine
+        self.sr = sr
+        # window and hop at the rate of the stream
+        self.window = int(round(WINDOW * sr / 24000.))
+        self.hop = max(int(round(hop * sr / 24000.)), 1)
+
+        self._ring = np.zeros(self.window, dtype=np.float32)
+        self._pos = 0
+        self._received = 0
+        self._next = self.window
+        self._windows = 0
+        self._sum_binary = np.zeros(2)
+        self._sum_multi = np.zeros(7)
+
+    def push(self, samples):
+        """
+        Append 1-D float samples; yield one dict per window that got filled.
+        """
+        samples = np.asarray(samples, dtype=np.float32)
+        while len(samples):
+            # copy up to the end of the next window, or what is left
+            take = min(len(samples), self._next - self._received)
+            self._write(samples[:take])
+            samples = samples[take:]
+            self._received += take
+            if self._received == self._next:
+                self._next += self.hop
+                yield self._score(self._window(), self._received)
+
+    def finish(self):
+        """
+        Yield the window still owed at the end of the stream: one aligned to
+        the last sample when the tail is not covered yet, or the padded
+        audio when the stream is shorter than a window (as eval.segment).
+        """
+        if self._windows == 0:
+            if self._received > 0:
+                yield self._score(self._ring[:self._received].copy(),
+                                  self._received)
+        elif self._received > self._next - self.hop:
+            yield self._score(self._window(), self._received)
+
+    def result(self):
+        """ Aggregate dict over all windows scored so far. """
+        if self._windows == 0:
+            raise ValueError("No audio received")
+        return build_result(self._sum_binary / self._windows,
+                            self._sum_multi / self._windows, self._windows)
+
+    def _write(self, samples):
+        # never more than one window at a time, see push()
+        end = self._pos + len(samples)
+        if end <= self.window:
+            self._ring[self._pos:end] = samples
+        else:
+            split = self.window - self._pos
+            self._ring[self._pos:] = samples[:split]
+            self._ring[:end - self.window] = samples[split:]
+        self._pos = end % self.window
+
+    def _window(self):
+        # oldest sample first
+        return np.concatenate([self._ring[self._pos:], self._ring[:self._pos]])
+
+    def _score(self, samples, end):
+        # resampling may be off by a sample; pad() trims or repeat-pads
+        segment = pad(resample(samples, self.sr), WINDOW)
+        probs_binary, probs_multi = self.engine.score(segment[None])
+        return self._record(probs_binary[0], probs_multi[0],
+                            max(end - self.window, 0), end)
+
+    def _record(self, probs_binary, probs_multi, start, end):
+        self._windows += 1
+        self._sum_binary += probs_binary
+        self._sum_multi += probs_multi
+
+        window = build_result(probs_binary, probs_multi, 1)
+        del window["segments"]
+        window["window"] = self._windows - 1
+        window["start"] = start / float(self.sr)
+        window["end"] = end / float(self.sr)
+        window["aggregate"] = self.result()
+        return window
+
+
+class StatefulStreamDetector(StreamDetector):
+    """
+    detector = StatefulStreamDetector(engine, sr=24000, hop=STREAM_HOP,
+                                      memory=WINDOW)
+
+    Same interface as StreamDetector; needs the torch backend and a
+    24 kHz stream. Every hop of audio is pushed to a StreamingRawNet,
+    whose scores cover the stream so far; memory is the time constant of
+    its attention means, in samples at 24 kHz.
+    """
+
+    def __init__(self, engine, sr=24000, hop=STREAM_HOP, memory=WINDOW):
+        if sr != 24000:
+            raise ValueError("Stateful streaming needs 24 kHz audio, got {} Hz".format(sr))
+        super(StatefulStreamDetector, self).__init__(engine, sr, hop)
+        if not hasattr(engine.model, 'classify'):
+            raise ValueError("Stateful streaming needs the torch backend")
+        # torch is only needed here, not by the onnxruntime serving path
+        from stream_model import StreamingRawNet
+
+        self.streamer = StreamingRawNet(engine.model, memory)
+        # at most one hop of audio waits here
+        self._pending = []
+        self._num_pending = 0
+
+    def push(self, samples):
+        samples = np.asarray(samples, dtype=np.float32)
+        while len(samples):
+            take = min(len(samples), self.hop - self._num_pending)
+            self._pending.append(samples[:take])
+            self._num_pending += take
+            samples = samples[take:]
+            if self._num_pending == self.hop:
+                window = self._step()
+                if window is not None:
+                    yield window
+
+    def finish(self):
+        window = self._step(final=True)
+        if window is not None:
+            yield window
+
+    def _step(self, final=False):
+        hop = np.concatenate(self._pending) if self._pending \
+            else np.zeros(0, dtype=np.float32)
+        self._pending, self._num_pending = [], 0
+        self._received += len(hop)
+        start = self.streamer.frames
+        outputs = self.streamer.step(hop, final=final)
+        if outputs is None:
+            return None
+        probs_binary, probs_multi = [np.exp(out[0].cpu().numpy())
+                                     for out in outputs]
+        # span of the GRU frames scored by this hop
+        return self._record(probs_binary, probs_multi, start * FRAME,
+                            self.streamer.frames * FRAME)
+
+
+def iter_stream_samples(stream, fmt, read_bytes=READ_BYTES):
+    """
+    Yield mono float32 sample blocks decoded from a binary stream of raw
+    frames; a frame split across two reads is kept for the next block.
+    """
+    frame_bytes = fmt['block_align']
+    pending = b''
+    while True:
+        chunk = stream.read(read_bytes)
+        if not chunk:
+            break
+        data = pending + chunk
+        usable = len(data) - len(data) % frame_bytes
+        pending = data[usable:]
+        if usable:
+            yield nii_wav_tk.wavDataToFloat(data[:usable], fmt)
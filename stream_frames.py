@@ -0,0 +1,17 @@
+"""
+stream_frames
+
+Frame geometry of RawNet shared by stream_model and stream_detect, kept
+free of torch so that the onnxruntime serving path can import it.
+"""
+
+# samples per GRU frame: SincConv pooling and six Residual_block poolings
+FRAME = 3 ** 7
+# front-end frames (3 samples each) per GRU frame
+FRONT_FRAMES = 3 ** 6
+# GRU frames of left context for the six stages: the receptive field of a
+# GRU frame reaches 728 front-end frames back
+CONTEXT = 1
+# GRU frames held back until their right context has arrived: the
+# receptive field reaches 1456 front-end frames past the frame start
+LOOKAHEAD = 1
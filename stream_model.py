@@ -0,0 +1,122 @@
+"""
+stream_model
+
+Stateful streaming inference for RawNet.
+
+RawNet.forward scores each 4 s window from scratch: overlapping windows
+recompute the shared audio and the GRU restarts from zeros. StreamingRawNet
+instead consumes a stream hop by hop and only computes the new frames:
+
+  front end  SincConv, pooling and first_bn only see 1025 samples per
+             output; their output is cached for the last CONTEXT +
+             LOOKAHEAD GRU frames, so each sample goes through SincConv once
+  stages     the six residual stages run on the cached and the new
+             front-end frames, which covers their receptive field; a GRU
+             frame is held back until its right context has arrived
+  attention  the per-filter mean over the window is replaced by an
+             exponential running mean with a time constant of `memory`
+             samples, carried per stage
+  GRU        the hidden state after the last frame seeds the next hop
+
+With the attention scales fixed, feeding a stream hop by hop gives the
+same frames as one pass over the whole stream. Scores summarize the
+stream so far, weighted towards the last `memory` samples, rather than a
+single window; on a stream of one window they are close to RawNet.forward.
+"""
+import math
+
+import torch
+
+from stream_frames import CONTEXT, FRAME, FRONT_FRAMES, LOOKAHEAD
+
+
+class StreamingRawNet:
+    """
+    streamer = StreamingRawNet(model, memory=96000)
+
+    model: eval-mode RawNet (float or dynamically quantized)
+    memory: time constant, in samples at 24 kHz, of the attention means
+
+    outputs = streamer.step(samples)   # (log_probs_binary, log_probs_multi)
+                                       # or None while no frame is complete
+    outputs = streamer.step([], final=True)   # at the end of the stream
+    """
+
+    def __init__(self, model, memory=96000):
+        self.model = model
+        self.memory = memory
+        self.device = getattr(model, 'device', 'cpu')
+        self.reset()
+
+    def reset(self):
+        """ Forget the stream: buffered samples, caches and GRU state. """
+        # raw samples not consumed yet, led by SincConv context once started
+        self._samples = torch.zeros(0)
+        # front-end output of the context and held-back GRU frames
+        self._features = None
+        self._means = [None] * len(self.model.stages())
+        self._hidden = None
+        # GRU frames scored so far
+        self.frames = 0
+
+    def step(self, samples, final=False):
+        """
+        Push 1-D float samples at 24 kHz and score the GRU frames whose
+        receptive field is complete. With final=True the held-back frames
+        are scored as well, with zero right padding like the end of a
+        window; samples short of a whole frame are dropped, and reset()
+        has to be called before the streamer is used again.
+        """
+        kernel_size = self.model.Sinc_conv.kernel_size
+        self._samples = torch.cat([self._samples,
+                                   torch.as_tensor(samples, dtype=torch.float32)])
+        # only whole GRU frames, the rest waits for the next hop
+        available = len(self._samples) - (kernel_size - 1)
+        num = max(available // FRAME, 0) * FRAME
+
+        with torch.no_grad():
+            parts = [] if self._features is None else [self._features]
+            if num:
+                x = self._samples[:num + kernel_size - 1]
+                self._samples = self._samples[num:]
+                parts.append(self.model.front_end(
+                    x.view(1, 1, -1).to(self.device)))
+            if not parts:
+                return None
+            x = torch.cat(parts, dim=-1)
+            total = x.shape[-1] // FRONT_FRAMES
+            cached = 0 if self._features is None \
+                else self._features.shape[-1] // FRONT_FRAMES
+            self._features = x[..., -(CONTEXT + LOOKAHEAD) * FRONT_FRAMES:]
+            # GRU frames [skip, stop) are scored now
+            skip = max(cached - LOOKAHEAD, 0)
+            stop = total if final else total - LOOKAHEAD
+            if stop <= skip:
+                return None
+
+            frames = FRONT_FRAMES
+            for idx, (block, fc_attention) in enumerate(self.model.stages()):
+                x = block(x)
+                frames //= 3
+                x = self._attention(idx, x, skip * frames, stop * frames,
+                                    fc_attention)
+            x = x[..., skip:stop]
+
+            output_binary, output_multi, self._hidden = \
+                self.model.classify(x, self._hidden)
+        self.frames += stop - skip
+        return output_binary, output_multi
+
+    def _attention(self, idx, x, start, end, fc_attention):
+        # running mean over the frames scored now; context frames were
+        # counted by an earlier hop, held-back ones will be by a later one
+        new = x[..., start:end]
+        mean = new.mean(dim=-1)
+        if self._means[idx] is not None:
+            # frames of this stage span 3 ** (idx + 2) samples
+            tau = self.memory / 3 ** (idx + 2)
+            weight = 1 - math.exp(-new.shape[-1] / tau)
+            mean = torch.lerp(self._means[idx], mean, weight)
+        self._means[idx] = mean
+        y = self.model.sig(fc_attention(mean)).unsqueeze(-1)
+        return torch.addcmul(y, x, y)
@@ -0,0 +1,123 @@
+"""
+upload_io
+
+Decode uploaded audio straight from the request, without temp files.
+
+WAV uploads are parsed in place by core_scripts.data_io.wav_tools; other
+containers are handed to librosa as an in-memory file object. Uploads
+larger than MAX_UPLOAD_BYTES are rejected by Flask while the body is
+received, and WAV audio longer than MAX_UPLOAD_SECONDS is rejected from
+its header before any sample is decoded. Other audio is checked against
+the duration libsndfile reads from the container, and never decoded past
+MAX_UPLOAD_SECONDS.
+"""
+import io
+import os
+import tempfile
+
+import soundfile
+from flask import Request
+
+import core_scripts.data_io.wav_tools as nii_wav_tk
+
+MAX_UPLOAD_BYTES = int(float(os.environ.get("ECHOWIPE_MAX_UPLOAD_MB", "50"))
+                       * 1024 * 1024)
+MAX_UPLOAD_SECONDS = float(os.environ.get("ECHOWIPE_MAX_UPLOAD_SECONDS", "600"))
+# sampling rates accepted from uploads and streams: buffers and resampling
+# filters are sized from them
+MIN_SAMPLE_RATE = 4000
+MAX_SAMPLE_RATE = 384000
+
+
+def check_sample_rate(sr):
+    """ Raise ValueError for a sampling rate outside MIN..MAX_SAMPLE_RATE. """
+    if not MIN_SAMPLE_RATE <= sr <= MAX_SAMPLE_RATE:
+        raise ValueError("Sampling rate should be in {}..{} Hz, got {}".format(
+            MIN_SAMPLE_RATE, MAX_SAMPLE_RATE, sr))
+
+
+class UploadError(ValueError):
+    """ Upload that cannot be scored; status is the HTTP code to answer. """
+
+    def __init__(self, message, status=400):
+        super(UploadError, self).__init__(message)
+        self.status = status
+
+
+class InMemoryRequest(Request):
+    """
+    Flask request that keeps uploaded files in memory.
+
+    Werkzeug spools uploads above 500 kB to a temporary file; the body size
+    is already capped by MAX_CONTENT_LENGTH, so a BytesIO is safe here.
+    A view setting spool_uploads (background jobs, whose uploads are large
+    and outlive the request) gets temporary files instead.
+    """
+    spool_uploads = False
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if self.spool_uploads:
+            return tempfile.TemporaryFile("rb+")
+        return io.BytesIO()
+
+
+def decode_upload(stream, max_seconds=MAX_UPLOAD_SECONDS,
+                  max_bytes=MAX_UPLOAD_BYTES):
+    """
+    waveform, sr = decode_upload(stream, max_seconds=MAX_UPLOAD_SECONDS,
+                                 max_bytes=MAX_UPLOAD_BYTES)
+
+    stream: binary file-like object, e.g. request.files["audio"].stream
+    waveform: np.float32, (length, ), mono
+    """
+    if not stream.seekable():
+        stream = io.BytesIO(stream.read(max_bytes + 1))
+    if stream.seek(0, io.SEEK_END) > max_bytes:
+        raise UploadError("Upload is larger than %d bytes" % max_bytes, 413)
+    stream.seek(0)
+    magic = stream.read(12)
+    stream.seek(0)
+
+    if magic[0:4] == b'RIFF' and magic[8:12] == b'WAVE':
+        try:
+            # the header alone tells the duration
+            fmt, data_size = nii_wav_tk.wavHeaderRead(stream)
+            check_sample_rate(fmt['sr'])
+            stream.seek(0)
+            if data_size is not None and data_size > \
+                    max_seconds * fmt['sr'] * max(fmt['block_align'], 1):
+                raise UploadError(
+                    "Audio is longer than %g seconds" % max_seconds, 413)
+            sr, waveform = nii_wav_tk.waveReadFromStream(stream)
+        except UploadError:
+            raise
+        except ValueError as e:
+            raise UploadError(str(e))
+    else:
+        import librosa
+
+        try:
+            # libsndfile containers (FLAC, OGG, MP3...) tell their duration
+            # before anything is decoded
+            duration = soundfile.info(stream).duration
+        except Exception:
+            duration = None
+        stream.seek(0)
+        if duration is not None and duration > max_seconds:
+            raise UploadError("Audio is longer than %g seconds" % max_seconds, 413)
+        try:
+            # and the rest is decoded no further than just past the limit
+            waveform, sr = librosa.load(stream, sr=None, duration=max_seconds + 1)
+        except Exception as e:
+            raise UploadError("Cannot decode audio: %s" % e)
+        try:
+            check_sample_rate(sr)
+        except ValueError as e:
+            raise UploadError(str(e))
+
+    if len(waveform) > max_seconds * sr:
+        raise UploadError("Audio is longer than %g seconds" % max_seconds, 413)
+    if len(waveform) == 0:
+        raise UploadError("Audio is empty")
+    return waveform, sr
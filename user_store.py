@@ -0,0 +1,161 @@
+"""
+user_store
+
+Accounts of the web app in SQLite (users.db), one row per user with a
+unique index on email: a login is one indexed lookup and a signup one
+INSERT, whatever the number of users, and two workers signing up the same
+email at once cannot both succeed.
+
+Connections are per thread and per process, in WAL mode so that logins
+never wait for a signup. The schema of the original users.db (id,
+username, email, password) is extended in place with first, last and
+created; a users.json of the old JSON store is imported on first use and
+renamed to users.json.migrated.
+
+Usage:
+  python user_store.py --db users.db --json users.json
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# sqlite file holding the accounts
+USER_DB = os.environ.get("ECHOWIPE_USER_DB", os.path.join(BASE_DIR, "users.db"))
+# accounts of the old JSON store, imported once into USER_DB
+USER_JSON = os.environ.get("ECHOWIPE_USER_JSON",
+                           os.path.join(BASE_DIR, "users.json"))
+
+COLUMNS = [("first", "TEXT"), ("last", "TEXT"), ("created", "TEXT")]
+
+
+class UserStore:
+    """
+    users = UserStore(db_path=USER_DB, json_path=USER_JSON)
+
+    db_path: sqlite file, created when missing
+    json_path: users.json of the old store, imported when it exists
+
+    Users are dicts with "email", "password" (a werkzeug hash), "first",
+    "last" and "created".
+    """
+
+    def __init__(self, db_path=USER_DB, json_path=USER_JSON):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._migrate_schema()
+        if json_path is not None and os.path.exists(json_path):
+            self.import_json(json_path)
+
+    def get(self, email):
+        """ User dict of an email, or None. """
+        row = self._connect().execute(
+            "SELECT email, password, first, last, created FROM users"
+            " WHERE email = ?", (email,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(["email", "password", "first", "last", "created"], row))
+
+    def create(self, email, password, first=None, last=None, created=None):
+        """ Add a user; False when the email is taken. """
+        try:
+            self._connect().execute(
+                "INSERT INTO users (email, password, first, last, created)"
+                " VALUES (?, ?, ?, ?, ?)", (email, password, first, last, created))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def import_json(self, json_path):
+        """
+        imported = users.import_json(json_path)
+
+        Insert the users of a users.json ({email: {"password", "first",
+        "last", "created"}}) that are not in the database yet, in one
+        transaction, then rename the file so it is not imported again.
+        """
+        with open(json_path, "r") as f_json:
+            users = json.load(f_json)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO users (email, password, first, last, created)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [(email, user.get("password"), user.get("first"),
+                  user.get("last"), user.get("created"))
+                 for email, user in users.items()])
+            imported = conn.total_changes - before
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        try:
+            os.replace(json_path, json_path + ".migrated")
+        except FileNotFoundError:
+            # another worker imported and renamed it first
+            pass
+        return imported
+
+    def _migrate_schema(self):
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE,"
+            " email TEXT, password TEXT)")
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+        for name, kind in COLUMNS:
+            if name not in columns:
+                try:
+                    conn.execute("ALTER TABLE users ADD COLUMN {} {}".format(name, kind))
+                except sqlite3.OperationalError:
+                    # added by another worker in the meantime
+                    pass
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS users_email ON users (email)")
+
+    def _connect(self):
+        # like ResultCache: one connection per thread, none across fork()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+_user_store = None
+_user_store_lock = threading.Lock()
+
+
+def get_user_store():
+    """ Return the per-process UserStore, created on first use. """
+    global _user_store
+    if _user_store is None:
+        with _user_store_lock:
+            if _user_store is None:
+                _user_store = UserStore()
+    return _user_store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', type=str, default=USER_DB)
+    parser.add_argument('--json', type=str, default=USER_JSON,
+                        help='users.json to import')
+    args = parser.parse_args()
+
+    users = UserStore(args.db, json_path=None)
+    if os.path.exists(args.json):
+        print('Imported {} users from {}'.format(users.import_json(args.json), args.json))
+    else:
+        print('{} not found, nothing to import'.format(args.json))
+    print('{} users in {}'.format(users.count(), args.db))